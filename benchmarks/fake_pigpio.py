@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the pigpio module, for benchmarks and for trying gpio_pins.py
+and shift_register.py without a Raspberry Pi.
+
+Each pi method counts as one round trip to pigpiod and adds CALL_LATENCY to
+the simulated time of the connection (pi.elapsed); a wave adds the length of
+its pulses. Pin levels are tracked, and shift register chains attached with
+pi.attach_shift_register() latch the bits clocked into them, so the outputs
+can be compared with the frame that was sent.
+"""
+
+OUTPUT = 1
+INPUT = 0
+PUD_OFF = 0
+PUD_DOWN = 1
+PUD_UP = 2
+EITHER_EDGE = 2
+TIMEOUT = 2
+
+CALL_LATENCY = 100e-6  # Seconds per round trip to pigpiod over its socket.
+
+
+class error(Exception):
+    pass
+
+
+class pulse(object):
+
+    def __init__(self, gpio_on, gpio_off, delay):
+        self.gpio_on = gpio_on
+        self.gpio_off = gpio_off
+        self.delay = delay  # microseconds
+
+
+class ShiftRegister(object):
+    """
+    Chain of 74HC595 shift registers: a rising clock shifts the data bit in,
+    a rising latch copies the shifted bits to the outputs.
+    """
+
+    def __init__(self, dat, clk, lat, size=512):
+        self.dat = dat
+        self.clk = clk
+        self.lat = lat
+        self.size = size
+        self.shifted = [0] * size
+        self.outputs = [0] * size
+
+    def update(self, before, after):
+        if after.get(self.clk) and not before.get(self.clk):
+            self.shifted = [after.get(self.dat, 0)] + self.shifted[:-1]
+        if after.get(self.lat) and not before.get(self.lat):
+            self.outputs = list(self.shifted)
+
+    def frame(self, n):
+        """Return the first n outputs, station 1 first."""
+        return self.outputs[:n]
+
+
+def _gpios(mask):
+    return [g for g in range(32) if mask >> g & 1]
+
+
+class pi(object):
+
+    def __init__(self, host='localhost', port=8888):
+        self.connected = True
+        self.calls = 0
+        self.elapsed = 0.0  # simulated seconds
+        self.levels = {}
+        self.registers = []
+        self._pulses = []
+        self._waves = {}
+
+    def _call(self):
+        self.calls += 1
+        self.elapsed += CALL_LATENCY
+
+    def _set(self, on, off):
+        before = dict(self.levels)
+        for g in on:
+            self.levels[g] = 1
+        for g in off:
+            self.levels[g] = 0
+        for r in self.registers:
+            r.update(before, self.levels)
+
+    def attach_shift_register(self, dat, clk, lat):
+        r = ShiftRegister(dat, clk, lat)
+        self.registers.append(r)
+        return r
+
+    def set_mode(self, gpio, mode):
+        self._call()
+        return 0
+
+    def set_pull_up_down(self, gpio, pud):
+        self._call()
+        return 0
+
+    def read(self, gpio):
+        self._call()
+        return self.levels.get(gpio, 0)
+
+    def write(self, gpio, level):
+        self._call()
+        if level:
+            self._set([gpio], [])
+        else:
+            self._set([], [gpio])
+        return 0
+
+    def callback(self, gpio, edge=0, func=None):
+        self._call()
+        return None
+
+    def wave_clear(self):
+        self._call()
+        self._pulses = []
+        return 0
+
+    def wave_add_generic(self, pulses):
+        self._call()
+        self._pulses.extend(pulses)
+        return len(self._pulses)
+
+    def wave_create(self):
+        self._call()
+        wid = len(self._waves)
+        self._waves[wid] = self._pulses
+        self._pulses = []
+        return wid
+
+    def wave_send_once(self, wave_id):
+        self._call()
+        for p in self._waves[wave_id]:
+            self._set(_gpios(p.gpio_on), _gpios(p.gpio_off))
+            self.elapsed += p.delay / 1e6
+        return 0
+
+    def wave_tx_busy(self):
+        self._call()
+        return 0
+
+    def wave_delete(self, wave_id):
+        self._call()
+        del self._waves[wave_id]
+        return 0
+
+    def stop(self):
+        self.connected = False
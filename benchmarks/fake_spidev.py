@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Stand-in for the spidev module, for benchmarks and for trying
+shift_register.SpiOutput without SPI hardware.
+
+Each transfer adds CALL_LATENCY plus the time to clock its bits at
+max_speed_hz to the simulated time (SpiDev.elapsed), and is kept in
+SpiDev.sent.
+"""
+
+CALL_LATENCY = 20e-6  # Seconds per ioctl.
+
+
+class SpiDev(object):
+
+    def __init__(self):
+        self.max_speed_hz = 500000
+        self.mode = 0
+        self.calls = 0
+        self.elapsed = 0.0  # simulated seconds
+        self.sent = []
+
+    def open(self, bus, device):
+        self.calls += 1
+
+    def close(self):
+        pass
+
+    def xfer2(self, data):
+        self.calls += 1
+        self.elapsed += CALL_LATENCY + len(data) * 8.0 / self.max_speed_hz
+        self.sent.append(list(data))
+        return [0] * len(data)
+
+    def frame(self, n):
+        """
+        Return the first n outputs of a shift register chain after the last
+        transfer, station 1 first.
+        """
+        data = self.sent[-1]
+        outputs = []
+        for byte in reversed(data):  # The first byte sent ends up on the last board.
+            outputs.extend(byte >> s & 1 for s in range(8))
+        return outputs[:n]
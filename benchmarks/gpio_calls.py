@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Count the GPIO calls made by gpio_pins.set_output and estimate their time on hardware.
+
+gpio_pins runs on the recording backend (gpio_recorder.py), which charges
+a fixed simulated latency for every gp_* call. For each number of boards a
+series of random frames is written with set_output(), and the calls and
+simulated time per set_output are reported. The frames latched into the
+shift registers are decoded from the recorded writes and checked against
+the station values.
+
+Run from the SIP directory:
+    python benchmarks/gpio_calls.py [-b BOARDS ...] [-l LATENCY_US] [-n REFRESHES]
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['SIP_GPIO'] = 'recording'
+
+import i18n
+
+import argparse
+import random
+
+import gv
+import gpio_pins
+import gpio_recorder
+
+
+def measure(nbrd, latency, refreshes):
+    """
+    Return (calls, writes, simulated seconds) per set_output for nbrd boards.
+    """
+    nst = nbrd * 8
+    gv.sd['nbrd'] = nbrd
+    gv.sd['nst'] = nst
+    gv.sd['alr'] = 0
+    gv.stations.resize(nst)
+    recorder = gpio_recorder.Recorder(latency)
+    gpio_pins.use_recorder(recorder)
+    gpio_pins.set_output()  # Sets up the pins on the first call.
+
+    calls = writes = 0
+    elapsed = 0.0
+    frame = gv.srvals.tolist()
+    for i in range(refreshes):
+        previous = frame
+        while frame == previous:
+            frame = [random.randint(0, 1) for sid in range(nst)]
+        for sid, value in enumerate(frame):
+            gv.srvals[sid] = value
+        recorder.reset()
+        gpio_pins.set_output()
+        latched = gpio_recorder.decode_frames(recorder.calls, gpio_pins.pin_sr_dat,
+                                              gpio_pins.pin_sr_clk, gpio_pins.pin_sr_lat)
+        assert latched == [frame], 'latched outputs do not match the stations'
+        calls += recorder.count()
+        writes += recorder.count('write')
+        elapsed += recorder.elapsed
+    return calls / refreshes, writes / refreshes, elapsed / refreshes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count GPIO calls per set_output.')
+    parser.add_argument('-b', '--boards', type=int, nargs='+', default=[1, 8, 64], help='numbers of boards')
+    parser.add_argument('-l', '--latency', type=float, default=100.0, help='simulated time per GPIO call in microseconds')
+    parser.add_argument('-n', '--refreshes', type=int, default=20, help='set_output calls per measurement')
+    args = parser.parse_args()
+
+    print '{:>7} {:>9} {:>18} {:>10} {:>15}'.format('boards', 'stations', 'calls/set_output', 'writes', 'simulated (ms)')
+    for nbrd in args.boards:
+        calls, writes, elapsed = measure(nbrd, args.latency / 1e6, args.refreshes)
+        print '{:>7} {:>9} {:>18} {:>10} {:>15.2f}'.format(nbrd, nbrd * 8, calls, writes, elapsed * 1e3)
+
+
+if __name__ == '__main__':
+    main()
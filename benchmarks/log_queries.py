@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time log queries on a long history with the segment files (run_log.py) and
+the SQLite database (log_db.py).
+
+A history of YEARS years with RUNS_PER_DAY runs a day spread over STATIONS
+stations is written to both stores in a temporary directory, then each of
+these queries is timed:
+
+    total       minutes of station 12 last month (run_log.totals)
+    month       records of last month (run_log.records_between)
+    page        a page of 100 records from the middle of the log (run_log.page)
+
+Run from the SIP directory:
+    python benchmarks/log_queries.py [-y YEARS] [-r RUNS_PER_DAY]
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import i18n
+
+import argparse
+import datetime
+import json
+import shutil
+import tempfile
+import time
+
+import gv
+import log_db
+import run_log
+
+STATIONS = 16
+
+
+def history(years, runs_per_day):
+    """Return the log lines of years of runs, oldest first, and the first day of the last month."""
+    lines = []
+    day = datetime.date.today() - datetime.timedelta(days=365 * years)
+    end = datetime.date.today()
+    n = 0
+    while day < end:
+        for i in range(runs_per_day):
+            minutes = 5 + n % 20
+            lines.append(json.dumps({'program': str(n % 5 + 1), 'station': n % STATIONS,
+                                     'duration': '{:02d}:00'.format(minutes),
+                                     'start': '{:02d}:00:00'.format(4 + i % 20), 'date': day.isoformat()}))
+            n += 1
+        day += datetime.timedelta(days=1)
+    last_month = (end.replace(day=1) - datetime.timedelta(days=1)).replace(day=1)
+    return lines, last_month
+
+
+def best(func, repeat=5):
+    """Return the shortest of repeat timings of func(), in seconds."""
+    times = []
+    for i in range(repeat):
+        began = time.time()
+        func()
+        times.append(time.time() - began)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time log queries on a long history.')
+    parser.add_argument('-y', '--years', type=int, default=5, help='years of history')
+    parser.add_argument('-r', '--runs', type=int, default=30, help='runs per day')
+    args = parser.parse_args()
+
+    gv.sd['lr'] = 0
+    lines, month = history(args.years, args.runs)
+    first = month.isoformat()
+    last = (month.replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(days=1)
+    last = last.isoformat()
+    middle = len(lines) / 2
+    print '{} records, {} to {}'.format(len(lines), json.loads(lines[0])['date'], json.loads(lines[-1])['date'])
+
+    directory = tempfile.mkdtemp()
+    try:
+        segments = run_log.LogStore(os.path.join(directory, 'log'))
+        began = time.time()
+        for line in lines:
+            segments.append(line)
+        print 'segment files written in {:.1f} s'.format(time.time() - began)
+        database = log_db.SqliteStore(os.path.join(directory, 'log.db'))
+        began = time.time()
+        for line in lines:
+            database.append(line)
+        database.flush()
+        print 'database written in {:.1f} s'.format(time.time() - began)
+
+        cursors = {segments: '{}.{}'.format(middle / segments.segment_records + 1, middle % segments.segment_records),
+                   database: str(middle)}
+        print '{:>10} {:>15} {:>15}'.format('query', 'segments (ms)', 'database (ms)')
+        for name, query in [
+                ('total', lambda store: store.totals(first, last, station=12)),
+                ('month', lambda store: list(store.records_between(first, last))),
+                ('page', lambda store: store.page(cursors[store], 100))]:
+            print '{:>10} {:>15.1f} {:>15.1f}'.format(name, best(lambda: query(segments)) * 1e3,
+                                                     best(lambda: query(database)) * 1e3)
+        assert segments.totals(first, last, 12) == database.totals(first, last, 12), 'stores disagree'
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time a full shift register refresh (gpio_pins.set_output) at 1, 8 and 64 boards.
+
+The outputs are written through the fake pigpio and spidev modules in this
+directory, so no hardware is needed. Three ways of sending the frame are
+compared:
+
+    gpio        bit by bit with gp_write (setShiftRegister)
+    wave        one pigpio waveform (shift_register.WaveOutput)
+    spi         one spidev transfer (shift_register.SpiOutput)
+
+For each the number of calls to pigpiod/spidev, the simulated time those
+calls take on a Pi (see CALL_LATENCY in the fakes) and the Python time spent
+here are reported. The latched outputs are checked against the frame.
+
+Run from the SIP directory:
+    python benchmarks/output_refresh.py [-l LATENCY_US]
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import i18n
+
+import argparse
+import random
+import time
+
+import gv
+import gpio_pins
+import shift_register
+
+import fake_pigpio
+import fake_spidev
+
+BOARDS = [1, 8, 64]
+DAT, CLK, LAT, NOE = 27, 4, 22, 17  # Broadcom numbers of header pins 13, 7, 15 and 11.
+
+
+def refresh(nbrd, method):
+    """
+    Write a random frame with set_output() and return (calls, simulated seconds, python seconds).
+    """
+    nst = nbrd * 8
+    gv.sd['nbrd'] = nbrd
+    gv.sd['nst'] = nst
+    gv.sd['alr'] = 0
+    gv.stations.resize(nst)
+    frame = [random.randint(0, 1) for i in range(nst)]
+    for sid, value in enumerate(frame):
+        gv.srvals[sid] = value
+
+    pi = fake_pigpio.pi()
+    register = pi.attach_shift_register(DAT, CLK, LAT)
+    spi = None
+    gpio_pins.gp_write = pi.write
+    gpio_pins.pin_sr_dat, gpio_pins.pin_sr_clk, gpio_pins.pin_sr_lat, gpio_pins.pin_sr_noe = DAT, CLK, LAT, NOE
+    if method == 'wave':
+        gpio_pins.sr_output = shift_register.WaveOutput(fake_pigpio, pi, DAT, CLK, LAT)
+    elif method == 'spi':
+        spi = shift_register.open_spi(spidev=fake_spidev)
+        spi.calls = 0
+        gpio_pins.sr_output = shift_register.SpiOutput(spi)
+    else:
+        gpio_pins.sr_output = None
+    gpio_pins._committed = None  # Force the write.
+
+    began = time.time()
+    gpio_pins.set_output()
+    python = time.time() - began
+
+    calls = pi.calls
+    simulated = pi.elapsed
+    if spi is not None:
+        calls += spi.calls
+        simulated += spi.elapsed
+        latched = spi.frame(nst)
+    else:
+        latched = register.frame(nst)
+    assert latched == frame, '{} output does not match the frame'.format(method)
+    return calls, simulated, python
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time a full shift register refresh at 1, 8 and 64 boards.')
+    parser.add_argument('-l', '--latency', type=float, default=fake_pigpio.CALL_LATENCY * 1e6,
+                        help='simulated round trip to pigpiod in microseconds')
+    args = parser.parse_args()
+    fake_pigpio.CALL_LATENCY = args.latency / 1e6
+
+    print '{:>7} {:>9} {:>7} {:>7} {:>15} {:>12}'.format(
+        'boards', 'stations', 'method', 'calls', 'simulated (ms)', 'python (ms)')
+    for nbrd in BOARDS:
+        for method in ['gpio', 'wave', 'spi']:
+            calls, simulated, python = refresh(nbrd, method)
+            print '{:>7} {:>9} {:>7} {:>7} {:>15.2f} {:>12.2f}'.format(
+                nbrd, nbrd * 8, method, calls, simulated * 1e3, python * 1e3)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time from starting sip.py to the first served request.
+
+SIP is started from a temporary copy of this directory (sharing its .git)
+with a free HTTP port, and the home page is requested every few
+milliseconds until it answers. Each start is timed with the version cache
+(data/version.json, see version.py) in place and without it, when gv.py
+has to run git.
+
+Run from the SIP directory:
+    python benchmarks/startup.py [-n STARTS]
+"""
+
+import os
+import sys
+
+import argparse
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import urllib2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TIMEOUT = 120  # seconds to wait for the first response
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def copy_tree():
+    """Return a temporary copy of SIP with its own data directory, and its HTTP port."""
+    directory = tempfile.mkdtemp()
+    root = os.path.join(directory, 'SIP')
+    shutil.copytree(ROOT, root, ignore=shutil.ignore_patterns('.git', '*.pyc', 'data', 'sessions'))
+    os.symlink(os.path.join(ROOT, '.git'), os.path.join(root, '.git'))
+    os.mkdir(os.path.join(root, 'data'))
+    port = free_port()
+    with open(os.path.join(root, 'data', 'sd.json'), 'w') as f:
+        f.write('{"htp": %d, "ipas": 1}' % port)
+    return root, port
+
+
+def start(root, port):
+    """Start sip.py and return the seconds until it answers a request."""
+    with open(os.devnull, 'w') as devnull:
+        began = time.time()
+        process = subprocess.Popen([sys.executable, 'sip.py'], cwd=root, stdout=devnull, stderr=subprocess.STDOUT)
+        try:
+            while True:
+                if process.poll() is not None:
+                    raise RuntimeError('sip.py exited with status {}'.format(process.returncode))
+                if time.time() - began > TIMEOUT:
+                    raise RuntimeError('no response in {} seconds'.format(TIMEOUT))
+                try:
+                    urllib2.urlopen('http://127.0.0.1:{}/'.format(port), timeout=5).read()
+                    break
+                except urllib2.HTTPError:
+                    break  # Served, if not with 200.
+                except (urllib2.URLError, socket.error):
+                    time.sleep(0.005)
+            return time.time() - began
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time from starting sip.py to the first served request.')
+    parser.add_argument('-n', '--starts', type=int, default=5, help='starts per case')
+    args = parser.parse_args()
+
+    root, port = copy_tree()
+    cache = os.path.join(root, 'data', 'version.json')
+    try:
+        start(root, port)  # Warm the file cache and create the data files.
+        print '{:>14} {:>10} {:>10}'.format('version', 'min (ms)', 'max (ms)')
+        for case in ['cached', 'git']:
+            times = []
+            for i in range(args.starts):
+                if case == 'git' and os.path.exists(cache):
+                    os.remove(cache)
+                times.append(start(root, port))
+            print '{:>14} {:>10.0f} {:>10.0f}'.format(case, min(times) * 1e3, max(times) * 1e3)
+    finally:
+        shutil.rmtree(os.path.dirname(root))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time the timing loop in sip.py at 1, 8 and 64 boards.
+
+The loop runs against a simulated clock that steps one second at a time while
+a program keeps four stations on the first board running, so the cost per
+second reflects the number of active stations and not the number of
+configured ones. Two figures are reported for each size:
+
+    idle tick   a second with nothing to switch (display update only)
+    full pass   a second on which the whole schedule is re-evaluated
+
+Run from the SIP directory:
+    python benchmarks/tick_time.py [-s SECONDS]
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import i18n
+
+import argparse
+import calendar
+import time
+
+import gv
+import helpers
+import program_index
+import scheduler
+import sip
+
+BOARDS = [1, 8, 64]
+START = calendar.timegm(time.strptime('2024-06-03', '%Y-%m-%d'))
+
+
+class TickClock(scheduler.VirtualClock):
+    """
+    Virtual clock that stops on every second, as the real clock does.
+    With full=True every second is reported as a wake up, forcing a full pass.
+    """
+
+    skip_idle_seconds = False
+
+    def __init__(self, start, end, full):
+        scheduler.VirtualClock.__init__(self, start, end)
+        self.full = full
+        self.ticks = 0
+
+    def wait(self, timeout):
+        scheduler.VirtualClock.wait(self, timeout)
+        self.ticks += 1
+        return self.full
+
+
+def set_boards(nbrd):
+    gv.sd['nbrd'] = nbrd
+    gv.sd['nst'] = nbrd * 8
+    for key, default in [('mo', 0), ('ir', 0), ('iw', 0), ('show', 255)]:
+        gv.sd[key] = (gv.sd[key] + [default] * nbrd)[:nbrd]
+    gv.snames = (gv.snames + ['S{:0>2d}'.format(i + 1) for i in range(len(gv.snames), nbrd * 8)])[:nbrd * 8]
+    gv.stations.resize(nbrd * 8)
+
+
+def run(nbrd, seconds, full):
+    """
+    Return the time in microseconds per second of simulated time.
+    """
+    set_boards(nbrd)
+    # Four stations on the first board, 30 minutes each, every day at midnight.
+    gv.pd = [[1, 127, 0, 0, 1, 1440, 1800, 15] + [0] * (nbrd - 1)]
+    program_index.invalidate()
+    gv.use_gpio_pins = False
+    gv.sd.update({'en': 1, 'mm': 0, 'seq': 0, 'mas': 0, 'lg': 0, 'urs': 0, 'rd': 0, 'rdst': 0, 'idd': 0, 'wl': 100})
+    helpers.stop_stations()
+
+    first = START + 60  # One minute in, all four stations are running.
+    scheduler.clock = TickClock(START, first, False)  # Start the program.
+    scheduler.reset()
+    try:
+        sip.timing_loop()
+    except scheduler.SimulationEnd:
+        pass
+
+    assert gv.stations.count_on() == 4, 'program did not start'
+    clock = TickClock(first, first + seconds, full)
+    scheduler.clock = clock
+    began = time.time()
+    try:
+        sip.timing_loop()
+    except scheduler.SimulationEnd:
+        pass
+    finally:
+        scheduler.clock = scheduler.RealClock()
+    return (time.time() - began) * 1e6 / clock.ticks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the SIP timing loop at 1, 8 and 64 boards.')
+    parser.add_argument('-s', '--seconds', type=int, default=1200, help='simulated seconds per measurement')
+    args = parser.parse_args()
+
+    print '{:>7} {:>9} {:>15} {:>15}'.format('boards', 'stations', 'idle tick (us)', 'full pass (us)')
+    for nbrd in BOARDS:
+        idle = run(nbrd, args.seconds, False)
+        full = run(nbrd, args.seconds, True)
+        print '{:>7} {:>9} {:>15.1f} {:>15.1f}'.format(nbrd, nbrd * 8, idle, full)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+Commands for the timing loop.
+
+Web pages and plugins ask for stations to be started or stopped through the
+functions in this module instead of writing to gv.rs, gv.ps and gv.srvals
+from their own threads. Each function queues a command and returns a
+Future. The timing loop applies queued commands at the top of its next pass
+and completes the futures when the pass is done, so a caller that waits on
+the future sees the result in gv:
+
+    control.start_station(sid, 600).wait(control.TIMEOUT)
+
+When the timing loop runs in its own process (engine.py) the commands are
+sent to it and the future completes once the engine has published the
+state that includes them.
+"""
+
+from collections import deque
+import threading
+
+import gv
+import scheduler
+
+TIMEOUT = 5  # seconds web pages wait for a command to be applied.
+
+_queue = deque()  # (name, args, future) waiting for the timing loop.
+_applied = []  # Futures of commands applied in the current pass.
+
+
+class Future(object):
+    """
+    Completion of a queued command.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the command has been applied or timeout seconds have passed.
+        Returns True if the command was applied.
+        """
+        return self._event.wait(timeout)
+
+    def result(self, timeout=None):
+        """
+        Return the result of the command, raising the exception it raised.
+        Raises RuntimeError if it was not applied within timeout seconds.
+        """
+        if not self.wait(timeout):
+            raise RuntimeError('command not applied within {} seconds'.format(timeout))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def submit(name, *args):
+    """
+    Queue command name (a function in COMMANDS) and return its Future.
+    """
+    import engine
+    if engine.role == 'web':
+        return engine.send_command(name, args)
+    future = Future()
+    _queue.append((name, args, future))
+    scheduler.wake()
+    return future
+
+
+def execute(name, args):
+    """Run a command. Called in the timing loop thread."""
+    return COMMANDS[name](*args)
+
+
+def apply_pending():
+    """
+    Run the queued commands. Called by the timing loop at the top of every pass.
+    Returns True if any were run.
+    """
+    applied = False
+    while _queue:
+        name, args, future = _queue.popleft()
+        try:
+            future._result = execute(name, args)
+        except Exception as e:
+            print 'command', name, 'failed:', e
+            future._error = e
+        _applied.append(future)
+        applied = True
+    return applied
+
+
+def complete():
+    """
+    Complete the futures of the commands applied in this pass.
+    Called by the timing loop at the end of every pass.
+    """
+    while _applied:
+        _applied.pop(0)._event.set()
+
+
+### Commands ###
+
+def _start_station(sid, duration):
+    """Manual mode: turn a station on for duration seconds, or until stopped if 0."""
+    if not gv.sd['mm']:
+        return False
+    gv.rs[sid][0] = gv.now  # set start time to current time
+    if duration > 0:  # if an optional duration time is given
+        gv.rs[sid][2] = duration
+        gv.rs[sid][1] = gv.rs[sid][0] + duration  # stop time = start time + duration
+    else:
+        gv.rs[sid][1] = float('inf')  # stop time = infinity
+    gv.rs[sid][3] = 99  # set program index
+    gv.ps[sid][1] = duration
+    gv.sd['bsy'] = 1
+    return True
+
+
+def _stop_station(sid):
+    """Manual mode: turn a station off in this pass of the timing loop."""
+    if not gv.sd['mm']:
+        return False
+    if gv.rs[sid][1]:
+        gv.rs[sid][1] = gv.now
+    return True
+
+
+def _stop_all():
+    """Stop all stations and clear the run schedule."""
+    from helpers import stop_stations
+    stop_stations()
+    return True
+
+
+def _all_off():
+    """Turn every station off, keeping the run schedule."""
+    from gpio_pins import set_output
+    gv.stations.all_off()
+    set_output()
+    return True
+
+
+def _end_manual_mode():
+    """Turn every station off and clear the run schedule, when manual mode is switched off."""
+    from gpio_pins import set_output
+    gv.stations.clear()
+    set_output()
+    return True
+
+
+def _stop_program(pnum):
+    """Stop the stations of program number pnum (1 based) if it is running."""
+    from gpio_pins import set_output
+    if pnum != gv.pon:
+        return False
+    for sid in gv.stations.scheduled():
+        if gv.ps[sid][0] == pnum:
+            gv.ps[sid] = [0, 0]
+        if gv.srvals[sid]:
+            gv.srvals[sid] = 0
+        if gv.rs[sid][3] == pnum:
+            gv.rs[sid] = [0, 0, 0, 0]
+    set_output()
+    return True
+
+
+def _run_program(pid):
+    """Run program index pid now. This overrides any running program."""
+    from helpers import plugin_adjustment, schedule_stations, stop_stations
+    p = gv.pd[pid]  # program data
+    stop_stations()
+    extra_adjustment = plugin_adjustment()
+    sid = -1
+    for b in range(gv.sd['nbrd']):  # check each station
+        for s in range(8):
+            sid += 1  # station index
+            if sid + 1 == gv.sd['mas']:  # skip if this is master valve
+                continue
+            if p[7 + b] & 1 << s:  # if this station is scheduled in this program
+                if gv.sd['idd']:
+                    duration = p[-1][sid]
+                else:
+                    duration = p[6]
+                if not gv.sd['iw'][b] & 1 << s:
+                    duration = duration * gv.sd['wl'] / 100 * extra_adjustment
+                gv.rs[sid][2] = duration
+                gv.rs[sid][3] = pid + 1  # store program number in schedule
+                gv.ps[sid][0] = pid + 1  # store program number for display
+                gv.ps[sid][1] = duration  # duration
+    schedule_stations(p[7:7 + gv.sd['nbrd']])
+    return True
+
+
+def _run_once(durations):
+    """Run each station for the duration (seconds) in durations. This overrides any running program."""
+    from helpers import log_run, report_station_completed, schedule_stations
+    if not gv.sd['en']:   # check operation status
+        return False
+    gv.rovals = durations
+    for sid in gv.stations.on_stations():  # if currently on, log result
+        gv.lrun[0] = sid
+        gv.lrun[1] = gv.rs[sid][3]
+        gv.lrun[2] = int(gv.now - gv.rs[sid][0])
+        gv.lrun[3] = gv.now     # think this is unused
+        log_run()
+        report_station_completed(sid + 1)
+    stations = [0] * gv.sd['nbrd']
+    gv.stations.clear_schedule()  # program schedule (gv.ps) and run schedule (gv.rs)
+    for sid, dur in enumerate(durations[:gv.sd['nst']]):
+        if dur:  # if this element has a value
+            gv.rs[sid][0] = gv.now
+            gv.rs[sid][2] = dur
+            gv.rs[sid][3] = 98
+            gv.ps[sid][0] = 98
+            gv.ps[sid][1] = dur
+            stations[sid / 8] += 2 ** (sid % 8)
+    schedule_stations(stations)
+    return True
+
+
+def _rain_delay(hours):
+    """Start a rain delay of hours (0 cancels it) and stop stations that do not ignore rain."""
+    from helpers import jsave, stop_onrain
+    if hours:
+        gv.sd['rd'] = hours
+        gv.sd['rdst'] = int(gv.now + hours * 3600)
+        stop_onrain()
+    else:
+        gv.sd['rd'] = 0
+        gv.sd['rdst'] = 0
+    jsave(gv.sd, 'sd')
+    return True
+
+
+COMMANDS = {
+    'start_station': _start_station,
+    'stop_station': _stop_station,
+    'stop_all': _stop_all,
+    'all_off': _all_off,
+    'end_manual_mode': _end_manual_mode,
+    'stop_program': _stop_program,
+    'run_program': _run_program,
+    'run_once': _run_once,
+    'rain_delay': _rain_delay,
+}
+
+
+def start_station(sid, duration=0):
+    """Manual mode: turn station index sid on for duration seconds (0: until stopped)."""
+    return submit('start_station', sid, duration)
+
+
+def stop_station(sid):
+    """Manual mode: turn station index sid off."""
+    return submit('stop_station', sid)
+
+
+def stop_all():
+    """Stop all stations and clear the run schedule."""
+    return submit('stop_all')
+
+
+def all_off():
+    """Turn every station off without clearing the run schedule."""
+    return submit('all_off')
+
+
+def end_manual_mode():
+    """Turn every station off and clear the run schedule, leaving manual mode."""
+    return submit('end_manual_mode')
+
+
+def stop_program(pnum):
+    """Stop the stations of program number pnum (1 based) if it is the running program."""
+    return submit('stop_program', pnum)
+
+
+def run_program(pid):
+    """Run program index pid (0 based) now, overriding any running program."""
+    return submit('run_program', pid)
+
+
+def run_once(durations):
+    """Run each station for the number of seconds in durations (one per station)."""
+    return submit('run_once', durations)
+
+
+def rain_delay(hours):
+    """Set a rain delay of hours, 0 to cancel."""
+    return submit('rain_delay', hours)
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous delivery of blinker signals to plugin receivers.
+
+Signals such as station_completed and zone_change are sent from the timing
+loop, zone_change while gv.output_srvals_lock is held. blinker calls every
+receiver in the sending thread, so a plugin that sends an SMS or makes an
+HTTP request when a zone changes delays the next valve being switched off.
+
+The timing loop sends these signals with dispatch.send(sig, ...) instead of
+sig.send(...). With the "Background signals" option (gv.sd['asig']) off
+this is the same as sig.send(). With it on, receivers marked with
+synchronous() still run in the sending thread, and the rest are queued to
+a small pool of worker threads:
+
+    @dispatch.synchronous
+    def invalidate(name, **kw):
+        ...
+    signal('station_completed').connect(invalidate)
+
+All deliveries of one signal go to the same worker, so receivers see the
+sends of a signal in order. Each worker's queue holds at most QUEUE_SIZE
+sends; when it is full OVERFLOW decides what happens:
+
+    'drop_oldest'   discard the oldest queued send (default)
+    'drop_newest'   discard the new send
+    'sync'          deliver the new send in the sending thread
+
+Sends, deliveries, drops and receiver errors are counted per signal, see
+stats() and prometheus().
+
+Every call of a receiver of a named signal, sent through dispatch or
+directly with blinker's Signal.send (which this module replaces with a
+timed copy), is also timed: receiver_stats() gives the calls, total and
+maximum time and exceptions of each receiver of each signal, so a plugin
+that eats the timing loop's time can be found (/api/signals). Calls taking
+longer than SLOW_RECEIVER seconds are counted as slow and reported on the
+console.
+"""
+
+from collections import deque
+import os
+import threading
+import time
+
+from blinker.base import Signal
+
+import gv
+
+WORKERS = 2
+QUEUE_SIZE = 100  # Sends waiting per worker.
+OVERFLOW = 'drop_oldest'
+COUNTERS = ['sent', 'queued', 'delivered', 'dropped', 'errors']
+SLOW_RECEIVER = 0.1  # seconds
+SLOW_WARNING_INTERVAL = 60  # Seconds between console warnings about the same receiver.
+
+_lock = threading.Lock()
+_workers = []
+_pid = None  # Process the workers were started in (the engine process forks).
+_counts = {}  # Signal name -> dict of COUNTERS.
+_receivers = {}  # (signal name, receiver name) -> dict of call statistics.
+
+
+def synchronous(receiver):
+    """
+    Mark receiver as needing synchronous delivery: it always runs in the
+    thread that sends the signal. Returns receiver, so it can be used as a
+    decorator.
+    """
+    getattr(receiver, 'im_func', receiver).sip_synchronous = True
+    return receiver
+
+
+def is_synchronous(receiver):
+    return getattr(receiver, 'sip_synchronous', False)
+
+
+def receiver_name(receiver):
+    """Return a readable name for a receiver: module.function or module.Class.method."""
+    func = getattr(receiver, 'im_func', receiver)
+    name = getattr(func, '__name__', None) or repr(receiver)
+    owner = getattr(receiver, 'im_self', None)
+    if owner is not None:
+        name = type(owner).__name__ + '.' + name
+    module = getattr(func, '__module__', None)
+    return module + '.' + name if module else name
+
+
+def _record(name, receiver, seconds, error):
+    key = (name, receiver_name(receiver))
+    warn = False
+    with _lock:
+        r = _receivers.get(key)
+        if r is None:
+            r = _receivers[key] = {'calls': 0, 'total': 0.0, 'max': 0.0, 'errors': 0, 'slow': 0,
+                                   'last_error': None, 'warned': 0}
+        r['calls'] += 1
+        r['total'] += seconds
+        r['max'] = max(r['max'], seconds)
+        if error is not None:
+            r['errors'] += 1
+            r['last_error'] = repr(error)
+        if seconds > SLOW_RECEIVER:
+            r['slow'] += 1
+            now = time.time()
+            if now - r['warned'] >= SLOW_WARNING_INTERVAL:
+                r['warned'] = now
+                warn = True
+    if warn:
+        print 'slow receiver: {} took {:.3f} s for signal {}'.format(key[1], seconds, name)
+
+
+def call(name, receiver, sender, kwargs):
+    """
+    Call receiver of signal name, recording the time it took.
+    Exceptions are recorded and raised.
+    """
+    started = time.time()
+    error = None
+    try:
+        return receiver(sender, **kwargs)
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _record(name, receiver, time.time() - started, error)
+
+
+_blinker_send = Signal.send
+
+
+def _timed_send(self, *sender, **kwargs):
+    """
+    blinker's Signal.send, timing each receiver of named signals with call().
+    """
+    name = getattr(self, 'name', None)
+    if name is None:
+        return _blinker_send(self, *sender, **kwargs)
+    if len(sender) == 0:
+        sender = None
+    elif len(sender) > 1:
+        raise TypeError('send() accepts only one positional argument, '
+                        '%s given' % len(sender))
+    else:
+        sender = sender[0]
+    if not self.receivers:
+        return []
+    return [(receiver, call(name, receiver, sender, kwargs))
+            for receiver in self.receivers_for(sender)]
+
+Signal.send = _timed_send
+
+
+def _count(name, counter, n=1):
+    with _lock:
+        counts = _counts.get(name)
+        if counts is None:
+            counts = _counts[name] = dict((c, 0) for c in COUNTERS)
+        counts[counter] += n
+
+
+class _Worker(object):
+    """
+    Thread delivering queued sends in order.
+    """
+
+    def __init__(self, index):
+        self.queue = deque()
+        self.ready = threading.Condition(threading.Lock())
+        self.thread = threading.Thread(target=self.run, name='signal-dispatch-{}'.format(index))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, item):
+        """
+        Queue item. Returns False if the queue is full and OVERFLOW is 'sync'.
+        """
+        with self.ready:
+            if len(self.queue) >= QUEUE_SIZE:
+                if OVERFLOW == 'sync':
+                    return False
+                if OVERFLOW == 'drop_newest':
+                    _count(item[0], 'dropped')
+                    return True
+                _count(self.queue.popleft()[0], 'dropped')
+            self.queue.append(item)
+            self.ready.notify()
+        _count(item[0], 'queued')
+        return True
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.queue:
+                    self.ready.wait()
+                item = self.queue.popleft()
+            _deliver(*item)
+
+
+def _deliver(name, receivers, sender, kwargs):
+    for receiver in receivers:
+        try:
+            call(name, receiver, sender, kwargs)
+        except Exception as e:
+            _count(name, 'errors')
+            print 'signal', name, 'receiver', receiver_name(receiver), 'failed:', e
+    _count(name, 'delivered')
+
+
+def _worker(name):
+    global _workers, _pid
+    with _lock:
+        if _pid != os.getpid():  # First use, or threads lost in a fork.
+            _workers = [_Worker(i) for i in range(WORKERS)]
+            _pid = os.getpid()
+        return _workers[hash(name) % WORKERS]
+
+
+def send(sig, *sender, **kwargs):
+    """
+    Send blinker signal sig on behalf of sender, like sig.send(*sender, **kwargs).
+    Returns a list of (receiver, return value) of the receivers that ran in this thread.
+    """
+    if not gv.sd['asig']:
+        return sig.send(*sender, **kwargs)
+    sender = sender[0] if sender else None
+    _count(sig.name, 'sent')
+    if not sig.receivers:
+        return []
+    result = []
+    queued = []
+    for receiver in sig.receivers_for(sender):
+        if is_synchronous(receiver):
+            result.append((receiver, call(sig.name, receiver, sender, kwargs)))
+        else:
+            queued.append(receiver)
+    if queued:
+        item = (sig.name, queued, sender, kwargs)
+        if not _worker(sig.name).put(item):  # Full, deliver here.
+            _deliver(*item)
+    return result
+
+
+def pending():
+    """Return the number of sends waiting to be delivered."""
+    return sum(len(w.queue) for w in _workers) if _pid == os.getpid() else 0
+
+
+def stats():
+    """Return the counters of every signal sent, by signal name."""
+    with _lock:
+        return dict((name, dict(counts)) for name, counts in _counts.items())
+
+
+def prometheus():
+    """
+    Return the counters in Prometheus text exposition format.
+    """
+    lines = []
+    counts = stats()
+    for counter in COUNTERS:
+        metric = 'sip_signal_{}_total'.format(counter)
+        lines.append('# TYPE {} counter'.format(metric))
+        for name in sorted(counts):
+            lines.append('{}{{signal="{}"}} {}'.format(metric, name, counts[name][counter]))
+    lines.append('# TYPE sip_signal_pending gauge')
+    lines.append('sip_signal_pending {}'.format(pending()))
+    return '\n'.join(lines) + '\n'
+
+
+def receiver_stats():
+    """
+    Return the call statistics of every receiver that has been called, slowest
+    (by total time) first, with the slow receiver threshold, as a dictionary.
+    Times are in seconds.
+    """
+    with _lock:
+        items = [(key, dict(r)) for key, r in _receivers.items()]
+    receivers = []
+    for (name, receiver), r in items:
+        del r['warned']
+        r['signal'] = name
+        r['receiver'] = receiver
+        r['mean'] = r['total'] / r['calls']
+        receivers.append(r)
+    receivers.sort(key=lambda r: r['total'], reverse=True)
+    return {'slow_threshold': SLOW_RECEIVER, 'receivers': receivers}
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Run the timing loop and GPIO output in a separate process.
+
+By default the timing loop runs in a thread of the web server process, where
+it competes for the interpreter lock with the web server threads and plugins.
+With the "Timing process" option (gv.sd['eng']) set, sip_begin() forks an
+engine process that runs the timing loop and drives the outputs, while the
+original process serves the web pages.
+
+Engine -> web: after every pass of the timing loop the engine publishes the
+station state (gv.srvals, gv.rs, gv.ps), gv.now, gv.pon, gv.lrun and the
+settings the loop changes (bsy, rd, rdst, rs) to a shared memory segment.
+The web process copies it into its own gv at the start of each request
+(WebPage.__init__) and once a second.
+
+Web -> engine: changes the web process makes to gv.sd, gv.pd, gv.snames or
+the station state are sent over a queue when scheduler.wake() or
+set_output() is called, and once a second for changes made by plugins.
+Only what changed is sent: the settings that differ and, for the station
+state, the individual changes recorded in its journal (StationState.journal),
+never a copy of the whole state, which would undo the stations the engine
+started or stopped meanwhile. Commands from control.py are sent over the
+same queue. The engine applies them at the top of the next pass.
+
+Signals sent by the timing loop (station_completed, zone_change, ...) are
+delivered to receivers in the engine process, which are the receivers
+plugins connected before the fork.
+"""
+
+from collections import deque
+import copy
+from ctypes import c_double, c_long, c_ubyte, c_ulong
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray, RawValue
+import threading
+import time
+
+import control
+import gv
+import program_index
+import scheduler
+import snapshot
+from station_state import MAX_BOARDS, SCHEDULE, DISPLAY, COLUMN_TYPES, adopt_replaced_views
+
+ENGINE_SETTINGS = ['bsy', 'rd', 'rdst', 'rs']  # Settings the timing loop changes.
+SYNC_INTERVAL = 1.0  # seconds between checks for changes made by plugins.
+
+role = None  # None: timing loop runs in a thread, 'engine' or 'web' when split into processes.
+_shared = None
+_commands = None
+_process = None
+_pending = deque()  # Engine: messages received and not yet applied.
+_applied_seq = 0  # Engine: number of the last message applied.
+
+_send_lock = threading.RLock()
+_sent = {}  # Web: copies of what the engine last received or published.
+_sent_seq = 0  # Web: number of the last message sent.
+_seen_version = -1  # Web: version of the shared state last loaded.
+_futures = []  # Web: (message number, control.Future) of commands not yet applied by the engine.
+_sync_now = threading.Event()
+
+
+class SharedState(object):
+    """
+    Station state and timing values in shared memory, written by the engine.
+    """
+
+    def __init__(self, size=MAX_BOARDS * 8):
+        ctypes = {'d': c_double, 'l': c_long}
+        self.lock = multiprocessing.Lock()
+        self.version = RawValue(c_ulong, 0)
+        self.applied_seq = RawValue(c_ulong, 0)  # Number of the last web message applied.
+        self.nst = RawValue(c_long, 0)
+        self.now = RawValue(c_long, 0)
+        self.pon = RawValue(c_long, 0)  # 0 means None
+        self.lrun = RawArray(c_double, 4)
+        self.settings = RawArray(c_double, len(ENGINE_SETTINGS))
+        self.sbits = RawArray(c_ubyte, size / 8)
+        self.columns = dict((name, RawArray(ctypes[COLUMN_TYPES[name]], size))
+                            for name in SCHEDULE + DISPLAY)
+
+    def publish(self, applied_seq):
+        state = gv.stations
+        nst = state.nst
+        with self.lock:
+            self.nst.value = nst
+            self.now.value = gv.now
+            self.pon.value = gv.pon or 0
+            self.lrun[:] = [float(v) for v in gv.lrun]
+            self.settings[:] = [float(gv.sd[k]) for k in ENGINE_SETTINGS]
+            for b in range((nst + 7) / 8):
+                self.sbits[b] = state.board_bits(b)
+            for name in SCHEDULE + DISPLAY:
+                self.columns[name][:nst] = getattr(state, name)
+            self.applied_seq.value = applied_seq
+            self.version.value += 1
+
+    def read(self):
+        """
+        Return a dictionary of the published values.
+        """
+        with self.lock:
+            nst = self.nst.value
+            on_mask = 0
+            for b in range((nst + 7) / 8):
+                on_mask |= self.sbits[b] << (b * 8)
+            return {
+                'version': self.version.value,
+                'applied_seq': self.applied_seq.value,
+                'nst': nst,
+                'now': self.now.value,
+                'pon': self.pon.value or None,
+                'lrun': [int(v) for v in self.lrun],
+                'settings': dict(zip(ENGINE_SETTINGS, [int(v) for v in self.settings])),
+                'on_mask': on_mask,
+                'columns': dict((name, self.columns[name][:nst]) for name in SCHEDULE + DISPLAY),
+            }
+
+
+def start():
+    """
+    Fork the engine process. Called by sip_begin() instead of starting the timing loop thread.
+    """
+    global role, _shared, _commands, _process
+    _shared = SharedState()
+    _commands = multiprocessing.Queue()
+    _shared.publish(0)
+    _process = multiprocessing.Process(target=_engine_main, name='sip-engine')
+    _process.daemon = True  # Stopped when the web process exits.
+    _process.start()
+
+    role = 'web'
+    gv.use_gpio_pins = False  # Outputs belong to the engine process.
+    scheduler.engine_link = sync
+    _remember_sent()
+    gv.stations.journal = []  # Record station changes made here to send them.
+    t = threading.Thread(target=_sync_loop, name='engine-sync')
+    t.daemon = True
+    t.start()
+
+
+### Engine process ###
+
+def _engine_main():
+    global role
+    role = 'engine'
+    import sip
+    from gpio_pins import set_output
+    t = threading.Thread(target=_receive_loop, name='engine-commands')
+    t.daemon = True
+    t.start()
+    if gv.use_gpio_pins:
+        set_output()
+    sip.timing_loop()
+
+
+def _receive_loop():
+    while True:
+        msg = _commands.get()
+        _pending.append(msg)
+        scheduler.wake()
+
+
+def apply_pending():
+    """
+    Apply the changes and run the commands received from the web process.
+    Called by the timing loop at the top of every pass; does nothing unless
+    this is the engine process. Returns True if anything was applied.
+    """
+    global _applied_seq
+    if role != 'engine' or not _pending:
+        return False
+    while _pending:
+        msg = _pending.popleft()
+        if 'sd' in msg:
+            gv.sd.update(msg['sd'])
+            if gv.sd['nst'] != gv.stations.nst:
+                gv.stations.resize(gv.sd['nst'])
+        if 'pd' in msg:
+            gv.pd = msg['pd']
+            program_index.invalidate()
+        if 'snames' in msg:
+            gv.snames = msg['snames']
+        if 'stations' in msg:
+            gv.stations.replay(msg['stations'])
+        for name, args in msg.get('commands', []):
+            try:
+                control.execute(name, args)
+            except Exception as e:
+                print 'command', name, 'failed:', e
+        _applied_seq = msg['seq']
+    return True
+
+
+def publish():
+    """
+    Publish the state to the web process. Called by the timing loop after
+    every pass; does nothing unless this is the engine process.
+    """
+    if role == 'engine':
+        _shared.publish(_applied_seq)
+
+
+### Web process ###
+
+def _remember_sent():
+    _sent['sd'] = copy.deepcopy(gv.sd)
+    _sent['pd'] = copy.deepcopy(gv.pd)
+    _sent['snames'] = list(gv.snames)
+
+
+def sync():
+    """
+    Send the changes made in the web process since the last call to the engine.
+    """
+    global _sent_seq
+    with _send_lock:
+        adopt_replaced_views(gv)  # So that values of replaced lists are recorded in the journal.
+        msg = {}
+        changed = dict((k, v) for k, v in gv.sd.items() if _sent['sd'].get(k) != v)
+        if changed:
+            msg['sd'] = changed  # Only changed settings, so the engine's own are not overwritten.
+        if gv.pd != _sent['pd']:
+            msg['pd'] = gv.pd
+        if gv.snames != _sent['snames']:
+            msg['snames'] = list(gv.snames)
+        changes = gv.stations.take_journal()
+        if changes:
+            msg['stations'] = changes
+        if not msg:
+            return
+        _sent_seq += 1
+        msg['seq'] = _sent_seq
+        _commands.put(msg)
+        _remember_sent()
+
+
+def send_command(name, args):
+    """
+    Send a control command to the engine and return a control.Future that
+    completes once the engine has published the state after applying it.
+    """
+    global _sent_seq
+    future = control.Future()
+    with _send_lock:
+        sync()  # Changes made before the command are applied first.
+        _sent_seq += 1
+        _commands.put({'seq': _sent_seq, 'commands': [(name, args)]})
+        _futures.append((_sent_seq, future))
+    _sync_now.set()
+    return future
+
+
+def _complete_futures():
+    applied = _shared.applied_seq.value
+    with _send_lock:
+        while _futures and _futures[0][0] <= applied:
+            _futures.pop(0)[1].set_result(None)
+
+
+def refresh():
+    """
+    Load the state published by the engine into gv. Called at the start of each web request.
+    Station state is only replaced once the engine has applied every change
+    sent from this process, so local changes not yet sent are kept.
+    """
+    global _seen_version
+    if role != 'web' or _shared.version.value == _seen_version:
+        return
+    with _send_lock:
+        values = _shared.read()
+        _seen_version = values['version']
+        gv.now = values['now']
+        gv.nowt = time.gmtime(gv.now)
+        gv.pon = values['pon']
+        gv.lrun[:] = values['lrun']
+        if values['applied_seq'] >= _sent_seq and not gv.stations.journal:  # Engine has caught up.
+            gv.sd.update(values['settings'])
+            _sent['sd'].update(values['settings'])
+            if values['nst'] == gv.stations.nst:
+                gv.stations.load(values['on_mask'], values['columns'])
+        snapshot.publish()
+
+
+def _sync_loop():
+    while True:
+        _sync_now.wait(0.02 if _futures else SYNC_INTERVAL)  # Poll quickly while commands are outstanding.
+        _sync_now.clear()
+        try:
+            sync()
+            refresh()
+            _complete_futures()
+        except Exception as e:
+            print 'engine sync failed:', e
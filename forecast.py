@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Forecast of the station runs the current programs will produce.
+
+The programs in gv.pd are expanded with the same rules the timing loop in
+sip.py applies when a program fires: program day and time matching, water
+level and plugin adjustments (unless a station ignores them), individual
+station durations, sequential accumulation with the station delay or
+concurrent restarts, master on/off adjustments and rain delay.
+
+Each program's fire times and station durations are worked out once for the
+whole period and then merged in time order, rather than stepping minute by
+minute. The result is cached until programs, options or the run schedule
+change.
+
+Times are in the same frame as gv.now (local time as a UTC timestamp).
+"""
+
+import heapq
+import itertools
+import threading
+
+from blinker import signal
+
+import dispatch
+import gv
+import program_index
+from helpers import plugin_adjustment
+
+MAX_DAYS = 365
+
+_lock = threading.Lock()
+_generation = 0
+_cache_key = None
+_cache = None
+
+
+@dispatch.synchronous
+def invalidate(*args, **kw):
+    """
+    Discard the cached forecast. Connected to the signals sent when
+    programs, options, stations or the run schedule change.
+    """
+    global _generation
+    _generation += 1
+
+for name in ['program_change', 'program_deleted', 'program_toggled',
+             'option_change', 'value_change', 'station_names',
+             'stations_scheduled', 'station_completed', 'rain_changed']:
+    signal(name).connect(invalidate)
+
+
+def station_durations(prog, extra_adjustment):
+    """
+    Return a list of (station index, duration) for the stations a program runs.
+    Durations are adjusted as in the timing loop.
+    """
+    result = []
+    for b in range(len(prog[7:7 + gv.sd['nbrd']])):
+        for s in range(8):
+            sid = b * 8 + s  # station index
+            if gv.sd['mas'] == sid + 1:
+                continue  # skip if this is master station
+            if not prog[7 + b] & 1 << s:
+                continue  # station not in program
+            if gv.sd['iw'][b] & 1 << s:
+                if gv.sd['idd'] == 1:
+                    duration = prog[-1][sid]
+                else:
+                    duration = prog[6]
+            else:
+                duration_adj = (float(gv.sd['wl']) / 100) * extra_adjustment
+                if gv.sd['idd'] == 1:
+                    duration = prog[-1][sid] * duration_adj
+                else:
+                    duration = prog[6] * duration_adj
+                duration = int(round(duration))
+            if duration:
+                result.append((sid, duration))
+    return result
+
+
+def fire_times(prog, first_day, days):
+    """
+    Return the sorted start times of a program over days starting at first_day.
+    """
+    minutes = program_index.fire_minutes(prog)
+    if not minutes:
+        return []
+    if (prog[1] >= 128) and (prog[2] > 1):  # Interval program
+        run_days = range(first_day + ((prog[1] - 128) - first_day) % prog[2], first_day + days, prog[2])
+    else:
+        run_days = [d for d in range(first_day, first_day + days) if program_index.day_match(prog, d)]
+    return [d * 86400 + m * 60 for d in run_days for m in minutes]
+
+
+def ignores_rain(sid):
+    return gv.sd['ir'][sid / 8] & 1 << (sid % 8)
+
+
+def master_runs(runs):
+    """
+    Return the merged [start, stop] periods the master station is on for a list of station runs.
+    """
+    periods = []
+    for sid, pid, start, stop in sorted(runs, key=lambda r: r[2]):
+        if not gv.sd['mo'][sid / 8] & 1 << (sid % 8):
+            continue
+        on, off = start + gv.sd['mton'], stop + gv.sd['mtoff']
+        if periods and on <= periods[-1][1]:
+            periods[-1][1] = max(periods[-1][1], off)
+        else:
+            periods.append([on, off])
+    return periods
+
+
+def busy_end(sid, stop):
+    """
+    Return when the timing loop stops being busy with a run of station sid
+    ending at stop: when the master turns off if the station uses it.
+    """
+    if gv.sd['mas'] and gv.sd['mo'][sid / 8] & 1 << (sid % 8):
+        return max(stop, stop + gv.sd['mtoff'])
+    return stop
+
+
+def expand(now, days):
+    """
+    Return a list of [station index, program number, start, stop] for
+    every run expected between now and the end of the period.
+    Includes runs already in the run schedule (gv.rs).
+    """
+    runs = []
+    busy_until = None  # Sequential mode: end of the last scheduled run or of the master.
+    active = {}  # Concurrent mode: station index -> run currently scheduled.
+    for sid, r in enumerate(gv.rs):
+        if not r[1] or r[1] <= now:
+            continue
+        if gv.sd['mas'] == sid + 1:
+            end = r[1]  # The master has already been scheduled to turn off.
+        else:
+            run = [sid, r[3], r[0], r[1]]
+            runs.append(run)
+            active[sid] = run
+            end = busy_end(sid, r[1])
+        if busy_until is None or end > busy_until:
+            busy_until = end
+
+    if not gv.sd['en'] or gv.sd['mm']:  # Programs do not run.
+        return runs
+
+    start = (now / 60 + 1) * 60  # Programs for the current minute have already been checked.
+    end = now + days * 86400
+    first_day = start / 86400
+    extra_adjustment = plugin_adjustment()
+    durations = {}
+    fires = []
+    for i, p in enumerate(gv.pd):
+        times = [t for t in fire_times(p, first_day, days + 1) if start <= t < end]
+        if times:
+            durations[i] = station_durations(p, extra_adjustment)
+            fires.append([(t, i) for t in times])
+
+    group_time = None
+    group = []
+    for t, i in itertools.chain(heapq.merge(*fires), [(None, None)]):  # Sentinel flushes the last group.
+        if t == group_time:
+            group.append(i)
+            continue
+        if group:
+            rain = gv.sd['rd'] and group_time < gv.sd['rdst']
+            if gv.sd['seq']:
+                if busy_until is None or group_time > busy_until:
+                    busy_until = _schedule_sequential(runs, group, durations, group_time, rain)
+                elif busy_until < group_time + 60:  # The check skipped while busy runs when the sequence ends.
+                    busy_until = _schedule_sequential(runs, group, durations, busy_until, rain)
+            else:
+                _schedule_concurrent(runs, active, group, durations, group_time, rain)
+        group_time = t
+        group = [i]
+    return [r for r in runs if r[3] > r[2]]
+
+
+def _schedule_sequential(runs, group, durations, t, rain):
+    """
+    Programs firing in the same minute share one sequence, as repeated
+    calls to schedule_stations do. Returns the end of the sequence,
+    including the master off delay (see busy_end()).
+    """
+    scheduled = {}
+    for i in group:
+        for sid, duration in durations[i]:
+            scheduled[sid] = (duration, i + 1)
+    accumulate_time = t
+    end = None
+    for sid in sorted(scheduled):
+        if rain and not ignores_rain(sid):
+            continue
+        duration, pid = scheduled[sid]
+        runs.append([sid, pid, accumulate_time, accumulate_time + duration])
+        accumulate_time += duration
+        end = max(end, busy_end(sid, accumulate_time))
+        accumulate_time += gv.sd['sdt']
+    return end
+
+
+def _schedule_concurrent(runs, active, group, durations, t, rain):
+    """
+    Each station restarts at the program start, cutting short any run in progress.
+    """
+    for i in group:
+        for sid, duration in durations[i]:
+            if rain and not ignores_rain(sid):
+                continue
+            current = active.get(sid)
+            if current is not None and current[2] <= t < current[3]:
+                current[3] = t
+            run = [sid, i + 1, t, t + duration]
+            runs.append(run)
+            active[sid] = run
+
+
+def _run_dict(sid, pid, start, stop):
+    if stop == float('inf'):  # Manual mode station with no set duration.
+        return {'station': sid, 'program': pid, 'start': start, 'stop': None, 'duration': None}
+    return {'station': sid, 'program': pid, 'start': start, 'stop': stop, 'duration': stop - start}
+
+
+def forecast(days=7, now=None):
+    """
+    Return the forecast for the next days (at most MAX_DAYS) as a dictionary.
+    """
+    global _cache_key, _cache
+    if now is None:
+        now = gv.now
+    days = max(1, min(int(days), MAX_DAYS))
+    key = (_generation, now / 60, days, plugin_adjustment())
+    with _lock:
+        if key == _cache_key:
+            return _cache
+        runs = sorted(expand(now, days), key=lambda r: (r[2], r[0]))
+        result = {
+            'devt': now,
+            'days': days,
+            'rain_sensed': gv.sd['urs'] and gv.sd['rs'],
+            'runs': [_run_dict(sid, pid, start, stop) for sid, pid, start, stop in runs],
+            'master': [{'station': gv.sd['mas'] - 1, 'start': on, 'stop': None if off == float('inf') else off}
+                       for on, off in (master_runs(runs) if gv.sd['mas'] else [])]
+        }
+        _cache_key = key
+        _cache = result
+        return result
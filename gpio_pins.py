@@ -9,20 +9,34 @@ valves.
 This module provides a common interface to configure, control, and remove
 access to the hardware pins attached to the platform.
 
-There are five functions defined in this module that abstract the platform
+There are six functions defined in this module that abstract the platform
 differences and allow usage of the gpio hardware independent of the platform.
     gp_config_output(pin):
     gp_config_input(pin, pullup='off')
     gp_write(pin,val)
     gp_read(pin)
+    gp_watch_input(pin, callback)
     gp_cleanup(header_pins = None)
 
+gp_watch_input calls callback(level) from a library thread on every edge of
+an input pin and returns True, or returns False where edge detection is not
+available so the caller can fall back to polling. DebouncedInput builds on it.
+
+With the environment variable SIP_GPIO=recording the calls are recorded
+instead of reaching the hardware (gv.platform 'rec', see gpio_recorder.py).
+
 Pins are identified by the number of the hardware connector pin number.
 """
 
 import os
 import subprocess
+import threading
+import time
+import dispatch
 import gv
+import engine
+import scheduler
+import shift_register
 
 ###
 # Fall through logic to configure platform specific runtime requirements.
@@ -84,6 +98,10 @@ except ImportError:
             gv.platform = ''  # If no platform, allows program to still run.
             gv.pin_map = [i for i in range(27)]  # Simulate 26 pins all mapped.
 
+if os.environ.get('SIP_GPIO') == 'recording':  # Recording backend for tests and benchmarks, see gpio_recorder.py.
+    gv.platform = 'rec'
+    gv.pin_map = [i for i in range(27)]  # Simulate 26 pins all mapped.
+
 ###
 # gv.platform and gv.pin_map are now defined correctly for the runtime of this module.
 ###
@@ -145,6 +163,13 @@ if gv.platform == 'pi' and gv.use_pigpio:  # pigpio support for pi only.
         def gp_read(pin):
             return pi.read(pin)
 
+        def gp_watch_input(pin, callback):
+            def edge(gpio, level, tick):
+                if level != pigpio.TIMEOUT:  # Ignore watchdog reports.
+                    callback(level)
+            pi.callback(pin, pigpio.EITHER_EDGE, edge)
+            return True
+
         def gp_cleanup(header_pins = None):  # Untested.
             """
             Input: header_pins is list of integers corresponding
@@ -181,6 +206,14 @@ if gv.platform == 'pi' and gv.use_pigpio:  # pigpio support for pi only.
         def gp_read(pin):
             return GPIO.input(pin)
 
+        def gp_watch_input(pin, callback):
+            try:
+                GPIO.add_event_detect(pin, GPIO.BOTH, callback=lambda channel: callback(GPIO.input(channel)))
+            except (RuntimeError, AttributeError) as e:  # Edge detection not supported or already in use.
+                print 'gpio_pins: no edge detection on pin', pin, e
+                return False
+            return True
+
         def gp_cleanup(header_pins = None):
             """
             Input: header_pins is list of integers corresponding
@@ -218,6 +251,14 @@ elif gv.platform == 'pi' or gv.platform == 'bo':
     def gp_read(pin):
         return GPIO.input(pin)
 
+    def gp_watch_input(pin, callback):
+        try:
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=lambda channel: callback(GPIO.input(channel)))
+        except (RuntimeError, AttributeError) as e:  # Edge detection not supported or already in use.
+            print 'gpio_pins: no edge detection on pin', pin, e
+            return False
+        return True
+
     def gp_cleanup(header_pins = None):
         """
         Input: header_pins is list of integers corresponding
@@ -240,8 +281,36 @@ elif gv.platform == 'nt' or gv.platform == '':  # Use simulated IO.
     def gp_write(pin,val):
         pass
 
+    sim_levels = {}  # Simulated input levels by pin, 1 (pulled up) if not set.
+    sim_callbacks = {}  # Edge callbacks by pin.
+
     def gp_read(pin):
-        return 1  # Dummy return for simulation.
+        return sim_levels.get(pin, 1)
+
+    def gp_watch_input(pin, callback):
+        sim_callbacks.setdefault(pin, []).append(callback)
+        return True
+
+    def sim_edge(pin, level):
+        """
+        Simulate an edge: set the level of an input pin and call its edge callbacks.
+        """
+        if sim_levels.get(pin, 1) == level:
+            return
+        sim_levels[pin] = level
+        for callback in sim_callbacks.get(pin, []):
+            callback(level)
+
+    def sim_edges(pin, edges):
+        """
+        Simulate a sequence of edges on an input pin, for example a bouncing contact:
+            sim_edges(pin, [(0, 0), (0.002, 1), (0.003, 0)])
+        edges is a list of (seconds after the previous edge, level).
+        """
+        for delay, level in edges:
+            if delay:
+                time.sleep(delay)
+            sim_edge(pin, level)
 
     def gp_cleanup(header_pins = None):
         """
@@ -257,6 +326,40 @@ elif gv.platform == 'nt' or gv.platform == '':  # Use simulated IO.
                 gp_config_input(gv.pin_map[i])  # Config pin as a high impedance input.
                 unmap_gpio_pin(i)
 
+elif gv.platform == 'rec':  # Record calls, see gpio_recorder.py.
+    import gpio_recorder
+    recorder = gpio_recorder.Recorder(float(os.environ.get('SIP_GPIO_LATENCY', 0)) / 1e6)
+
+    def gp_config_output(pin):
+        recorder.config_output(pin)
+
+    def gp_config_input(pin, pullup='off'):
+        recorder.config_input(pin, pullup)
+
+    def gp_write(pin,val):
+        recorder.write(pin, val)
+
+    def gp_read(pin):
+        return recorder.read(pin)
+
+    def gp_watch_input(pin, callback):
+        return recorder.watch_input(pin, callback)
+
+    def gp_cleanup(header_pins = None):
+        if header_pins == None:  # Unmap all claimed pins.
+              header_pins = [x for x in range(len(gv.pin_map))]
+        for i in header_pins:
+            if claimed_gpio_pins[i]:
+                gp_config_input(gv.pin_map[i])  # Config pin as a high impedance input.
+                unmap_gpio_pin(i)
+
+    def use_recorder(r):
+        """
+        Send the gp_* calls to gpio_recorder.Recorder r from now on.
+        """
+        global recorder
+        recorder = r
+
 else:  # Oppps! The dreaded configuration errror.
     print 'Error: gpio_pins -- configuring platform "{}"'.format(gv.platform)
     print 'Should probably abort execution.'
@@ -285,6 +388,43 @@ def config_pin_relay():
     gp_config_output(pr)
     return pr
 
+class DebouncedInput(object):
+    """
+    Edge triggered input that ignores contact bounce.
+
+    Every edge (re)starts a timer of window seconds. When the timer expires
+    the input has been stable for the whole window, and on_change(level) is
+    called from the timer thread if the level differs from the last one
+    reported. Short pulses that return to the previous level are ignored.
+    """
+
+    def __init__(self, pin, window, on_change):
+        self.pin = pin
+        self.window = window
+        self.on_change = on_change
+        self.level = gp_read(pin)  # Debounced level.
+        self._last = self.level  # Level of the latest edge.
+        self._timer = None
+        self._lock = threading.Lock()
+        self.edge_detect = gp_watch_input(pin, self._edge)
+
+    def _edge(self, level):
+        with self._lock:
+            self._last = level
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.window, self._settled)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _settled(self):
+        with self._lock:
+            self._timer = None
+            if self._last == self.level:
+                return
+            self.level = self._last
+        self.on_change(self.level)
+
 ###
 # Kludge: Pin allocation and setup should be moved out of gpio_pins.
 #         Mapping should be done in the module that uses the pin(s).
@@ -335,6 +475,28 @@ def setup_pins():
     except AttributeError:
         pass
 
+    select_sr_output()
+
+
+sr_output = None  # Output from shift_register.py used instead of setShiftRegister(), if any.
+
+def select_sr_output():
+    """
+    Choose how frames are sent to the shift register: an SPI transfer if
+    the registers are wired to the SPI pins (gv.sd['spi']), a pigpio
+    waveform when using pigpio, else bit by bit with setShiftRegister().
+    """
+
+    global sr_output
+    sr_output = None
+    if gv.sd['spi']:
+        try:
+            sr_output = shift_register.SpiOutput(shift_register.open_spi())
+        except (ImportError, IOError) as e:
+            print 'gpio_pins: SPI output not available, using GPIO pins:', e
+    elif gv.platform == 'pi' and gv.use_pigpio and 'pi' in globals():
+        sr_output = shift_register.WaveOutput(pigpio, pi, pin_sr_dat, pin_sr_clk, pin_sr_lat)
+
 def disableShiftRegisterOutput():
     """
     Disable (tristate) output from shift register.
@@ -383,16 +545,94 @@ def setShiftRegister(srvals):
         pass
 
 
+_committed = None  # Output frame last written to the shift register.
+_held = False  # True while the timing loop coalesces set_output() calls.
+_stale = False  # set_output() was called while held.
+_closed = False  # close_output() was called, outputs are no longer written.
+
+
+def _write_output():
+    """
+    Write gv.srvals to the shift register unless the frame is the one already written.
+    Called with gv.output_srvals_lock held.
+    """
+    global _committed, sr_output
+    frame = gv.srvals.tolist()
+    if gv.sd['alr']:
+        frame = [1-i for i in frame]  # Invert logic of shift registers.
+    if frame == _committed:
+        return
+    gv.output_srvals = frame
+    disableShiftRegisterOutput()
+    if sr_output is not None:
+        try:
+            sr_output.write(frame)
+        except Exception as e:
+            print 'gpio_pins: shift register output failed, using GPIO pins:', e
+            sr_output = None
+    if sr_output is None:
+        setShiftRegister(gv.output_srvals)  # gv.srvals stores shift register state.
+    enableShiftRegisterOutput()
+    _committed = frame
+    dispatch.send(zone_change)
+
+
 def set_output():
     """
     Write contents of shift register to the valve controller hardware outputs.
+    Nothing is written and zone_change is not sent if the outputs are unchanged.
+    Between hold_output() and release_output() the write is postponed to release_output().
     """
 
+    global _stale
+    if engine.role == 'web':  # Outputs are driven by the engine process.
+        scheduler.wake()
+        return
     with gv.output_srvals_lock:
-        gv.output_srvals = gv.srvals
-        if gv.sd['alr']:
-            gv.output_srvals = [1-i for i in gv.output_srvals]  # Invert logic of shift registers.
-        disableShiftRegisterOutput()
-        setShiftRegister(gv.output_srvals)  # gv.srvals stores shift register state.
-        enableShiftRegisterOutput()
-        zone_change.send()
+        if _closed:
+            return
+        if _held:
+            _stale = True
+            return
+        _write_output()
+
+
+def hold_output():
+    """
+    Postpone set_output() calls until release_output(), so that all the
+    changes of one pass of the timing loop reach the hardware in one write.
+    """
+    global _held
+    with gv.output_srvals_lock:
+        _held = True
+
+
+def release_output():
+    """
+    End hold_output() and write the outputs if set_output() was called meanwhile.
+    """
+    global _held, _stale
+    with gv.output_srvals_lock:
+        _held = False
+        if _stale:
+            _stale = False
+            if not _closed:
+                _write_output()
+
+
+def close_output():
+    """
+    Write the outputs now, even between hold_output() and release_output(),
+    then stop writing them and release the pins with gp_cleanup().
+    Called before restart, reboot and power off, so a frame held by the
+    timing loop cannot reach the pins after they were cleaned up.
+    """
+    global _held, _stale, _closed
+    if engine.role == 'web':  # Outputs are driven by the engine process.
+        scheduler.wake()
+    else:
+        with gv.output_srvals_lock:
+            _held = _stale = False
+            _write_output()
+            _closed = True
+    gp_cleanup()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Recording GPIO backend for tests and benchmarks.
+
+A Recorder stands in for the hardware behind the gp_* functions of
+gpio_pins.py. It records every call with a timestamp, and advances a
+simulated clock by a fixed latency per call, so the cost of an output path
+on real hardware can be estimated on any machine (100 microseconds is about
+one round trip to pigpiod).
+
+Select it for a whole run with environment variables:
+
+    SIP_GPIO=recording SIP_GPIO_LATENCY=100 python sip.py
+
+gpio_pins.recorder is then the Recorder in use, and
+gpio_pins.use_recorder(Recorder(latency)) installs a fresh one.
+decode_frames() turns the recorded shift register writes back into the
+station values that were latched.
+"""
+
+from collections import namedtuple
+import threading
+import time
+
+Call = namedtuple('Call', [
+    'time',  # time.time() of the call
+    'simulated',  # simulated time of the call, seconds since the recorder was created or reset
+    'op',  # 'config_output', 'config_input', 'write' or 'read'
+    'pin',
+    'value',  # level written or read, pull up setting for config_input
+])
+
+
+class Recorder(object):
+    """
+    Records gp_* calls.
+
+    @type latency: float
+    @param latency: simulated time taken by each call, in seconds
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.inputs = {}  # Level read() returns, by pin. Pins not listed read 1 (pulled up).
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Discard the recorded calls and restart the simulated clock."""
+        with self._lock:
+            self.calls = []
+            self.elapsed = 0.0
+
+    def _record(self, op, pin, value=None):
+        with self._lock:
+            self.calls.append(Call(time.time(), self.elapsed, op, pin, value))
+            self.elapsed += self.latency
+
+    def config_output(self, pin):
+        self._record('config_output', pin)
+
+    def config_input(self, pin, pullup='off'):
+        self._record('config_input', pin, pullup)
+
+    def write(self, pin, val):
+        self._record('write', pin, 1 if val else 0)
+
+    def read(self, pin):
+        value = self.inputs.get(pin, 1)
+        self._record('read', pin, value)
+        return value
+
+    def watch_input(self, pin, callback):
+        return False  # No edges, callers poll with read().
+
+    def count(self, op=None):
+        """Return the number of recorded calls, or of calls of one operation."""
+        if op is None:
+            return len(self.calls)
+        return len([c for c in self.calls if c.op == op])
+
+
+def decode_frames(calls, dat, clk, lat):
+    """
+    Return the frames latched into a shift register chain by calls, as
+    lists of station values, station 1 first.
+
+    A rising edge on clk shifts in the level of dat and a rising edge on lat
+    latches the bits shifted since the previous latch. The bit shifted
+    first ends up on the last station.
+    """
+    levels = {}
+    bits = []
+    frames = []
+    for c in calls:
+        if c.op != 'write':
+            continue
+        rising = c.value and not levels.get(c.pin)
+        levels[c.pin] = c.value
+        if rising and c.pin == clk:
+            bits.append(levels.get(dat, 0))
+        elif rising and c.pin == lat:
+            frames.append(bits[::-1])
+            bits = []
+    return frames
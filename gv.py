@@ -4,24 +4,26 @@
 
 ##############################
 #### Revision information ####
-import subprocess
 from threading import RLock
 
+import version
+
 major_ver = 3
 minor_ver = 2
 old_count = 747
 
-try:
-    revision = int(subprocess.check_output(['git', 'rev-list', '--count', 'HEAD']))
+version_info = version.load()  # Cached in data/version.json, git only runs after an update.
+
+revision = version_info.get('revision')
+if revision is not None:
     ver_str = '%d.%d.%d' % (major_ver, minor_ver, (revision - old_count))
-except Exception:
+else:
     print _('Could not use git to determine version!')
     revision = 999
     ver_str = '%d.%d.%d' % (major_ver, minor_ver, revision)
 
-try:
-    ver_date = subprocess.check_output(['git', 'log', '-1', '--format=%cd', '--date=short']).strip()
-except Exception:
+ver_date = version_info.get('date')
+if ver_date is None:
     print _('Could not use git to determine date of last commit!')
     ver_date = '2015-01-09'
 
@@ -66,6 +68,7 @@ sd = {
     u"password": u"",
     u"ipas": 0,
     u"rst": 1,
+    u"rsdb": 100,
     u"mm": 0,
     u"mo": [0],
     u"rbt": 0,
@@ -82,7 +85,12 @@ sd = {
     u"lang": u"default",
     u"idd": 0,
     u"pigpio": 0,
-    u"alr":0
+    u"alr":0,
+    u"spi": 0,
+    u"asig": 0,
+    u"ldb": 0,
+    u"svd": 2,
+    u"eng": 0
 }
 
 try:
@@ -98,29 +106,27 @@ except IOError:  # If file does not exist, it will be created using defaults.
 use_pigpio = sd['pigpio']
 
 from helpers import load_programs, station_names
+from station_state import StationState
 
 nowt = time.localtime()
 now = timegm(nowt)
 tz_offset = int(time.time() - timegm(time.localtime()))  # Compatible with Javascript (negative tz shown as positive value).
 plugin_menu = []  # Empty list of lists for plugin links (e.g. ['name', 'URL']).
 
-srvals = [0] * (sd['nst'])  # Shift Register values.
+stations = StationState(sd['nst'])  # On/off state and run schedule of all stations.
+srvals = stations.srvals  # Shift Register values.
 output_srvals = [0] * (sd['nst'])  # Shift Register values last set by set_output().
 output_srvals_lock = RLock()
 rovals = [0] * sd['nbrd'] * 7  # Run Once durations.
 snames = station_names()  # Load station names from file.
 pd = load_programs()  # Load program data from file.
 plugin_data = {}  # Empty dictionary to hold plugin based global data.
-ps = []  # Program schedule (used for UI display).
-for i in range(sd['nst']):
-    ps.append([0, 0])
+ps = stations.ps  # Program schedule (used for UI display). [program number, time remaining] per station.
 
 pon = None  # Program on (Holds program number of a running program).
-sbits = [0] * (sd['nbrd'] + 1)  # Used to display stations that are on in UI.
+sbits = stations.sbits  # Used to display stations that are on in UI.
 
-rs = []  # Run schedule.
-for j in range(sd['nst']):
-    rs.append([0, 0, 0, 0])  # Scheduled start time, scheduled stop time, duration, program index.
+rs = stations.rs  # Run schedule. [scheduled start time, scheduled stop time, duration, program index] per station.
 
 lrun = [0, 0, 0, 0]  # Station index, program number, duration, end time (Used in UI).
 scount = 0  # Station count, used in set station to track on stations with master association.
@@ -136,6 +142,9 @@ options = [
     [_("24-hour clock"), "boolean", "tf", _("Display times in 24 hour format (as opposed to AM/PM style.)"), _("System")],
     [_("HTTP port"), "int", "htp", _("HTTP port."), _("System")],
     [_("Use pigpio"), "boolean", "pigpio", _("GPIO Library to use. Default is RPi.GPIO"), _("System")],    
+    [_("Background signals"), "boolean", "asig", _("Notify plugins of station and rain sensor changes from background threads, so slow plugins cannot delay the valves."), _("System")],
+    [_("Save delay"), "int", "svd", _("Seconds to wait before writing changed settings and programs to the SD card, so bursts of changes are written once. 0 writes at once."), _("System")],
+    [_("Timing process"), "boolean", "eng", _("Run valve timing in its own process, isolated from web load (takes effect after restart)."), _("System")],
     [_("Water Scaling"), "int", "wl", _("Water scaling (as %), between 0 and 100."), _("System")],
     [_("Disable security"), "boolean", "ipas", _("Allow anonymous users to access the system without a password."), _("Change Password")],
     [_("Current password"), "password", "opw", _("Re-enter the current password."), _("Change Password")],
@@ -146,11 +155,14 @@ options = [
     [_("Extension boards"), "int", "nbrd", _("Number of extension boards."), _("Station Handling")],
     [_("Station delay"), "int", "sdt", _("Station delay time (in seconds), between 0 and 240."), _("Station Handling")],
     [_("Active-Low Relay"), "boolean", "alr", _("Using active-low relay boards connected through shift registers"), _("Station Handling")],
+    [_("SPI shift registers"), "boolean", "spi", _("Shift registers are wired to the SPI pins: MOSI to data, SCLK to clock, CE0 to latch (takes effect after restart)."), _("Station Handling")],
     [_("Master station"), "int", "mas",_( "Select master station."), _("Configure Master")],
     [_("Master on adjust"), "int", "mton", _("Master on delay (in seconds), between +0 and +60."), _("Configure Master")],
     [_("Master off adjust"), "int", "mtoff", _("Master off delay (in seconds), between -60 and +60."), _("Configure Master")],
     [_("Use rain sensor"), "boolean", "urs", _("Use rain sensor."), _("Rain Sensor")],
     [_("Normally open"), "boolean", "rst", _("Rain sensor type."), _("Rain Sensor")],
+    [_("Debounce time"), "int", "rsdb", _("Time (in milliseconds) the rain sensor must be stable before a change is accepted."), _("Rain Sensor")],
     [_("Enable logging"), "boolean", "lg", _("Log all events - note that repetitive writing to an SD card can shorten its lifespan."), _("Logging")],
-    [_("Max log entries"), "int", "lr", _("Length of log to keep, 0=no limits."), _("Logging")]
+    [_("Max log entries"), "int", "lr", _("Length of log to keep, 0=no limits."), _("Logging")],
+    [_("Log database"), "boolean", "ldb", _("Keep the log in an SQLite database (data/log.db), for fast queries on long logs."), _("Logging")]
 ]
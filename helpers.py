@@ -20,11 +20,16 @@ from blinker import signal
 import web
 from web import form
 
+import dispatch
 import gv
+import persist
+import run_log
+import scheduler
+import usage
 from web.session import sha1
 
 try:
-    from gpio_pins import pin_relay, gp_read, config_pin_rain_sense
+    from gpio_pins import pin_relay, gp_read, config_pin_rain_sense, DebouncedInput
 except ImportError:
     print 'error importing GPIO pins into helpers'
     pass
@@ -48,14 +53,14 @@ def report_station_completed(station):
     Send blinker signal indicating that a station has completed.
     Include the station number as data.
     """
-    station_completed.send(station)
+    dispatch.send(station_completed, station)
 
 stations_scheduled = signal('stations_scheduled')
 def report_stations_scheduled(txt=None):
     """
     Send blinker signal indicating that stations had been scheduled.
     """
-    stations_scheduled.send('SIP',txt=txt)
+    dispatch.send(stations_scheduled, 'SIP', txt=txt)
 
 
 rain_changed = signal('rain_changed')
@@ -63,7 +68,7 @@ def report_rain_changed(txt=None):
     """
     Send blinker signal indicating that rain sensor changed.
     """
-    rain_changed.send()
+    dispatch.send(rain_changed)
 
 
 restarting = signal('restart') #: Signal to send on software restart
@@ -84,15 +89,15 @@ def reboot(wait=1, block=False):
         Set to True at start of thread (recursive).
     """
     if block:
-        from gpio_pins import set_output, gp_cleanup
-        gv.srvals = [0] * (gv.sd['nst'])
-        set_output()
-        gp_cleanup()
+        from gpio_pins import close_output
+        gv.stations.all_off()
+        close_output()
         time.sleep(wait)
         try:
             print _('Rebooting...')
         except Exception:
             pass
+        persist.flush()
         subprocess.Popen(['reboot'])
     else:
         t = Thread(target=reboot, args=(wait, True))
@@ -110,15 +115,15 @@ def poweroff(wait=1, block=False):
         Set to True at start of thread (recursive).
     """
     if block:
-        from gpio_pins import set_output, gp_cleanup
-        gv.srvals = [0] * (gv.sd['nst'])
-        set_output()
-        gp_cleanup()
+        from gpio_pins import close_output
+        gv.stations.all_off()
+        close_output()
         time.sleep(wait)
         try:
             print _('Powering off...')
         except Exception:
             pass
+        persist.flush()
         subprocess.Popen(['poweroff'])
     else:
         t = Thread(target=poweroff, args=(wait, True))
@@ -137,16 +142,16 @@ def restart(wait=1, block=False):
     """
     if block:
         report_restart()
-        from gpio_pins import set_output, gp_cleanup
-        gv.srvals = [0] * (gv.sd['nst'])
-        set_output()
-        gp_cleanup()
+        from gpio_pins import close_output
+        gv.stations.all_off()
+        close_output()
         time.sleep(wait)
         try:
             print _('Restarting...')
         except Exception:
             pass
         gv.restarted = 0
+        persist.flush()
         subprocess.Popen('systemctl restart sip.service'.split())
     else:
         t = Thread(target=restart, args=(wait, True))
@@ -206,45 +211,52 @@ def mkdir_p(path):
             raise
 
 pin_rain_sense  = None
+rain_input = None  # gpio_pins.DebouncedInput on the rain sensor pin.
+
+def _rain_input_changed(level):
+    """
+    Called from the debounce timer thread when the rain sensor input has changed.
+    The timing loop applies the new level in check_rain.
+    """
+    scheduler.wake()
 
 def check_rain():
     """
     Checks status of an installed rain sensor.
-    On first call initializes the hardware pin used by the rain sensor.
+    On first call initializes the hardware pin used by the rain sensor and,
+    where the platform supports it, edge detection with a debounce window of
+    gv.sd['rsdb'] milliseconds. With edge detection this only applies the
+    last debounced level and the timing loop is woken on changes instead of
+    polling every second.
     Handles normally open and normally closed rain sensors
     
     Sets gv.sd['rs'] to 1 if rain is detected otherwise 0.
     """
 
-    global pin_rain_sense
+    global pin_rain_sense, rain_input
 
     if not gv.use_gpio_pins:
         return
 
-    if not pin_rain_sense:
-        pin_rain_sense = config_pin_rain_sense()
-
     try:
+        if not pin_rain_sense:
+            pin_rain_sense = config_pin_rain_sense()
+            rain_input = DebouncedInput(pin_rain_sense, gv.sd['rsdb'] / 1000.0, _rain_input_changed)
+            scheduler.rain_polled = not rain_input.edge_detect
+
+        if rain_input.edge_detect:
+            rain_input.window = gv.sd['rsdb'] / 1000.0
+            level = rain_input.level
+        else:
+            level = gp_read(pin_rain_sense)
+
         if gv.sd['rst'] == 1:  # Rain sensor type normally open (default)
-            if gv.use_pigpio:
-                if not gp_read(pin_rain_sense):  # Rain detected
-                    gv.sd['rs'] = 1
-                else:
-                    gv.sd['rs'] = 0
-            else:
-                if gp_read(pin_rain_sense) == gv.sd['rs']: #  Rain sensor changed, reading and gv.sd['rs'] are inverse.
-                    report_rain_changed()
-                    gv.sd['rs'] = 1 - gv.sd['rs'] #  toggle
-        elif gv.sd['rst'] == 0:  # Rain sensor type normally closed
-            if gv.use_pigpio:
-                if gp_read(pin_rain_sense):  # Rain detected
-                    gv.sd['rs'] = 1
-                else:
-                    gv.sd['rs'] = 0
-            else:
-                if gp_read(pin_rain_sense) != gv.sd['rs']:  # Rain sensor changed
-                    report_rain_changed()
-                    gv.sd['rs'] = 1 - gv.sd['rs'] #  toggle
+            rs = 0 if level else 1  # Rain detected when the contact closes to ground.
+        else:  # Rain sensor type normally closed
+            rs = 1 if level else 0
+        if rs != gv.sd['rs']:  # Rain sensor changed
+            report_rain_changed()
+            gv.sd['rs'] = rs
     except NameError:
         pass
 
@@ -256,15 +268,9 @@ def clear_mm():
     """
     from gpio_pins import set_output
     if gv.sd['mm']:
-        gv.sbits = [0] * (gv.sd['nbrd'] + 1)
-        gv.ps = []
-        for i in range(gv.sd['nst']):
-            gv.ps.append([0, 0])
-        gv.rs = []
-        for i in range(gv.sd['nst']):
-            gv.rs.append([0, 0, 0, 0])
-        gv.srvals = [0] * (gv.sd['nst'])
+        gv.stations.clear()
         set_output()
+        scheduler.wake()
     return
 
 
@@ -329,40 +335,44 @@ def timestr(t):
         (t % 60 >> 0) % 10)
 
 
+def log_line():
+    """
+    Format the run described by gv.lrun as a json log record.
+    
+    @rtype: string
+    @return: log record or None if the run is not logged (program 0).
+    """
+    program = _('program')
+    station = _('station')
+    duration = _('duration')
+    strt = _('start')
+    date = _('date')
+    if gv.lrun[1] == 0:  # skip program 0
+        return None
+    elif gv.lrun[1] == 98:
+        pgr = _('Run-once')
+    elif gv.lrun[1] == 99:
+        pgr = _('Manual')
+    else:
+        pgr = str(gv.lrun[1])
+    start = time.gmtime(gv.now - gv.lrun[2])
+    return '{"'+program+'":"' + pgr + '","'+station+'":' + str(gv.lrun[0]) + ',"'+duration+'":"' + timestr(
+        gv.lrun[2]) + '","'+strt+'":"' + time.strftime('%H:%M:%S","'+date+'":"%Y-%m-%d"', start) + '}'
+
+
 def log_run():
     """
-    Add run data to json log file - most recent first.
+    Append run data to the run log (run_log.py) and add it to the usage totals (usage.py).
     
-    If a record limit is specified (gv.sd['lr']) the number of records is truncated.  
+    If a record limit is specified (gv.sd['lr']) older records are dropped.  
     """
 
     if gv.sd['lg']:
-        program = _('program')
-        station = _('station')
-        duration = _('duration')
-        strt = _('start')
-        date = _('date')
-        if gv.lrun[1] == 0:  # skip program 0
+        logline = log_line()
+        if logline is None:
             return
-        elif gv.lrun[1] == 98:
-            pgr = _('Run-once')
-        elif gv.lrun[1] == 99:
-            pgr = _('Manual')
-        else:
-            pgr = str(gv.lrun[1])
-        start = time.gmtime(gv.now - gv.lrun[2])
-        logline = '{"'+program+'":"' + pgr + '","'+station+'":' + str(gv.lrun[0]) + ',"'+duration+'":"' + timestr(
-            gv.lrun[2]) + '","'+strt+'":"' + time.strftime('%H:%M:%S","'+date+'":"%Y-%m-%d"', start) + '}'
-        lines = []
-        lines.append(logline + '\n')
-        log = read_log()
-        for r in log:
-            lines.append(json.dumps(r) + '\n')
-        with codecs.open('./data/log.json', 'w', encoding='utf-8') as f:
-            if gv.sd['lr']:
-                f.writelines(lines[:gv.sd['lr']])
-            else:
-                f.writelines(lines)
+        usage.add(json.loads(logline))
+        run_log.append(logline)
     return
 
 
@@ -418,7 +428,6 @@ def schedule_stations(stations):
                         gv.rs[sid][1] = accumulate_time  # set new stop time
                         accumulate_time += gv.sd['sdt']  # add station delay
                     else:
-                        gv.sbits[b] &= ~1 << s
                         gv.ps[s] = [0, 0]
     else:  # concurrent mode, stations allowed to run in parallel
         for b in range(len(stations)):
@@ -431,10 +440,10 @@ def schedule_stations(stations):
                         gv.rs[sid][0] = gv.now  # accumulate_time # set start time
                         gv.rs[sid][1] = (gv.now + gv.rs[sid][2])  # set stop time
                     else:  # if rain and station does not ignore, clear station from display
-                        gv.sbits[b] &= ~1 << s
                         gv.ps[s] = [0, 0]
     report_stations_scheduled()
     gv.sd['bsy'] = 1
+    scheduler.wake()
     return
 
 
@@ -445,17 +454,13 @@ def stop_onrain():
 
     from gpio_pins import set_output
     do_set_output = False
-    for b in range(gv.sd['nbrd']):
-        for s in range(8):
-            sid = b * 8 + s  # station index
-            if gv.sd['ir'][b] & 1 << s:  # if station ignores rain...
-                continue
-            elif not all(v == 0 for v in gv.rs[sid]):
-                gv.srvals[sid] = 0
-                do_set_output = True
-                gv.sbits[b] &= ~1 << s  # Clears stopped stations from display
-                gv.ps[sid] = [0, 0]
-                gv.rs[sid] = [0, 0, 0, 0]
+    for sid in gv.stations.scheduled():  # Only stations that are on or scheduled
+        b, s = divmod(sid, 8)
+        if gv.sd['ir'][b] & 1 << s:  # if station ignores rain...
+            continue
+        elif not all(v == 0 for v in gv.rs[sid]):
+            gv.stations.clear_station(sid)  # Also clears it from the display
+            do_set_output = True
 
     if do_set_output:
         set_output()
@@ -467,46 +472,29 @@ def stop_stations():
     Stop all running stations, clear schedules.
     """
     from gpio_pins import set_output
-    gv.srvals = [0] * (gv.sd['nst'])
+    gv.stations.clear()
     set_output()
-    gv.ps = []
-    for i in range(gv.sd['nst']):
-        gv.ps.append([0, 0])
-    gv.sbits = [0] * (gv.sd['nbrd'] + 1)
-    gv.rs = []
-    for i in range(gv.sd['nst']):
-        gv.rs.append([0, 0, 0, 0])
     gv.sd['bsy'] = 0
+    scheduler.wake()
     return
 
 
 def read_log():
     """
-    
+    Return a list of all the log records, most recent first.
+    Use run_log.records() to iterate them without loading them all.
     """
-    result = []
-    try:
-        with io.open('./data/log.json') as logf:
-            records = logf.readlines()
-            for i in records:
-                try:
-                    rec = ast.literal_eval(json.loads(i))
-                except ValueError:
-                    rec = json.loads(i)
-                result.append(rec)
-        return result
-    except IOError:
-        return result
+    return list(run_log.records())
 
 
 def jsave(data, fname):
     """
-    Save data to a json file.
-    
+    Save data to a json file in the data directory.
     
+    The file is written atomically by a background thread after the save delay
+    (gv.sd['svd']), see persist.py. Call persist.flush() to write it now.
     """
-    with open('./data/' + fname + '.json', 'w') as f:
-        json.dump(data, f, indent=4, sort_keys=True)
+    persist.save(data, fname)
 
 
 def station_names():
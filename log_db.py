@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite store for the run log, used instead of the segment files of
+run_log.py when the "Log database" option (gv.sd['ldb']) is set.
+
+Records are kept in data/log.db, one row per run, through web.py's database
+layer (web/db.py):
+
+    runs(id, date, start, station, program, duration, seconds, record)
+
+record is the json log line as written by helpers.log_line, so readers get
+back exactly what was logged; the other columns are copies of its fields,
+with the duration also in seconds, indexed for queries by date, station and
+program. id gives the order the records were added in.
+
+The database is in WAL mode, so the web pages can read while the timing
+loop writes. Appended records are buffered and written in one transaction
+when BATCH_SIZE are waiting, FLUSH_DELAY seconds after the first of them,
+before anything is read, and when persist.flush() is called (restart,
+reboot, power off, exit and SIGTERM).
+
+When the database is first created the records in the segment files are
+copied into it. The segment files are left as they are, so clearing the
+option goes back to them (without the runs logged meanwhile).
+"""
+
+import os
+import threading
+
+import web
+
+import gv
+import persist
+import run_log
+
+DATABASE = './data/log.db'
+BATCH_SIZE = 100  # Rows per insert, sqlite allows 999 parameters in a statement.
+FLUSH_DELAY = 2.0  # seconds
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, date TEXT, start TEXT, station INTEGER, '
+    'program TEXT, duration TEXT, seconds INTEGER, record TEXT)',
+    'CREATE INDEX IF NOT EXISTS runs_date ON runs (date)',
+    'CREATE INDEX IF NOT EXISTS runs_station ON runs (station, date)',
+    'CREATE INDEX IF NOT EXISTS runs_program ON runs (program, date)',
+]
+
+
+def _row(line):
+    record = run_log.parse(line)
+    station = record.get('station')
+    return {
+        'date': record.get('date'),
+        'start': record.get('start'),
+        'station': station if isinstance(station, int) else None,
+        'program': record.get('program'),
+        'duration': record.get('duration'),
+        'seconds': run_log.seconds(record.get('duration')),
+        'record': line,
+    }
+
+
+class SqliteStore(object):
+    """
+    Run log in the SQLite database at path, with the interface of run_log.LogStore.
+    The records of source (a run_log.LogStore) are copied in when the database is created.
+    """
+
+    def __init__(self, path=DATABASE, source=None):
+        self.path = path
+        self.source = source
+        self._lock = threading.RLock()
+        self._db = None
+        self._pid = None  # Process the connection was made in (the engine process forks).
+        self._pending = []  # Rows waiting to be inserted.
+        self._timer = None
+        persist.on_flush(self.flush)
+
+    def db(self):
+        """Return the web.db database, creating the file and schema on first use."""
+        with self._lock:
+            if self._pid != os.getpid():
+                created = not os.path.exists(self.path)
+                db = web.database(dbn='sqlite', db=self.path)
+                db.printing = False
+                db.supports_multiple_insert = True
+                db.query('PRAGMA journal_mode=WAL')
+                for statement in SCHEMA:
+                    db.query(statement)
+                self._db = db
+                self._pid = os.getpid()
+                self._pending = []
+                self._timer = None
+                if created and self.source is not None:
+                    self._import()
+            return self._db
+
+    def _import(self):
+        """Copy the records of the segment files, oldest first."""
+        lines = list(self.source.lines(0))
+        lines.reverse()
+        for line in lines:
+            try:
+                self._pending.append(_row(line))
+            except (ValueError, SyntaxError):
+                continue
+        self.flush()
+
+    def append(self, line):
+        """
+        Queue a log line (json text without the newline) to be added.
+        """
+        if isinstance(line, str):
+            line = line.decode('utf-8')
+        row = _row(line)
+        with self._lock:
+            self.db()
+            self._pending.append(row)
+            if len(self._pending) >= BATCH_SIZE:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(FLUSH_DELAY, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Insert the queued rows in one transaction and drop records beyond gv.sd['lr']."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending or self._pid != os.getpid():
+                return
+            db = self._db
+            rows, self._pending = self._pending, []
+            with db.transaction():
+                for i in range(0, len(rows), BATCH_SIZE):
+                    db.multiple_insert('runs', rows[i:i + BATCH_SIZE], seqname=False)
+                if gv.sd['lr']:
+                    db.query('DELETE FROM runs WHERE id <= (SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET $lr)',
+                             vars={'lr': gv.sd['lr']})
+
+    def _select(self, where=None, vars=None, limit=None):
+        """Iterate the records matching where, newest first."""
+        self.flush()
+        if limit is None:
+            limit = gv.sd['lr']
+        rows = self.db().select('runs', vars=vars, what='record', where=where, order='id DESC', limit=limit or None)
+        for row in rows:
+            try:
+                yield run_log.parse(row.record)
+            except (ValueError, SyntaxError):
+                continue
+
+    def records(self, limit=None):
+        """Iterate the log records (dictionaries) newest first, at most limit of them (default gv.sd['lr'], 0 for all)."""
+        return self._select(limit=limit)
+
+    def records_between(self, first, last, limit=None):
+        """Iterate the records dated first to last ("yyyy-mm-dd", both included) newest first."""
+        return self._select('date BETWEEN $first AND $last', {'first': first, 'last': last}, limit)
+
+    def page(self, cursor=None, size=100, limit=None):
+        """
+        Return a page of up to size records, newest first, and the cursor of
+        the next page (None after the last page). The cursor is the id of the
+        last record returned.
+        """
+        self.flush()
+        where = None
+        vars = {}
+        if cursor:
+            try:
+                vars['id'] = int(cursor)
+            except ValueError:
+                raise ValueError('bad cursor: {!r}'.format(cursor))
+            where = 'id < $id'
+        if limit is None:
+            limit = gv.sd['lr']
+        db = self.db()
+        if limit:  # Records beyond the limit may not be deleted yet.
+            oldest = db.query('SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET $n', vars={'n': limit - 1})
+            oldest = list(oldest)
+            if oldest:
+                vars['oldest'] = oldest[0].id
+                where = ' AND '.join(filter(None, [where, 'id >= $oldest']))
+        rows = list(db.select('runs', vars=vars, what='id, record', where=where, order='id DESC', limit=size + 1))
+        result = []
+        for row in rows[:size]:
+            try:
+                result.append(run_log.parse(row.record))
+            except (ValueError, SyntaxError):
+                continue
+        return result, str(rows[size - 1].id) if len(rows) > size else None
+
+    def count(self):
+        """Return the number of records, up to the record limit."""
+        self.flush()
+        total = list(self.db().query('SELECT COUNT(*) AS n FROM runs'))[0].n
+        limit = gv.sd['lr']
+        return min(total, limit) if limit else total
+
+    def totals(self, first, last, station=None, program=None):
+        """
+        Return (runs, seconds) of the records dated first to last, of one station
+        (index from 0) and/or program if given.
+        """
+        self.flush()
+        where = ['date BETWEEN $first AND $last']
+        if station is not None:
+            where.append('station = $station')
+        if program is not None:
+            where.append('program = $program')
+        row = list(self.db().select('runs', what='COUNT(*) AS runs, SUM(seconds) AS seconds', where=' AND '.join(where),
+                                    vars={'first': first, 'last': last, 'station': station, 'program': program}))[0]
+        return row.runs, row.seconds or 0
+
+    def clear(self):
+        """Delete all records."""
+        with self._lock:
+            self._pending = []
+            self.db().query('DELETE FROM runs')
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind saving of the json files in data/ (sd, programs, snames).
+
+helpers.jsave() used to rewrite the whole file in the calling thread, on
+every settings change, program toggle or rain delay expiry, so web requests
+and the timing loop waited for the SD card. Now jsave() calls save(), which
+only formats the document and marks it dirty; a background thread writes
+it once the save delay (gv.sd['svd'], seconds) has passed since the first
+unsaved change. Changes made meanwhile are coalesced into that one write.
+With the delay set to 0 documents are written in the calling thread.
+
+Each file is written atomically: to a temporary file that is flushed and
+fsync'ed, then renamed over the old one, so a power cut leaves either the
+old or the new file, never a truncated one.
+
+flush() writes everything pending at once. It is called before restart,
+reboot and power off (helpers.py), at interpreter exit, and on SIGTERM
+(systemctl stop/restart) once flush_on_exit() has been called (sip.py).
+Modules that buffer writes of their own register a function with
+on_flush() to have it called then too.
+"""
+
+import atexit
+import json
+import os
+import signal
+import threading
+import time
+
+import gv
+
+DATA_DIR = './data'
+
+# Both locks are reentrant: the SIGTERM handler runs in the main thread and
+# flushes, possibly while the main thread is in save() or flush() holding them.
+_lock = threading.Condition(threading.RLock())
+_write_lock = threading.RLock()  # Held while taking and writing documents, so writes happen in order.
+_pending = {}  # Document name -> json text not yet written.
+_due = None  # time.time() when the pending documents are to be written.
+_pid = None  # Process the writer thread was started in (the engine process forks).
+_thread = None
+_stopping = False
+_flush_callbacks = []  # Called by flush(), see on_flush().
+
+
+def write(name, text):
+    """Atomically replace data/<name>.json with text."""
+    path = os.path.join(DATA_DIR, name + '.json')
+    with open(path + '.tmp', 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+
+def _take():
+    """Return the pending documents and clear them. Called with _lock held."""
+    global _pending, _due
+    pending, _pending, _due = _pending, {}, None
+    return pending
+
+
+def _writer():
+    while True:
+        with _lock:
+            while not _stopping and (_due is None or time.time() < _due):
+                _lock.wait(None if _due is None else _due - time.time())
+            if _stopping:
+                return
+        with _write_lock:
+            with _lock:
+                pending = _take()
+            for name, text in pending.items():
+                try:
+                    write(name, text)
+                except (IOError, OSError) as e:
+                    print 'error saving', name, e
+
+
+def _start():
+    """Start the writer thread in this process if it is not running. Called with _lock held."""
+    global _pid, _pending, _thread
+    if _pid != os.getpid():  # First use, or thread lost in a fork.
+        _pending = {}  # The parent process writes what it had pending.
+        _thread = threading.Thread(target=_writer, name='persist')
+        _thread.daemon = True
+        _thread.start()
+        _pid = os.getpid()
+
+
+def save(data, name):
+    """
+    Save data as data/<name>.json after the save delay.
+    data is formatted now, so later changes to it are not saved until save() is called again.
+    """
+    global _due
+    text = json.dumps(data, indent=4, sort_keys=True)
+    delay = gv.sd.get('svd', 0)
+    if delay <= 0:
+        with _write_lock:
+            with _lock:
+                _pending.pop(name, None)
+            write(name, text)
+        return
+    with _lock:
+        _start()
+        _pending[name] = text
+        if _due is None:
+            _due = time.time() + delay
+            _lock.notify()
+
+
+def pending():
+    """Return the names of the documents waiting to be written."""
+    with _lock:
+        return sorted(_pending)
+
+
+def on_flush(callback):
+    """
+    Have flush() call callback as well, so that writes another module buffers
+    (such as log_db.py's) are made before restart, reboot, power off and exit.
+    """
+    _flush_callbacks.append(callback)
+
+
+def flush():
+    """Write the pending documents now, then call the functions registered with on_flush()."""
+    with _write_lock:
+        with _lock:
+            items = _take() if _pid == os.getpid() else {}
+        for name, text in items.items():
+            write(name, text)
+    for callback in list(_flush_callbacks):
+        try:
+            callback()
+        except Exception as e:
+            print 'error flushing', callback, e
+
+
+def _exit():
+    """Write the pending documents and stop the writer thread before the interpreter shuts down."""
+    global _stopping
+    flush()
+    with _lock:
+        _stopping = True
+        _lock.notify()
+    if _thread is not None and _pid == os.getpid():
+        _thread.join(1)
+
+atexit.register(_exit)
+
+
+def _terminate(signum, frame):
+    """
+    SIGTERM handler. A write the main thread was doing when the signal came
+    is abandoned (the old file is kept), the other pending documents are written.
+    """
+    flush()
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def flush_on_exit():
+    """Flush the pending documents on SIGTERM, as they are at interpreter exit. Call from the main thread."""
+    signal.signal(signal.SIGTERM, _terminate)
@@ -8,6 +8,8 @@ from os.path import dirname, join, split, splitext
 
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 
+import startup_profile
+
 
 def isidentifier(s):  # to make this work with Python 2.7.
     if s in keyword.kwlist:
@@ -28,7 +30,8 @@ for name in glob(join(basedir, '*.py')):
                 or module == 'plugin_manager'
                 ):  # Load plugin if group permission is executable.
                 try:
-                    __import__(__name__+'.'+module)
+                    with startup_profile.span(module, 'plugin'):
+                        __import__(__name__+'.'+module)
                 except Exception as e:
                     print 'Ignoring exception while loading the {} plug-in.'.format(module)
                     print e  # Provide feedback for plugin development
@@ -36,7 +39,8 @@ for name in glob(join(basedir, '*.py')):
                     __all__.append(module)       
         elif os_name == "nt":
             try:
-                __import__(__name__+'.'+module)
+                with startup_profile.span(module, 'plugin'):
+                    __import__(__name__+'.'+module)
             except Exception as e:
                 print 'Ignoring exception while loading the {} plug-in.'.format(module)
                 print e  # Provide feedback for plugin development
@@ -7,6 +7,8 @@ import calendar
 from helpers import get_cpu_temp, check_login, password_hash
 import web
 import gv  # Gain access to sip's settings
+import snapshot  # Consistent view of the station state
+import run_log  # Run history
 from urls import urls  # Gain access to sip's URL list
 from webpages import ProtectedPage, WebPage
 
@@ -62,20 +64,21 @@ class cur_settings(ProtectedPage):  # /jc
         web.header('Access-Control-Allow-Origin', '*')
         web.header('Content-Type', 'application/json')
         web.header('Cache-Control', 'no-cache')
+        snap = snapshot.current()
         jsettings = {
             "devt": gv.now,
-            "nbrd": gv.sd['nbrd'],
-            "en": gv.sd['en'],
-            "rd": gv.sd['rd'],
-            "rs": gv.sd['rs'],
-            "mm": gv.sd['mm'],
-            "rdst": gv.sd['rdst'],
-            "loc": gv.sd['loc'],
-            "sbits": gv.sbits,
-            "ps": gv.ps,
-            "lrun": gv.lrun,
-            "ct": get_cpu_temp(gv.sd['tu']),
-            "tu": gv.sd['tu']
+            "nbrd": snap.sd['nbrd'],
+            "en": snap.sd['en'],
+            "rd": snap.sd['rd'],
+            "rs": snap.sd['rs'],
+            "mm": snap.sd['mm'],
+            "rdst": snap.sd['rdst'],
+            "loc": snap.sd['loc'],
+            "sbits": list(snap.sbits),
+            "ps": [list(p) for p in snap.ps],
+            "lrun": list(snap.lrun),
+            "ct": get_cpu_temp(snap.sd['tu']),
+            "tu": snap.sd['tu']
         }
 
         return json.dumps(jsettings)
@@ -87,9 +90,11 @@ class station_state(ProtectedPage):  # /js
         web.header('Access-Control-Allow-Origin', '*')
         web.header('Content-Type', 'application/json')
         web.header('Cache-Control', 'no-cache')
+        snap = snapshot.current()
+        snapshot.not_modified(snap)  # 304 if the poller already has this version
         jstate = {
-            "sn": gv.srvals,
-            "nstations": gv.sd['nst']
+            "sn": list(snap.srvals),
+            "nstations": snap.nst
         }
 
         return json.dumps(jstate)
@@ -144,7 +149,6 @@ class station_info(ProtectedPage):  # /jn
 class get_logs(ProtectedPage):  # /jl
     """Returns log information for specified date range."""
     def GET(self):
-        records = self.read_log()
         data = []
         qdict = web.input()
 
@@ -155,10 +159,16 @@ class get_logs(ProtectedPage):  # /jl
         if 'start' not in qdict or 'end' not in qdict:
             return []
 
-        for r in records:
-            event = json.loads(r)
+        start = int(qdict["start"])
+        end = int(qdict["end"])
+        first = datetime.date.fromtimestamp(start)  # First date whose midnight is in the range.
+        if time.mktime(first.timetuple()) < start:
+            first += datetime.timedelta(days=1)
+        last = datetime.date.fromtimestamp(end)
+
+        for event in run_log.records_between(first.isoformat(), last.isoformat()):
             date = time.mktime(datetime.datetime.strptime(event["date"], "%Y-%m-%d").timetuple())
-            if int(qdict["start"]) <= int(date) <= int(qdict["end"]):
+            if start <= int(date) <= end:
                 pid = event["program"]
                 if pid == "Run-once":
                     pid = 98
@@ -175,14 +185,6 @@ class get_logs(ProtectedPage):  # /jl
 
         return json.dumps(data)
 
-    def read_log(self):
-        try:
-            with open('./data/log.json') as logf:
-                records = logf.readlines()
-            return records
-        except IOError:
-            return []
-
 
 class set_password():
     """Save changes to device password"""
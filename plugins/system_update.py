@@ -11,6 +11,7 @@ import json
 
 import web
 import gv  # Get access to SIP's settings
+import version
 from urls import urls  # Get access to SIP's URLsimport errno
 from sip import template_render
 from webpages import ProtectedPage
@@ -111,6 +112,8 @@ def perform_update():
     command = "git pull"
     subprocess.call(command.split())
 
+    version.update()  # Cache the new revision for the restart.
+
 #     command = "git checkout master"  # Make sure we are on the master branch
 #     output = subprocess.check_output(command.split())
 
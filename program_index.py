@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed index of the times at which the programs in gv.pd fire.
+
+helpers.prog_match() works out from scratch whether a single program runs in
+the current minute. The timing loop needs that answer for every program, so
+instead the enabled programs are compiled into a table of
+minute of day -> program indexes for the current day. The table is rebuilt
+when the day changes or when the programs are changed through the web pages
+(program_change, program_deleted and program_toggled signals).
+
+Plugins that modify gv.pd directly should call invalidate() afterwards.
+
+Times are in the same frame as gv.now (local time as a UTC timestamp).
+"""
+
+import threading
+import time
+
+from blinker import signal
+
+import gv
+
+MAX_SEARCH_DAYS = 62  # Longest gap between runs of a weekday program (odd/even day restrictions).
+
+_lock = threading.Lock()
+_dirty = True
+_day = None  # Day (days since epoch) the table was built for.
+_table = {}  # Minute of day -> list of indexes into gv.pd.
+_next_fire = None  # Cached result of next_fire().
+
+
+def day_match(prog, day):
+    """
+    Test if a program is set to run on a day (days since epoch).
+    Uses the same day rules as helpers.prog_match.
+    """
+    if (prog[1] >= 128) and (prog[2] > 1):  # Interval program
+        return (day % prog[2]) == (prog[1] - 128)
+    lt = time.gmtime(day * 86400)
+    if not prog[1] - 128 & 1 << lt[6]:  # Weekday program
+        return False
+    if prog[1] >= 128 and prog[2] == 0:  # even days
+        if lt[2] % 2 != 0:
+            return False
+    if prog[1] >= 128 and prog[2] == 1:  # Odd days
+        if lt[2] == 31 or (lt[1] == 2 and lt[2] == 29):
+            return False
+        elif lt[2] % 2 != 1:
+            return False
+    return True
+
+
+def fire_minutes(prog):
+    """
+    Return the minutes of the day at which an enabled program with a duration starts.
+    """
+    if not prog[0] or not prog[6] or prog[5] == 0:
+        return []
+    return range(prog[3], prog[4], prog[5])
+
+
+def build_table(day, programs=None):
+    """
+    Return a dictionary of minute of day -> program indexes for all programs running on day.
+    """
+    if programs is None:
+        programs = gv.pd
+    table = {}
+    for i, p in enumerate(programs):
+        minutes = fire_minutes(p)
+        if minutes and day_match(p, day):
+            for m in minutes:
+                table.setdefault(m, []).append(i)
+    return table
+
+
+def invalidate(*args, **kw):
+    """
+    Mark the index as out of date. Connected to the program change signals.
+    """
+    global _dirty
+    _dirty = True
+
+signal('program_change').connect(invalidate)
+signal('program_deleted').connect(invalidate)
+signal('program_toggled').connect(invalidate)
+
+
+def _refresh(day):
+    global _dirty, _day, _table, _next_fire
+    with _lock:
+        if _dirty or day != _day:
+            _dirty = False  # Cleared first so a change made while building is not lost.
+            _table = build_table(day)
+            _day = day
+            _next_fire = None
+
+
+def matches(now):
+    """
+    Return the indexes of programs in gv.pd that fire in the minute containing now.
+    Equivalent to testing prog_match(p) and p[0] and p[6] for every program.
+    """
+    _refresh(now / 86400)
+    npd = len(gv.pd)
+    return [i for i in _table.get((now % 86400) / 60, ()) if i < npd]
+
+
+def next_fire(now):
+    """
+    Return the start of the first minute after the one containing now
+    in which any program fires, or None if no program will run.
+    """
+    global _next_fire
+    _refresh(now / 86400)
+    if _next_fire is not None and _next_fire > now:
+        return _next_fire
+    day = now / 86400
+    minute = (now % 86400) / 60
+    later = [m for m in _table if m > minute]
+    if later:
+        result = day * 86400 + min(later) * 60
+    else:
+        result = None
+        for p in gv.pd:
+            minutes = fire_minutes(p)
+            if not minutes:
+                continue
+            if (p[1] >= 128) and (p[2] > 1):  # Interval program, next run day is known.
+                d = day + 1 + ((p[1] - 128) - (day + 1)) % p[2]
+                t = d * 86400 + minutes[0] * 60
+                if result is None or t < result:
+                    result = t
+                continue
+            for d in range(day + 1, day + 1 + MAX_SEARCH_DAYS):
+                if day_match(p, d):
+                    t = d * 86400 + minutes[0] * 60
+                    if result is None or t < result:
+                        result = t
+                    break
+    _next_fire = result
+    return result
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only store for the run log.
+
+Log records (one json object per line, see helpers.log_line) are appended
+to numbered segment files in data/log/, oldest first within each file:
+
+    data/log/000001.json
+    data/log/000002.json    <- the last segment is the one appended to
+
+A new segment is started when the last one holds SEGMENT_RECORDS records,
+so logging a run costs one small append however long the log is. The
+record limit (gv.sd['lr'], 0 for none) is enforced by deleting whole
+segments from the oldest end once the newer ones hold at least the limit,
+and readers stop after the limit, so they see exactly the newest records.
+
+Readers iterate newest first, loading one segment at a time:
+
+    for record in run_log.records():
+        ...
+
+The first and last record date of each segment are kept in an index
+(data/log/index.json, with the record count and file size), so queries for
+a range of dates only read the segments that overlap it:
+
+    for record in run_log.records_between('2024-05-01', '2024-05-31'):
+        ...
+
+Pages of records for the log page are addressed by a cursor that stays
+valid while records are added (see page()).
+
+Segments whose size does not match the index (normally just the last one)
+are rescanned when the store is opened, and segments added or removed by
+another process (the engine process, see engine.py) are picked up before
+each read. Records without a 'date' field make their segment match every
+range.
+
+With the "Log database" option (gv.sd['ldb']) set, the module functions use
+the SQLite store of log_db.py instead.
+
+A data/log.json file from an earlier version (newest record first) is
+imported the first time the store is used.
+"""
+
+import ast
+import io
+import json
+import os
+import threading
+
+import gv
+
+LOG_DIR = './data/log'
+LEGACY_LOG = './data/log.json'
+INDEX = 'index.json'
+SEGMENT_RECORDS = 1000
+
+
+def parse(line):
+    """Return the record (a dictionary) stored in a log line."""
+    record = json.loads(line)
+    if not isinstance(record, dict):  # Records written by old versions as a quoted dict.
+        record = ast.literal_eval(record)
+    return record
+
+
+def record_date(line):
+    """Return the date ("yyyy-mm-dd") of the record in a log line, None if it has none."""
+    try:
+        return parse(line).get('date')
+    except (ValueError, SyntaxError):
+        return None
+
+
+def _extend(segment, date):
+    """Add a record date to a segment's date range."""
+    if date is None:
+        segment['dated'] = False
+    elif segment['count'] == 0 or segment['first'] is None:
+        segment['first'] = segment['last'] = date
+    else:
+        segment['first'] = min(segment['first'], date)
+        segment['last'] = max(segment['last'], date)
+
+
+def _new_segment(number):
+    return {'number': number, 'count': 0, 'size': 0, 'first': None, 'last': None, 'dated': True}
+
+
+class LogStore(object):
+    """
+    Segmented, append-only log in directory path.
+    """
+
+    def __init__(self, path=LOG_DIR, segment_records=SEGMENT_RECORDS):
+        self.path = path
+        self.segment_records = segment_records
+        self._lock = threading.RLock()
+        self._segments = None  # List of segment dictionaries (see _new_segment), oldest first. None until opened.
+
+    def _file(self, number):
+        return os.path.join(self.path, '{:06d}.json'.format(number))
+
+    def _open(self):
+        """Load the index and scan changed segment files on first use. Called with the lock held."""
+        if self._segments is not None:
+            self._refresh()
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        try:
+            with open(os.path.join(self.path, INDEX)) as f:
+                index = dict((segment['number'], segment) for segment in json.load(f))
+        except (IOError, ValueError, KeyError, TypeError):
+            index = {}
+        segments = []
+        changed = False
+        for name in os.listdir(self.path):
+            number, ext = os.path.splitext(name)
+            if ext != '.json' or not number.isdigit():
+                continue
+            number = int(number)
+            size = os.path.getsize(os.path.join(self.path, name))
+            segment = index.get(number)
+            if segment is None or segment.get('size') != size:
+                segment = self._scan(number)
+                changed = True
+            segments.append(segment)
+        segments.sort(key=lambda segment: segment['number'])
+        self._segments = segments
+        if not segments and os.path.exists(LEGACY_LOG):
+            self._import(LEGACY_LOG)
+            changed = True
+        if changed or len(index) != len(segments):
+            self._save_index()
+
+    def _refresh(self):
+        """Pick up segments appended to, started or deleted by another process. Called with the lock held."""
+        segments = self._segments
+        while segments and not os.path.exists(self._file(segments[0]['number'])):
+            del segments[0]
+        number = segments[-1]['number'] if segments else 0
+        if segments:
+            try:
+                if os.path.getsize(self._file(number)) != segments[-1]['size']:
+                    segments[-1] = self._scan(number)
+            except OSError:
+                pass
+        while os.path.exists(self._file(number + 1)):
+            number += 1
+            segments.append(self._scan(number))
+
+    def _scan(self, number):
+        segment = _new_segment(number)
+        with io.open(self._file(number), encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                _extend(segment, record_date(line[:-1]))
+                segment['count'] += 1
+                segment['size'] += len(line.encode('utf-8'))
+        return segment
+
+    def _save_index(self):
+        name = os.path.join(self.path, INDEX)
+        with open(name + '.tmp', 'w') as f:
+            json.dump(self._segments, f)
+        os.rename(name + '.tmp', name)
+
+    def _import(self, legacy):
+        with io.open(legacy, encoding='utf-8') as f:
+            lines = [line.rstrip('\n') for line in f if line.strip()]
+        for line in reversed(lines):  # The old file is newest first.
+            self._append(line)
+        os.rename(legacy, legacy + '.imported')
+
+    def _append(self, line):
+        """Append a line, returns True if a new segment was started."""
+        segments = self._segments
+        started = not segments or segments[-1]['count'] >= self.segment_records
+        if started:
+            segments.append(_new_segment(segments[-1]['number'] + 1 if segments else 1))
+        segment = segments[-1]
+        data = line + u'\n'
+        with io.open(self._file(segment['number']), 'a', encoding='utf-8') as f:
+            f.write(data)
+        _extend(segment, record_date(line))
+        segment['count'] += 1
+        segment['size'] += len(data.encode('utf-8'))
+        return started
+
+    def append(self, line):
+        """
+        Append a log line (json text without the newline) and drop segments beyond gv.sd['lr'].
+        """
+        if isinstance(line, str):
+            line = line.decode('utf-8')
+        with self._lock:
+            self._open()
+            started = self._append(line)
+            if self._trim(gv.sd['lr']) or started:
+                self._save_index()  # Closed segments do not change after this.
+
+    def _trim(self, limit):
+        """Delete the oldest segments that are not needed to hold limit records. Returns True if any were."""
+        if not limit:
+            return False
+        segments = self._segments
+        trimmed = False
+        while len(segments) > 1 and sum(segment['count'] for segment in segments[1:]) >= limit:
+            try:
+                os.remove(self._file(segments[0]['number']))
+            except OSError:
+                pass
+            del segments[0]
+            trimmed = True
+        return trimmed
+
+    def count(self):
+        """Return the number of records, up to the record limit."""
+        with self._lock:
+            self._open()
+            total = sum(segment['count'] for segment in self._segments)
+        limit = gv.sd['lr']
+        return min(total, limit) if limit else total
+
+    def _visible(self, limit):
+        """
+        Return a list of (segment, number of its newest records within limit), newest segment first.
+        """
+        if limit is None:
+            limit = gv.sd['lr']
+        with self._lock:
+            self._open()
+            segments = [dict(segment) for segment in self._segments]
+        result = []
+        for segment in reversed(segments):
+            n = segment['count']
+            if limit:
+                n = min(n, limit)
+                limit -= n
+                if not limit:
+                    result.append((segment, n))
+                    break
+            result.append((segment, n))
+        return result
+
+    def _read(self, number):
+        """Return the complete lines of a segment, oldest first."""
+        try:
+            with io.open(self._file(number), encoding='utf-8') as f:
+                lines = f.readlines()
+        except IOError:  # Removed since the list was taken.
+            return []
+        if lines and not lines[-1].endswith('\n'):  # Being appended.
+            lines.pop()
+        return lines
+
+    def _segment_lines(self, number, n):
+        """Return up to n complete lines of a segment, newest first."""
+        lines = self._read(number)
+        return [line[:-1] for line in reversed(lines[-n:])] if n else []
+
+    def lines(self, limit=None):
+        """
+        Iterate the log lines newest first, at most limit of them (default gv.sd['lr'], 0 for all).
+        """
+        for segment, n in self._visible(limit):
+            for line in self._segment_lines(segment['number'], n):
+                yield line
+
+    def records(self, limit=None):
+        """
+        Iterate the log records (dictionaries) newest first, see lines().
+        """
+        for line in self.lines(limit):
+            try:
+                yield parse(line)
+            except (ValueError, SyntaxError):
+                continue
+
+    def records_between(self, first, last, limit=None):
+        """
+        Iterate the records dated first to last ("yyyy-mm-dd", both included)
+        newest first, reading only the segments that hold such dates.
+        limit is the record limit as in lines().
+        """
+        for segment, n in self._visible(limit):
+            if segment['dated'] and (segment['first'] is None or segment['first'] > last
+                                     or segment['last'] < first):
+                continue
+            for line in self._segment_lines(segment['number'], n):
+                try:
+                    record = parse(line)
+                except (ValueError, SyntaxError):
+                    continue
+                if first <= record.get('date', first) <= last:
+                    yield record
+
+    def page(self, cursor=None, size=100, limit=None):
+        """
+        Return a page of up to size records, newest first, and the cursor of
+        the next page (None after the last page). cursor is None for the
+        first page. limit is the record limit as in lines().
+
+        A cursor ("segment.line") points below the last record returned, so
+        records added meanwhile do not shift the pages.
+        """
+        if cursor:
+            try:
+                number, end = [int(v) for v in cursor.split('.')]
+            except ValueError:
+                raise ValueError('bad cursor: {!r}'.format(cursor))
+        result = []
+        visible = self._visible(limit)
+        for i, (segment, n) in enumerate(visible):
+            if cursor and segment['number'] > number:
+                continue
+            lines = self._read(segment['number'])
+            low = segment['count'] - n  # Lines below low are beyond the record limit.
+            line = min(len(lines), segment['count'])
+            if cursor and segment['number'] == number:
+                line = min(line, end)
+            while line > low and len(result) < size:
+                line -= 1
+                try:
+                    result.append(parse(lines[line][:-1]))
+                except (ValueError, SyntaxError):
+                    continue
+            if len(result) >= size:
+                more = line > low or any(m for s, m in visible[i + 1:])
+                return result, '{}.{}'.format(segment['number'], line) if more else None
+        return result, None
+
+    def totals(self, first, last, station=None, program=None):
+        """
+        Return (runs, seconds) of the records dated first to last, of one station
+        (index from 0) and/or program if given.
+        """
+        runs = total = 0
+        for record in self.records_between(first, last):
+            if station is not None and record.get('station') != station:
+                continue
+            if program is not None and record.get('program') != program:
+                continue
+            runs += 1
+            total += seconds(record.get('duration'))
+        return runs, total
+
+    def clear(self):
+        """Delete all records."""
+        with self._lock:
+            self._open()
+            for segment in self._segments:
+                try:
+                    os.remove(self._file(segment['number']))
+                except OSError:
+                    pass
+            self._segments = []
+            self._save_index()
+
+
+def seconds(duration):
+    """Return the number of seconds in a duration string ("mm:ss" or "hh:mm:ss"), 0 if it is not one."""
+    total = 0
+    try:
+        for part in duration.split(':'):
+            total = total * 60 + int(part)
+    except (AttributeError, ValueError):
+        return 0
+    return total
+
+
+store = LogStore()
+_database = None
+
+
+def current():
+    """Return the store in use: the segment files, or the database if gv.sd['ldb'] is set."""
+    global _database
+    if not gv.sd['ldb']:
+        return store
+    if _database is None:
+        import log_db
+        _database = log_db.SqliteStore(source=store)
+    return _database
+
+
+def append(line):
+    current().append(line)
+
+
+def records(limit=None):
+    return current().records(limit)
+
+
+def records_between(first, last, limit=None):
+    return current().records_between(first, last, limit)
+
+
+def page(cursor=None, size=100, limit=None):
+    return current().page(cursor, size, limit)
+
+
+def count():
+    return current().count()
+
+
+def totals(first, last, station=None, program=None):
+    return current().totals(first, last, station, program)
+
+
+def clear():
+    current().clear()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Deadline queue used by the timing loop in sip.py.
+
+Rather than scanning every station once a second, the timing loop keeps the
+times at which something has to happen (a station or the master turning on
+or off, the end of a rain delay, the next time a program fires) in a priority queue
+and only does a full pass when the earliest of them is reached.
+
+Between deadlines the loop still wakes on each whole second to keep gv.now,
+gv.nowt and the remaining run times shown in the UI current, but that costs
+a couple of clock reads rather than a walk over all boards.
+
+Code that changes the run schedule from another thread (web pages, plugins)
+should call wake() so the timing loop re-plans at once instead of at the
+next deadline.
+
+The timing loop reads the time from scheduler.clock. Replacing it with a
+VirtualClock (see simulate.py) replays programs faster than real time.
+"""
+
+import errno
+import heapq
+import math
+import os
+import select
+import threading
+import time
+from calendar import timegm
+
+import gv
+import program_index
+
+# Kinds of deadline kept in the queue.
+STATION_ON = 'station_on'
+STATION_OFF = 'station_off'
+MASTER_ON = 'master_on'
+MASTER_OFF = 'master_off'
+PROGRAM_CHECK = 'program_check'
+RAIN_DELAY_END = 'rain_delay_end'
+RAIN_POLL = 'rain_poll'
+
+
+class DeadlineQueue(object):
+    """
+    Priority queue of (time, kind, station index) entries, earliest first.
+    """
+
+    def __init__(self):
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, when, kind, sid=None):
+        heapq.heappush(self._heap, (when, kind, sid))
+
+    def clear(self):
+        del self._heap[:]
+
+    def next_deadline(self):
+        """
+        Return the time of the earliest entry or None if the queue is empty.
+        """
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def pop_due(self, now):
+        """
+        Remove and return all entries whose time is at or before now.
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+        return due
+
+
+class Waker(object):
+    """
+    Lets other threads interrupt the timing loop while it sleeps.
+
+    On posix systems the loop blocks in select() on a pipe which wake() writes to.
+    Elsewhere threading.Event is used, which in Python 2 polls internally
+    while waiting with a timeout.
+    """
+
+    def __init__(self):
+        if os.name == 'posix':
+            import fcntl
+            self._rfd, self._wfd = os.pipe()
+            for fd in (self._rfd, self._wfd):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self._event = None
+        else:
+            self._rfd = self._wfd = None
+            self._event = threading.Event()
+
+    def wake(self):
+        if self._event is not None:
+            self._event.set()
+            return
+        try:
+            os.write(self._wfd, 'w')
+        except OSError:  # Pipe full, a wake up is already pending.
+            pass
+
+    def wait(self, timeout):
+        """
+        Block for up to timeout seconds.
+        Returns True if wake() was called, False on timeout.
+        """
+        if self._event is not None:
+            woken = self._event.wait(timeout)
+            self._event.clear()
+            return bool(woken)
+        try:
+            ready = select.select([self._rfd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        if not ready:
+            return False
+        try:
+            while os.read(self._rfd, 512):  # Drain all pending wake ups.
+                pass
+        except OSError:
+            pass
+        return True
+
+
+class SimulationEnd(Exception):
+    """Raised by VirtualClock when the end of the simulated period is reached."""
+    pass
+
+
+class RealClock(object):
+    """
+    Wall clock time. Waiting blocks until the timeout or a call to wake().
+    """
+
+    skip_idle_seconds = False  # Wake on each whole second to keep gv.now current.
+
+    def localtime(self):
+        return time.localtime()
+
+    def local_time(self):
+        """
+        Current time in the same frame as gv.now (local time expressed as a
+        UTC timestamp) but including the fraction of the current second.
+        """
+        t = time.time()
+        return timegm(time.localtime(t)) + (t % 1)
+
+    def wait(self, timeout):
+        return waker.wait(timeout)
+
+
+class VirtualClock(object):
+    """
+    Simulated clock running from start to end (timestamps in the gv.now frame).
+
+    Waiting moves the clock straight to the next deadline instead of sleeping,
+    skipping the once a second display updates in between, and raises
+    SimulationEnd when the end is reached.
+    """
+
+    skip_idle_seconds = True
+
+    def __init__(self, start, end):
+        self.now = start
+        self.end = end
+
+    def localtime(self):
+        return time.gmtime(self.now)
+
+    def local_time(self):
+        return self.now
+
+    def wait(self, timeout):
+        if waker.wait(0):  # Schedule changed during the last pass.
+            return True
+        if timeout is None:
+            self.now = self.end
+        else:
+            self.now = int(math.ceil(self.now + timeout))  # gv.now only has whole seconds.
+        if self.now >= self.end:
+            raise SimulationEnd()
+        return False
+
+
+deadlines = DeadlineQueue()
+waker = Waker()
+clock = RealClock()
+_woken = True  # Force a full pass on the first iteration of the timing loop.
+_planned_bsy = 0
+wake_target = None  # Time sleep() last planned to wake at, None if it waited for wake().
+engine_link = None  # Set by engine.start() in the web process to send changes to the engine process.
+rain_polled = True  # Cleared by helpers.check_rain() when the rain sensor input is edge triggered.
+checked_minute = None  # gv.now / 60 of the timing loop's last program check.
+
+
+def wake():
+    """
+    Make the timing loop re-evaluate the schedule immediately.
+    Call after changing gv.rs, gv.sd or gv.pd from outside the timing loop.
+    """
+    if engine_link is not None:
+        engine_link()
+    waker.wake()
+
+
+def due(now):
+    """
+    Return True if the timing loop should do a full pass at time now.
+    Consumes the deadlines that have been reached.
+    """
+    global _woken
+    expired = deadlines.pop_due(now)
+    if _woken:
+        _woken = False
+        return True
+    if gv.sd['bsy'] != _planned_bsy:  # Stations scheduled without calling wake().
+        return True
+    return bool(expired)
+
+
+def plan():
+    """
+    Rebuild the deadline queue from the run schedule (gv.rs) and settings.
+    Called by the timing loop at the end of every full pass.
+    """
+    global _planned_bsy
+    now = gv.now
+    deadlines.clear()
+    fire = program_index.next_fire(now)
+    if fire is not None:
+        deadlines.push(fire, PROGRAM_CHECK)
+    if (checked_minute != now / 60 and gv.sd['en'] and not gv.sd['mm']
+            and not (gv.sd['bsy'] and gv.sd['seq']) and program_index.matches(now)):
+        # The check of this minute was skipped while a sequence ran and it has just ended.
+        deadlines.push(now, PROGRAM_CHECK)
+    if gv.sd['rd'] and gv.sd['rdst']:
+        deadlines.push(gv.sd['rdst'], RAIN_DELAY_END)
+    if gv.sd['urs'] and rain_polled:
+        deadlines.push(now + 1, RAIN_POLL)
+    if gv.sd['bsy']:
+        masid = gv.sd['mas'] - 1
+        state = gv.stations
+        for sid in state.scheduled():
+            stop = state.stop[sid]
+            if not stop:
+                continue  # Not scheduled.
+            start = state.start[sid]
+            if state.is_on(sid):
+                deadlines.push(stop, MASTER_OFF if sid == masid else STATION_OFF, sid)
+            elif stop > now:  # A master scheduled late in a pass may already be due.
+                deadlines.push(max(start, now), MASTER_ON if sid == masid else STATION_ON, sid)
+    _planned_bsy = gv.sd['bsy']
+
+
+def reset():
+    """
+    Forget the planned deadlines and force a full pass on the next iteration.
+    """
+    global _woken, _planned_bsy
+    deadlines.clear()
+    _woken = True
+    _planned_bsy = 0
+
+
+def sleep():
+    """
+    Sleep until the next whole second, the next deadline or a call to wake(),
+    whichever comes first.
+    """
+    global _woken, wake_target
+    current = clock.local_time()
+    target = deadlines.next_deadline()
+    if not clock.skip_idle_seconds:
+        second = int(current) + 1
+        if target is None or second < target:
+            target = second
+    if target is None:
+        timeout = None  # Nothing planned, wait for wake().
+    else:
+        timeout = max(0, target - current)
+    wake_target = target
+    if clock.wait(timeout):
+        _woken = True
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Shift register outputs that send a whole frame in one call.
+
+gpio_pins.setShiftRegister() clocks a frame out one bit at a time with
+separate gp_write calls on the data, clock and latch pins, about four per
+station. With the pigpio library every call is a round trip to pigpiod, so
+a 64 board refresh takes hundreds of milliseconds. The outputs here build
+the frame up front and commit it at once:
+
+    WaveOutput  one pigpio waveform holding the data, clock and latch pulses,
+                played by pigpiod (about a microsecond per pulse).
+    SpiOutput   one spidev transfer, for shift registers wired to the SPI
+                pins (MOSI to data, SCLK to clock, CE0 to latch).
+
+gpio_pins.setup_pins() selects one of them and falls back to
+setShiftRegister() if it is not available or fails.
+
+A frame is a list of output values, one per station, station 1 first. As
+with setShiftRegister() the last station is shifted out first.
+"""
+
+import time
+
+PULSE_US = 1  # Length of each level of the clock, in microseconds.
+MAX_ADD_PULSES = 2000  # Pulses per wave_add_generic() call, to keep socket messages small.
+
+
+class WaveOutput(object):
+    """
+    Shift register output through a pigpio waveform.
+
+    @type pigpio: module
+    @param pigpio: the pigpio module (or a fake with the same interface)
+    @type pi: pigpio.pi
+    @param pi: connection to pigpiod
+    @param dat, clk, lat: Broadcom gpio numbers of the data, clock and latch pins
+    """
+
+    def __init__(self, pigpio, pi, dat, clk, lat):
+        self.pigpio = pigpio
+        self.pi = pi
+        self.dat = 1 << dat
+        self.clk = 1 << clk
+        self.lat = 1 << lat
+
+    def pulses(self, frame):
+        """Return the list of pigpio pulses that shift out and latch frame."""
+        pulse = self.pigpio.pulse
+        dat, clk, lat = self.dat, self.clk, self.lat
+        pulses = [pulse(0, clk | lat, PULSE_US)]
+        for value in reversed(frame):
+            if value:
+                pulses.append(pulse(dat, clk, PULSE_US))  # Data high, clock low.
+            else:
+                pulses.append(pulse(0, clk | dat, PULSE_US))  # Data low, clock low.
+            pulses.append(pulse(clk, 0, PULSE_US))  # Rising clock shifts the bit in.
+        pulses.append(pulse(lat, 0, PULSE_US))  # Rising latch sets the outputs.
+        return pulses
+
+    def write(self, frame):
+        pi = self.pi
+        pulses = self.pulses(frame)
+        pi.wave_clear()
+        for i in range(0, len(pulses), MAX_ADD_PULSES):
+            pi.wave_add_generic(pulses[i:i + MAX_ADD_PULSES])
+        wid = pi.wave_create()
+        try:
+            pi.wave_send_once(wid)
+            time.sleep(len(pulses) * PULSE_US / 1e6)  # Let the wave play before polling.
+            while pi.wave_tx_busy():
+                time.sleep(0.0001)
+        finally:
+            pi.wave_delete(wid)
+
+
+def frame_bytes(frame):
+    """
+    Return frame packed into bytes in shift order: the byte of the last
+    board first, most significant bit (highest station of the board) first.
+    """
+    nbytes = (len(frame) + 7) / 8
+    frame = list(frame) + [0] * (nbytes * 8 - len(frame))
+    data = []
+    for b in reversed(range(nbytes)):
+        byte = 0
+        for s in reversed(range(8)):
+            byte = byte << 1 | (1 if frame[b * 8 + s] else 0)
+        data.append(byte)
+    return data
+
+
+class SpiOutput(object):
+    """
+    Shift register output through an SPI transfer.
+
+    @type spi: spidev.SpiDev
+    @param spi: open SPI device, see open_spi()
+    """
+
+    def __init__(self, spi):
+        self.spi = spi
+
+    def write(self, frame):
+        self.spi.xfer2(frame_bytes(frame))  # Chip enable rises at the end, latching the outputs.
+
+
+def open_spi(bus=0, device=0, speed=1000000, spidev=None):
+    """
+    Open SPI device /dev/spidev<bus>.<device> for SpiOutput.
+    Raises ImportError if spidev is not installed, IOError if the device does not exist.
+    """
+    if spidev is None:
+        import spidev
+    spi = spidev.SpiDev()
+    spi.open(bus, device)
+    spi.max_speed_hz = speed
+    spi.mode = 0
+    return spi
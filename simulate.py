@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Replay the programs in data/programs.json against a simulated clock.
+
+The timing loop from sip.py runs with a scheduler.VirtualClock, jumping from
+one deadline to the next, so a year of programs takes seconds. GPIO output is
+disabled and nothing is written to the data directory. The log records
+the run would produce and the sequence of zone changes are written out.
+
+Usage:
+    python simulate.py [-d DAYS] [-s YYYY-MM-DD] [-l LOG_FILE] [-z ZONE_FILE]
+"""
+
+import i18n
+
+import argparse
+import calendar
+import json
+import sys
+import time
+from blinker import signal
+
+import dispatch
+import gv
+import helpers
+import scheduler
+import sip
+
+
+def simulate(start, days):
+    """
+    Run the timing loop from start (a timestamp in the gv.now frame) for a number of days.
+
+    @rtype: tuple
+    @return: list of log records (dictionaries, oldest first) and
+        list of (time, station values) for each zone change.
+    """
+    records = []
+    zones = []
+
+    @dispatch.synchronous
+    def on_completed(station, **kw):
+        line = helpers.log_line()
+        if line is not None:
+            records.append(json.loads(line))
+
+    @dispatch.synchronous
+    def on_zone_change(name, **kw):
+        zones.append((gv.now, list(gv.output_srvals)))
+
+    signal('station_completed').connect(on_completed)
+    signal('zone_change').connect(on_zone_change)
+
+    gv.use_gpio_pins = False  # Never touch hardware.
+    gv.sd['lg'] = 0  # Records are collected from the signal instead of the log file.
+    gv.sd['urs'] = 0  # Rain sensor is not simulated.
+    gv.sd['rd'] = 0  # Expiring rain delay would save settings.
+    gv.sd['rdst'] = 0
+    gv.sd['mm'] = 0
+    helpers.stop_stations()
+    del zones[:]
+
+    scheduler.clock = scheduler.VirtualClock(start, start + days * 86400)
+    scheduler.reset()
+    try:
+        sip.timing_loop()
+    except scheduler.SimulationEnd:
+        pass
+    finally:
+        scheduler.clock = scheduler.RealClock()
+        signal('station_completed').disconnect(on_completed)
+        signal('zone_change').disconnect(on_zone_change)
+    return records, zones
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay SIP programs against a simulated clock.')
+    parser.add_argument('-d', '--days', type=int, default=365, help='number of days to simulate')
+    parser.add_argument('-s', '--start', help='first day (YYYY-MM-DD), default today')
+    parser.add_argument('-l', '--log', help='write log records (json lines, oldest first) to this file')
+    parser.add_argument('-z', '--zones', help='write zone changes (time, station values) to this file')
+    args = parser.parse_args()
+
+    if args.start:
+        start = calendar.timegm(time.strptime(args.start, '%Y-%m-%d'))
+    else:
+        start = calendar.timegm(time.localtime()) / 86400 * 86400
+
+    began = time.time()
+    records, zones = simulate(start, args.days)
+    elapsed = time.time() - began
+
+    if args.log:
+        with open(args.log, 'w') as f:
+            for r in records:
+                f.write(json.dumps(r) + '\n')
+    if args.zones:
+        with open(args.zones, 'w') as f:
+            for t, vals in zones:
+                f.write(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t)) + ' ' + ''.join(str(v) for v in vals) + '\n')
+    print '{} days simulated in {:.2f} s: {} log records, {} zone changes'.format(
+        args.days, elapsed, len(records), len(zones))
+
+
+if __name__ == '__main__':
+    main()
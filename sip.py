@@ -1,14 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import sys
+import startup_profile
+if '--profile-startup' in sys.argv:  # Time the imports and plugin loads that follow.
+    sys.argv.remove('--profile-startup')
+    startup_profile.start()
+
 import i18n
 import subprocess
 import json
 import ast
 import time
 import thread
+from bisect import insort
 from calendar import timegm
-import sys
 sys.path.append('./plugins')
 
 import web  # the Web.py module. See webpy.org (Enables the Python SIP web interface)
@@ -17,7 +23,6 @@ import gv
 from helpers import (
                      report_station_completed, 
                      plugin_adjustment, 
-                     prog_match, 
                      schedule_stations, 
                      log_run, 
                      stop_onrain, 
@@ -27,8 +32,22 @@ from helpers import (
                      get_rpi_revision
                      )
 from urls import urls  # Provides access to URLs for UI pages
-from gpio_pins import set_output
+from gpio_pins import set_output, hold_output, release_output
 from ReverseProxied import ReverseProxied
+import scheduler
+import program_index
+import tick_stats
+import engine
+import control
+import snapshot
+import persist
+from station_state import adopt_replaced_views
+
+# Calls from the timing loop are added to the phase times in tick_stats.
+set_output = tick_stats.timed('set_output', set_output)
+release_output = tick_stats.timed('set_output', release_output)
+log_run = tick_stats.timed('log_run', log_run)
+jsave = tick_stats.timed('jsave', jsave)
 
 # do not call set output until plugins are loaded because it should NOT be called
 # if gv.use_gpio_pins is False (which is set in relay board plugin.
@@ -42,156 +61,175 @@ def timing_loop():
         print _('Starting timing loop') + '\n'
     except Exception:
         pass
-    last_min = 0
+    scheduler.checked_minute = None
     while True:  # infinite loop
-        gv.nowt = time.localtime()   # Current time as time struct.  Updated once per second.
+        gv.nowt = scheduler.clock.localtime()   # Current time as time struct.  Updated once per second.
         gv.now = timegm(gv.nowt)   # Current time as timestamp based on local time from the Pi. Updated once per second.
+        tick_stats.begin(scheduler.wake_target, scheduler.clock.local_time())
+        hold_output()  # One hardware write per pass.
+        changed = engine.apply_pending()  # Changes from the web process if running as a separate engine.
+        changed = control.apply_pending() or changed  # Commands from web pages and plugins.
+        changed = adopt_replaced_views(gv) or changed  # gv.srvals, gv.rs or gv.ps replaced by a plugin.
+        if not scheduler.due(gv.now) and not changed:  # Nothing to switch, just keep the display current.
+            if gv.sd['bsy']:
+                update_remaining()
+            release_output()
+            tick_stats.end()
+            engine.publish()
+            snapshot.publish()
+            control.complete()
+            scheduler.sleep()
+            continue
+        tick_stats.full_pass()
+
+        started = time.time()
         if (gv.sd['en'] 
             and not gv.sd['mm'] 
             and (not gv.sd['bsy'] or not gv.sd['seq'])
             ):
-            if gv.now / 60 != last_min:  # only check programs once a minute
-                last_min = gv.now / 60
+            if gv.now / 60 != scheduler.checked_minute:  # only check programs once a minute
+                scheduler.checked_minute = gv.now / 60
                 extra_adjustment = plugin_adjustment()
-                for i, p in enumerate(gv.pd):  # get both index and prog item
-                    # check if program time matches current time, is active, and has a duration
-                    if prog_match(p) and p[0] and p[6]:
-                        # check each station for boards listed in program up to number of boards in Options
-                        for b in range(len(p[7:7 + gv.sd['nbrd']])):
-                            for s in range(8):
-                                sid = b * 8 + s  # station index
-                                if gv.sd['mas'] == sid + 1:
-                                    continue  # skip if this is master station
-                                if gv.srvals[sid] and gv.sd['seq']:  # skip if currently on and sequential mode
-                                    continue
-
-                                # station duration conditionally scaled by "water level"
-                                if gv.sd['iw'][b] & 1 << s:
-                                    duration_adj = 1.0
-                                    if gv.sd['idd'] == 1:
-                                        duration = p[-1][sid]
-                                    else:
-                                        duration = p[6]
+                # programs that are enabled, have a duration and fire this minute
+                for i in program_index.matches(gv.now):
+                    p = gv.pd[i]
+                    # check each station for boards listed in program up to number of boards in Options
+                    for b in range(len(p[7:7 + gv.sd['nbrd']])):
+                        for s in range(8):
+                            sid = b * 8 + s  # station index
+                            if gv.sd['mas'] == sid + 1:
+                                continue  # skip if this is master station
+                            if gv.srvals[sid] and gv.sd['seq']:  # skip if currently on and sequential mode
+                                continue
+
+                            # station duration conditionally scaled by "water level"
+                            if gv.sd['iw'][b] & 1 << s:
+                                duration_adj = 1.0
+                                if gv.sd['idd'] == 1:
+                                    duration = p[-1][sid]
                                 else:
-                                    duration_adj = (float(gv.sd['wl']) / 100) * extra_adjustment
-                                    if gv.sd['idd'] == 1:
-                                        duration = p[-1][sid] * duration_adj
-                                    else:
-                                        duration = p[6] * duration_adj
-                                    duration = int(round(duration)) # convert to int
-                                if p[7 + b] & 1 << s:  # if this station is scheduled in this program
-                                    if gv.sd['seq']:  # sequential mode
-                                        gv.rs[sid][2] = duration
-                                        gv.rs[sid][3] = i + 1  # store program number for scheduling
-                                        gv.ps[sid][0] = i + 1  # store program number for display
-                                        gv.ps[sid][1] = duration
-                                    else:  # concurrent mode
-                                        if gv.srvals[sid]:  # if currently on, log result
-                                            gv.lrun[0] = sid
-                                            gv.lrun[1] = gv.rs[sid][3]
-                                            gv.lrun[2] = int(gv.now - gv.rs[sid][0])
-                                            gv.lrun[3] = gv.now     # think this is unused
-                                            log_run()
-                                            report_station_completed(sid + 1)
-                                        gv.rs[sid][2] = duration
-                                        gv.rs[sid][3] = i + 1  # store program number
-                                        gv.ps[sid][0] = i + 1  # store program number for display
-                                        gv.ps[sid][1] = duration
-                        schedule_stations(p[7:7 + gv.sd['nbrd']])  # turns on gv.sd['bsy']
-
+                                    duration = p[6]
+                            else:
+                                duration_adj = (float(gv.sd['wl']) / 100) * extra_adjustment
+                                if gv.sd['idd'] == 1:
+                                    duration = p[-1][sid] * duration_adj
+                                else:
+                                    duration = p[6] * duration_adj
+                                duration = int(round(duration)) # convert to int
+                            if p[7 + b] & 1 << s:  # if this station is scheduled in this program
+                                if gv.sd['seq']:  # sequential mode
+                                    gv.rs[sid][2] = duration
+                                    gv.rs[sid][3] = i + 1  # store program number for scheduling
+                                    gv.ps[sid][0] = i + 1  # store program number for display
+                                    gv.ps[sid][1] = duration
+                                else:  # concurrent mode
+                                    if gv.srvals[sid]:  # if currently on, log result
+                                        gv.lrun[0] = sid
+                                        gv.lrun[1] = gv.rs[sid][3]
+                                        gv.lrun[2] = int(gv.now - gv.rs[sid][0])
+                                        gv.lrun[3] = gv.now     # think this is unused
+                                        log_run()
+                                        report_station_completed(sid + 1)
+                                    gv.rs[sid][2] = duration
+                                    gv.rs[sid][3] = i + 1  # store program number
+                                    gv.ps[sid][0] = i + 1  # store program number for display
+                                    gv.ps[sid][1] = duration
+                    schedule_stations(p[7:7 + gv.sd['nbrd']])  # turns on gv.sd['bsy']
+        tick_stats.add('programs', time.time() - started)
+
+        started = time.time()
         if gv.sd['bsy']:
-            for b in range(gv.sd['nbrd']):  # Check each station once a second
-                for s in range(8):
-                    sid = b * 8 + s  # station index
-                    if gv.srvals[sid]:  # if this station is on
-                        if gv.now >= gv.rs[sid][1]:  # check if time is up                            
-                            gv.srvals[sid] = 0
+            masid = gv.sd['mas'] - 1  # master index
+            pending = gv.stations.scheduled()  # Only stations that are on or scheduled
+            for sid in pending:
+                b, s = divmod(sid, 8)  # board and bit of station
+                if gv.srvals[sid]:  # if this station is on
+                    if gv.now >= gv.rs[sid][1]:  # check if time is up
+                        gv.srvals[sid] = 0
+                        set_output()
+                        if gv.sd['mas'] != sid +1 :  # if not master, fill out log
+                            gv.ps[sid] = [0, 0]
+                            gv.lrun[0] = sid
+                            gv.lrun[1] = gv.rs[sid][3]
+                            gv.lrun[2] = int(gv.now - gv.rs[sid][0])
+                            gv.lrun[3] = gv.now
+                            log_run()
+                            report_station_completed(sid + 1)
+                            gv.pon = None  # Program has ended
+                        gv.rs[sid] = [0, 0, 0, 0]
+                else:  # if this station is not yet on
+                    if gv.rs[sid][0] <= gv.now < gv.rs[sid][1]:
+                        if gv.sd['mas'] != sid + 1 :  # if not master
+                            gv.srvals[sid] = 1  # station is turned on
+                            set_output()  # gv.sbits follows gv.srvals
+                            gv.ps[sid][0] = gv.rs[sid][3]
+                            gv.ps[sid][1] = gv.rs[sid][2]
+                            if gv.sd['mas'] and gv.sd['mo'][b] & (1 << s):  # Master settings
+                                gv.rs[masid][0] = gv.rs[sid][0] + gv.sd['mton']
+                                gv.rs[masid][1] = gv.rs[sid][1] + gv.sd['mtoff']
+                                gv.rs[masid][3] = gv.rs[sid][3]
+                                if masid > sid and masid not in pending:
+                                    insort(pending, masid)  # Check the master later in this pass
+                        elif gv.sd['mas'] == sid + 1:
+                            gv.srvals[masid] = 1
                             set_output()
-                            gv.sbits[b] &= ~(1 << s)
-                            if gv.sd['mas'] != sid +1 :  # if not master, fill out log
-                                gv.ps[sid] = [0, 0]
-                                gv.lrun[0] = sid
-                                gv.lrun[1] = gv.rs[sid][3]
-                                gv.lrun[2] = int(gv.now - gv.rs[sid][0])
-                                gv.lrun[3] = gv.now
-                                log_run()
-                                report_station_completed(sid + 1)
-                                gv.pon = None  # Program has ended
-                            gv.rs[sid] = [0, 0, 0, 0]
-                    else:  # if this station is not yet on
-                        if gv.rs[sid][0] <= gv.now < gv.rs[sid][1]:
-                            if gv.sd['mas'] != sid + 1 :  # if not master
-                                gv.srvals[sid] = 1  # station is turned on
-                                set_output()
-                                gv.sbits[b] |= 1 << s  # Set display to on
-                                gv.ps[sid][0] = gv.rs[sid][3]
-                                gv.ps[sid][1] = gv.rs[sid][2]
-                                if gv.sd['mas'] and gv.sd['mo'][b] & (1 << s):  # Master settings
-                                    masid = gv.sd['mas'] - 1  # master index
-                                    gv.rs[masid][0] = gv.rs[sid][0] + gv.sd['mton']
-                                    gv.rs[masid][1] = gv.rs[sid][1] + gv.sd['mtoff']
-                                    gv.rs[masid][3] = gv.rs[sid][3]
-                            elif gv.sd['mas'] == sid + 1:
-                                gv.sbits[b] |= 1 << sid
-                                gv.srvals[masid] = 1
-                                set_output()
-
-            for s in range(gv.sd['nst']):
-                if gv.rs[s][1]:  # if any station is scheduled
-                    program_running = True
-                    gv.pon = gv.rs[s][3]  # Store number of running program
-                    break
-                program_running = False
-                gv.pon = None
+
+            first = gv.stations.first_scheduled()
+            program_running = first is not None  # if any station is scheduled
+            gv.pon = gv.rs[first][3] if program_running else None  # Store number of running program
 
             if program_running:
                 if gv.sd['urs'] and gv.sd['rs']:  #  Stop stations if use rain sensor and rain detected.
                     stop_onrain()  # Clear schedule for stations that do not ignore rain.
-                for sid in range(len(gv.rs)):  # loop through program schedule (gv.ps)
-                    if gv.rs[sid][2] == 0:  # skip stations with no duration
-                        continue
-                    if gv.srvals[sid]:  # If station is on, decrement time remaining display
-                        if gv.ps[sid][1] > 0:   # if time is left
-                            gv.ps[sid][1] -= 1
+                update_remaining()
 
             if not program_running:
-                gv.srvals = [0] * (gv.sd['nst'])
+                gv.stations.clear()
                 set_output()
-                gv.sbits = [0] * (gv.sd['nbrd'] + 1)
-                gv.ps = []
-                for i in range(gv.sd['nst']):
-                    gv.ps.append([0, 0])
-                gv.rs = []
-                for i in range(gv.sd['nst']):
-                    gv.rs.append([0, 0, 0, 0])
                 gv.sd['bsy'] = 0
 
             if (gv.sd['mas'] #  master is defined
                 and (gv.sd['mm'] or not gv.sd['seq']) #  manual or concurrent mode.
                 ):
-                for b in range(gv.sd['nbrd']):  # set stop time for master
-                    for s in range(8):
-                        sid = b * 8 + s
-                        if (gv.sd['mas'] != sid + 1  # if not master
-                            and gv.srvals[sid] #  station is on
-                            and gv.rs[sid][1] >= gv.now #  station has a stop time >= now
-                            and gv.sd['mo'][b] & (1 << s) #  station activates master   
-                            ):                  
-                            gv.rs[gv.sd['mas'] - 1][1] = gv.rs[sid][1] + gv.sd['mtoff'] # set to future...
-                            break # first found will do
+                for sid in gv.stations.on_stations():  # set stop time for master
+                    b, s = divmod(sid, 8)
+                    if (gv.sd['mas'] != sid + 1  # if not master
+                        and gv.rs[sid][1] >= gv.now #  station has a stop time >= now
+                        and gv.sd['mo'][b] & (1 << s) #  station activates master
+                        ):
+                        gv.rs[gv.sd['mas'] - 1][1] = gv.rs[sid][1] + gv.sd['mtoff'] # set to future...
+                        break # first found will do
+        tick_stats.add('stations', time.time() - started)
 
         if gv.sd['urs']:
-            check_rain()  # in helpers.py
+            with tick_stats.phase('check_rain'):
+                check_rain()  # in helpers.py
 
         if gv.sd['rd'] and gv.now >= gv.sd['rdst']:  # Check if rain delay time is up
             gv.sd['rd'] = 0
             gv.sd['rdst'] = 0  # Rain delay stop time
             jsave(gv.sd, 'sd')        
 
-        time.sleep(1)
+        scheduler.plan()
+        release_output()
+        tick_stats.end()
+        engine.publish()
+        snapshot.publish()
+        control.complete()
+        scheduler.sleep()
         #### End of timing loop ####
 
 
+def update_remaining():
+    """Update the time remaining shown for stations that are on (gv.ps)."""
+    state = gv.stations
+    for sid in state.on_stations():  # loop through program schedule (gv.ps)
+        if state.duration[sid] == 0:  # skip stations with no duration
+            continue
+        if state.remaining[sid] > 0:   # if time is left, count down time remaining display
+            state.remaining[sid] = max(0, state.stop[sid] - gv.now)
+
+
 class SIPApp(web.application):
     """Allow program to select HTTP port."""
 
@@ -216,6 +254,7 @@ template_globals = {
     'ast': ast,
     '_': _,
     'i18n': i18n,
+    'snapshot': snapshot,
     'app_path': lambda p: web.ctx.homepath + p,
     'web': web,
 }
@@ -245,14 +284,22 @@ def sip_begin():
     except Exception:
         pass
     
-    thread.start_new_thread(timing_loop, ())
+    persist.flush_on_exit()
+
+    with startup_profile.span('timing loop'):
+        if gv.sd['eng']:
+            engine.start()  # Timing loop and outputs in a separate process.
+        else:
+            thread.start_new_thread(timing_loop, ())
 
     if gv.use_gpio_pins:
-        set_output()    
+        with startup_profile.span('set_output'):
+            set_output()    
 
 
     app.notfound = lambda: web.seeother('/')
 
+    startup_profile.finish()
     app.run()
 
 
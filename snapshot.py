@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Immutable, versioned snapshots of the controller state for readers.
+
+The timing loop publishes a new Snapshot at the end of a pass whenever the
+station state, the settings, the running program or the last run changed.
+Readers take one reference with current() and render everything from it,
+so they never see a station on in one field and off in another:
+
+    snap = snapshot.current()
+    if snap.sbits[b] & 1 << s: ...
+
+The time remaining of running stations is not part of the published state,
+which would make every second a new snapshot; snap.ps counts it down from
+the stop times to gv.now when it is read. Station names are changed by web
+pages rather than the timing loop, so current() publishes a new snapshot
+when they differ from the latest one.
+
+The version increases by one with every published snapshot, and etag()
+combines it with the start up time (and the current second while stations
+are counting down), so web pages can answer repeated polls with 304 Not
+Modified (see not_modified()).
+"""
+
+from collections import namedtuple
+import copy
+import threading
+import time
+
+import web
+
+import gv
+from station_state import _num
+
+
+
+class Snapshot(namedtuple('Snapshot', [
+    'version',  # increases with every published snapshot
+    'now',  # gv.now when published
+    'sd',  # copy of gv.sd, do not modify
+    'nst',
+    'srvals',  # tuple, 1 if station is on
+    'sbits',  # tuple, one byte per board
+    'program',  # tuple, program number shown per station
+    'remaining',  # tuple, time remaining per station when published, see ps
+    'counting',  # tuple of the stations whose time remaining counts down
+    'rs',  # tuple of (start, stop, duration, program number) per station
+    'pon',
+    'lrun',
+    'snames',  # tuple of station names
+])):
+    __slots__ = ()
+
+    @property
+    def ps(self):
+        """Tuple of (program number, time remaining) per station, as gv.ps, counted down to gv.now."""
+        remaining = list(self.remaining)
+        now = gv.now
+        for sid in self.counting:
+            remaining[sid] = max(0, self.rs[sid][1] - now)
+        return tuple(zip(self.program, remaining))
+
+
+_started = int(time.time())
+_lock = threading.Lock()
+_current = None
+_key = None
+
+
+def _state_key():
+    state = gv.stations
+    return (state.generation, gv.pon, tuple(gv.lrun))
+
+
+def publish():
+    """
+    Publish a new snapshot if anything changed since the last one.
+    Called by the timing loop at the end of every pass.
+    """
+    global _current, _key
+    key = _state_key()
+    snap = _current
+    if snap is not None and key == _key and gv.sd == snap.sd:  # Nothing to publish, most passes.
+        return snap
+    with _lock:
+        state = gv.stations
+        nst = state.nst
+        sd = _current.sd if _current is not None and gv.sd == _current.sd else copy.deepcopy(gv.sd)
+        _current = Snapshot(
+            version=_current.version + 1 if _current is not None else 1,
+            now=gv.now,
+            sd=sd,
+            nst=nst,
+            srvals=tuple(state.is_on(sid) for sid in xrange(nst)),
+            sbits=tuple(state.board_bits(b) for b in xrange((nst + 7) / 8 + 1)),
+            program=tuple(state.display_program),
+            remaining=tuple(map(_num, state.remaining)),
+            counting=tuple(sid for sid in state.on_stations() if state.duration[sid] != 0 and state.remaining[sid] > 0),
+            rs=tuple(zip(map(_num, state.start), map(_num, state.stop), map(_num, state.duration), state.program)),
+            pon=gv.pon,
+            lrun=tuple(gv.lrun),
+            snames=tuple(gv.snames),
+        )
+        _key = key
+        return _current
+
+
+def current():
+    """Return the latest snapshot, with the current station names."""
+    global _current
+    if _current is None:
+        return publish()
+    names = tuple(gv.snames)
+    if names != _current.snames:
+        with _lock:
+            if names != _current.snames:
+                _current = _current._replace(version=_current.version + 1, snames=names)
+    return _current
+
+
+def etag(snap=None):
+    """Return the HTTP entity tag of a snapshot (default the latest)."""
+    if snap is None:
+        snap = current()
+    if snap.counting:  # snap.ps changes every second.
+        return '"{}-{}-{}"'.format(_started, snap.version, gv.now)
+    return '"{}-{}"'.format(_started, snap.version)
+
+
+def not_modified(snap):
+    """
+    Set the ETag header for snap and raise 304 Not Modified if the client already has it.
+    """
+    tag = etag(snap)
+    web.header('ETag', tag)
+    if web.ctx.env.get('HTTP_IF_NONE_MATCH') == tag:
+        raise web.notmodified()
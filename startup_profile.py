@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Startup profiler: wall and CPU time of every module import and plugin load.
+
+    python sip.py --profile-startup
+
+replaces __import__ with a timed copy before anything else is imported, and
+when sip_begin() is about to start the web server writes:
+
+    data/startup_profile.txt    plugins by load time, and modules by the time
+                                spent in their own code (nested imports excluded)
+    data/startup_trace.json     all imports, plugin loads and startup steps in
+                                Chrome trace format, for chrome://tracing or
+                                https://ui.perfetto.dev
+
+Only imports that load a module are recorded. CPU time is that of the whole
+process (os.times), so it includes threads started meanwhile.
+
+Code that may be slow at startup can be timed as a step with span():
+
+    with startup_profile.span('set_output'):
+        set_output()
+
+which costs nothing when the profiler is not running.
+"""
+
+import __builtin__
+from contextlib import contextmanager
+import json
+import os
+import sys
+import thread
+import time
+
+REPORT = './data/startup_profile.txt'
+TRACE = './data/startup_trace.json'
+TOP = 40  # Modules listed in the report.
+
+_original_import = __builtin__.__import__
+_events = None  # Closed events while profiling, None when not.
+_stacks = {}  # Thread id -> events not yet closed.
+_origin = 0.0
+
+
+def _cpu():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _open(name, category, by=None):
+    event = {'name': name, 'cat': category, 'by': by, 'tid': thread.get_ident(),
+             'start': time.time(), 'start_cpu': _cpu(), 'nested': 0.0, 'nested_cpu': 0.0}
+    _stacks.setdefault(event['tid'], []).append(event)
+    return event
+
+
+def _close(event, keep=True):
+    wall = time.time() - event['start']
+    cpu = _cpu() - event['start_cpu']
+    stack = _stacks[event['tid']]
+    stack.pop()
+    if not keep or _events is None:
+        return
+    event['wall'] = wall
+    event['cpu'] = cpu
+    if stack:
+        stack[-1]['nested'] += wall
+        stack[-1]['nested_cpu'] += cpu
+    _events.append(event)
+
+
+def _profiled_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    if _events is None:
+        return _original_import(name, globals, locals, fromlist, level)
+    loaded = len(sys.modules)
+    by = globals.get('__name__') if globals else None
+    event = _open(name or '.' + ','.join(fromlist or []), 'import', by)
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _close(event, len(sys.modules) > loaded)
+
+
+def start():
+    """Start recording imports and spans."""
+    global _events, _origin
+    _events = []
+    _origin = time.time()
+    __builtin__.__import__ = _profiled_import
+
+
+def running():
+    return _events is not None
+
+
+@contextmanager
+def span(name, category='startup'):
+    """Record the time spent in the with block as a startup step (or plugin load, category 'plugin')."""
+    if _events is None:
+        yield
+        return
+    event = _open(name, category)
+    try:
+        yield
+    finally:
+        _close(event)
+
+
+def _trace(events, cpu):
+    trace = []
+    for e in events:
+        trace.append({'name': e['name'], 'cat': e['cat'], 'ph': 'X', 'pid': os.getpid(), 'tid': e['tid'],
+                      'ts': int((e['start'] - _origin) * 1e6), 'dur': int(e['wall'] * 1e6),
+                      'args': {'cpu_ms': round(e['cpu'] * 1e3, 3), 'self_ms': round((e['wall'] - e['nested']) * 1e3, 3),
+                               'imported_by': e['by']}})
+    return {'traceEvents': trace, 'displayTimeUnit': 'ms', 'otherData': {'cpu_s': cpu}}
+
+
+def _report(events, wall, cpu):
+    lines = ['SIP startup profile, {}'.format(time.strftime('%Y-%m-%d %H:%M:%S')),
+             'Until ready to serve: {:.0f} ms wall, {:.0f} ms CPU'.format(wall * 1e3, cpu * 1e3), '']
+    steps = [e for e in events if e['cat'] == 'startup']
+    plugins = sorted([e for e in events if e['cat'] == 'plugin'], key=lambda e: e['wall'], reverse=True)
+    modules = sorted([e for e in events if e['cat'] == 'import'], key=lambda e: e['wall'] - e['nested'], reverse=True)
+    if steps:
+        lines.append('Startup steps:')
+        lines.append('{:>10} {:>10}  {}'.format('wall ms', 'cpu ms', 'step'))
+        for e in steps:
+            lines.append('{:>10.1f} {:>10.1f}  {}'.format(e['wall'] * 1e3, e['cpu'] * 1e3, e['name']))
+        lines.append('')
+    lines.append('Plugins, slowest first (including the modules they import):')
+    lines.append('{:>10} {:>10}  {}'.format('wall ms', 'cpu ms', 'plugin'))
+    for e in plugins:
+        lines.append('{:>10.1f} {:>10.1f}  {}'.format(e['wall'] * 1e3, e['cpu'] * 1e3, e['name']))
+    lines.append('')
+    lines.append('Modules by own time, slowest {} (nested imports excluded):'.format(TOP))
+    lines.append('{:>10} {:>10} {:>10}  {}'.format('self ms', 'total ms', 'self cpu', 'module (imported by)'))
+    for e in modules[:TOP]:
+        lines.append('{:>10.1f} {:>10.1f} {:>10.1f}  {} ({})'.format(
+            (e['wall'] - e['nested']) * 1e3, e['wall'] * 1e3, (e['cpu'] - e['nested_cpu']) * 1e3, e['name'], e['by']))
+    return '\n'.join(lines) + '\n'
+
+
+def finish():
+    """
+    Stop recording and write the report and trace. Returns the report, None if the profiler was not running.
+    """
+    global _events
+    if _events is None:
+        return None
+    __builtin__.__import__ = _original_import
+    wall = time.time() - _origin
+    cpu = _cpu()  # Since the process started.
+    events, _events = _events, None
+    report = _report(events, wall, cpu)
+    with open(REPORT, 'w') as f:
+        f.write(report)
+    with open(TRACE, 'w') as f:
+        json.dump(_trace(events, cpu), f)
+    print report
+    print 'Startup profile written to', REPORT, 'and', TRACE
+    return report
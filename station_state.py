@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+Compact store for the state of every station.
+
+The on/off state of all stations is one integer bit mask (bit n = station
+index n) and the run schedule and display values are array columns:
+
+    start, stop, duration, program  -- gv.rs   [start time, stop time, duration, program number]
+    display_program, remaining      -- gv.ps   [program number, time remaining]
+
+gv.srvals, gv.sbits, gv.ps and gv.rs are views onto the store, so existing
+code that reads or assigns items (gv.srvals[sid] = 1, gv.rs[sid][1] = t,
+gv.ps[sid] = [0, 0]) keeps working. The views must not be replaced with new
+lists; use clear(), all_off() or resize() instead. Code written for the old
+lists that still does (gv.srvals = [0] * n) is caught by
+adopt_replaced_views(), which the timing loop calls every pass: it copies
+the values into the store, puts the view back and warns. gv.sbits follows
+the on/off state, so writes to it are ignored, with a warning.
+
+Times are kept as doubles because stop times can be infinite (manual mode)
+and adjusted durations fractional. Whole numbers are returned as ints.
+
+The store also keeps the set of active stations: those that are on, have a
+stop time or show a program. The timing loop only visits these, so the work
+done each second depends on the number of active stations rather than on the
+number of boards.
+
+With journal set to a list, every change made through the methods is also
+appended to it as (method name, arguments...), so another copy of the state
+can make the same changes with replay() (see engine.py). load() is not
+recorded.
+"""
+
+from abc import ABCMeta, abstractmethod
+from array import array
+import threading
+import warnings
+
+MAX_BOARDS = 64  # Largest number of boards (base unit plus expansion boards) accepted in options.
+
+JOURNALED = ['resize', 'set_on', 'all_off', 'set_field', 'clear_schedule']  # Methods recorded in the journal.
+SCHEDULE = ['start', 'stop', 'duration', 'program']  # Columns of gv.rs
+DISPLAY = ['display_program', 'remaining']  # Columns of gv.ps
+LEGACY_VIEWS = ['srvals', 'sbits', 'ps', 'rs']  # Attributes of gv that are views onto gv.stations.
+COLUMN_TYPES = {
+    'start': 'd',
+    'stop': 'd',
+    'duration': 'd',
+    'program': 'l',
+    'display_program': 'l',
+    'remaining': 'd',
+}
+
+
+def _num(v):
+    """Return whole valued floats as ints."""
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    return v
+
+
+def _index(i, length):
+    if i < 0:
+        i += length
+    if not 0 <= i < length:
+        raise IndexError('station index out of range')
+    return i
+
+
+class StationState(object):
+    """
+    On/off bit mask and run schedule columns for nst stations.
+    """
+
+    def __init__(self, nst):
+        self._lock = threading.RLock()
+        self.nst = 0
+        self.on_mask = 0
+        self._count_on = 0
+        self.active = set()
+        self.generation = 0  # Incremented on every change except remaining time updates.
+        self.journal = None  # List of changes made, while recording them.
+        for name in SCHEDULE + DISPLAY:
+            setattr(self, name, array(COLUMN_TYPES[name]))
+        self.resize(nst)
+        self.srvals = SrvalsView(self)
+        self.sbits = SbitsView(self)
+        self.rs = RowsView(self, SCHEDULE)
+        self.ps = RowsView(self, DISPLAY)
+
+    def resize(self, nst):
+        """
+        Change the number of stations, keeping the state of those that remain.
+        """
+        with self._lock:
+            for name in SCHEDULE + DISPLAY:
+                col = getattr(self, name)
+                if nst > len(col):
+                    col.extend([0] * (nst - len(col)))
+                else:
+                    del col[nst:]
+            self.on_mask &= (1 << nst) - 1
+            self._count_on = bin(self.on_mask).count('1')
+            self.active = set(sid for sid in self.active if sid < nst)
+            self.nst = nst
+            self.generation += 1
+            self._record('resize', nst)
+
+    def _record(self, *change):
+        if self.journal is not None:
+            self.journal.append(change)
+
+    def take_journal(self):
+        """Return the changes recorded since the last call and start a new journal."""
+        with self._lock:
+            changes, self.journal = self.journal or [], []
+            return changes
+
+    def replay(self, changes):
+        """Make the changes recorded in another copy's journal."""
+        with self._lock:
+            for change in changes:
+                if change[0] not in JOURNALED:
+                    raise ValueError('not a station state change: {}'.format(change[0]))
+                getattr(self, change[0])(*change[1:])
+
+    def _update_active(self, sid):
+        if (self.on_mask >> sid) & 1 or self.stop[sid] or self.display_program[sid]:
+            self.active.add(sid)
+        else:
+            self.active.discard(sid)
+
+    def scheduled(self):
+        """
+        Return a sorted list of the active stations (on, scheduled or shown with a program).
+        """
+        with self._lock:
+            return sorted(self.active)
+
+    def on_stations(self):
+        """Return a list of the indexes of the stations that are on."""
+        result = []
+        mask = self.on_mask
+        while mask:
+            low = mask & -mask
+            result.append(low.bit_length() - 1)
+            mask ^= low
+        return result
+
+    ### On/off state ###
+
+    def is_on(self, sid):
+        return (self.on_mask >> sid) & 1
+
+    def set_on(self, sid, on):
+        bit = 1 << sid
+        with self._lock:
+            if on and not self.on_mask & bit:
+                self.on_mask |= bit
+                self._count_on += 1
+            elif not on and self.on_mask & bit:
+                self.on_mask &= ~bit
+                self._count_on -= 1
+            else:
+                return
+            self._update_active(sid)
+            self.generation += 1
+            self._record('set_on', sid, on)
+
+    def any_on(self):
+        return self.on_mask != 0
+
+    def count_on(self):
+        return self._count_on
+
+    def board_bits(self, board):
+        """Return the on/off bits of one board (8 stations) as a byte."""
+        return (self.on_mask >> (board * 8)) & 0xFF
+
+    def all_off(self):
+        """Turn every station off without touching the schedule."""
+        with self._lock:
+            self.on_mask = 0
+            self._count_on = 0
+            self.active = set(sid for sid in self.active if self.stop[sid] or self.display_program[sid])
+            self.generation += 1
+            self._record('all_off')
+
+    ### Schedule ###
+
+    def set_field(self, name, sid, value):
+        if COLUMN_TYPES[name] == 'l':
+            value = int(value)
+        getattr(self, name)[sid] = value
+        with self._lock:
+            if name in ('stop', 'display_program'):
+                self._update_active(sid)
+            self.generation += 1
+            self._record('set_field', name, sid, value)
+
+    def clear_schedule(self):
+        """Clear the run schedule (gv.rs) and display values (gv.ps) of every station."""
+        with self._lock:
+            for name in SCHEDULE + DISPLAY:
+                getattr(self, name)[:] = array(COLUMN_TYPES[name], [0]) * self.nst
+            self.active = set(self.on_stations())
+            self.generation += 1
+            self._record('clear_schedule')
+
+    def clear_station(self, sid):
+        """Turn a station off and clear its schedule."""
+        with self._lock:
+            self.set_on(sid, 0)
+            for name in SCHEDULE + DISPLAY:
+                self.set_field(name, sid, 0)
+
+    def clear(self):
+        """Turn every station off and clear all schedules."""
+        with self._lock:
+            self.all_off()
+            self.clear_schedule()
+
+    def dump(self):
+        """
+        Return the on/off mask and a dictionary of column name -> list of values.
+        """
+        with self._lock:
+            return self.on_mask, dict((name, getattr(self, name).tolist()) for name in SCHEDULE + DISPLAY)
+
+    def load(self, on_mask, columns):
+        """
+        Replace the whole state with values from dump() or a shared copy.
+        columns must hold a sequence of nst values for each column name.
+        """
+        with self._lock:
+            for name in SCHEDULE + DISPLAY:
+                getattr(self, name)[:] = array(COLUMN_TYPES[name], columns[name][:self.nst])
+            self.on_mask = on_mask & ((1 << self.nst) - 1)
+            self._count_on = bin(self.on_mask).count('1')
+            self.active = set(self.on_stations())
+            for sid in xrange(self.nst):
+                if self.stop[sid] or self.display_program[sid]:
+                    self.active.add(sid)
+            self.generation += 1
+
+    def first_scheduled(self):
+        """Return the index of the first station with a stop time or None."""
+        for sid in self.scheduled():
+            if self.stop[sid]:
+                return sid
+        return None
+
+
+class _ListView(object):
+    """Common list behaviour for the legacy views."""
+
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    @abstractmethod
+    def __getitem__(self, i):
+        pass
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def tolist(self):
+        return [self[i] for i in xrange(len(self))]
+
+    def __eq__(self, other):
+        if isinstance(other, _ListView):
+            other = other.tolist()
+        return self.tolist() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def _slice(self, i):
+        return [self[j] for j in xrange(*i.indices(len(self)))]
+
+
+class SrvalsView(_ListView):
+    """gv.srvals: 1 if a station is on, otherwise 0."""
+
+    def __init__(self, state):
+        self._state = state
+
+    def __len__(self):
+        return self._state.nst
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._slice(i)
+        return self._state.is_on(_index(i, self._state.nst))
+
+    def __setitem__(self, i, value):
+        self._state.set_on(_index(i, self._state.nst), value)
+
+
+class SbitsView(_ListView):
+    """
+    gv.sbits: one byte per board with the bits of the stations that are on.
+    The bits follow the on/off state so assignments are ignored, with a warning
+    unless they match.
+    """
+
+    def __init__(self, state):
+        self._state = state
+
+    def __len__(self):
+        return (self._state.nst + 7) / 8 + 1  # Legacy list has one spare entry.
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._slice(i)
+        return self._state.board_bits(_index(i, len(self)))
+
+    def __setitem__(self, i, value):
+        if value != self[i]:
+            warnings.warn('gv.sbits follows gv.srvals, set gv.srvals[sid] to turn stations on or off',
+                          RuntimeWarning, stacklevel=2)
+
+
+class RowsView(_ListView):
+    """gv.rs and gv.ps: one row per station made up of the named columns."""
+
+    def __init__(self, state, names):
+        self._state = state
+        self._names = names
+
+    def __len__(self):
+        return self._state.nst
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._slice(i)
+        return Row(self._state, self._names, _index(i, self._state.nst))
+
+    def __setitem__(self, i, values):
+        sid = _index(i, self._state.nst)
+        for name, value in zip(self._names, values):
+            self._state.set_field(name, sid, value)
+
+    def tolist(self):
+        return [self[i].tolist() for i in xrange(len(self))]
+
+
+class Row(_ListView):
+    """One station's entry in gv.rs or gv.ps."""
+
+    def __init__(self, state, names, sid):
+        self._state = state
+        self._names = names
+        self._sid = sid
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._slice(i)
+        return _num(getattr(self._state, self._names[i])[self._sid])
+
+    def __setitem__(self, i, value):
+        self._state.set_field(self._names[i], self._sid, value)
+
+
+def adopt_replaced_views(module):
+    """
+    Put the views back if code replaced module.srvals, .sbits, .ps or .rs (gv)
+    with new lists, which the timing loop would never see. The values of the
+    replacement lists are copied into module.stations first, except those of
+    sbits, which follows srvals. Returns True if any view was replaced.
+    """
+    state = module.stations
+    replaced = False
+    for name in LEGACY_VIEWS:
+        value = getattr(module, name)
+        view = getattr(state, name)
+        if value is view:
+            continue
+        replaced = True
+        warnings.warn('gv.{0} was replaced by a new list and has been put back; assign its items instead '
+                      '(gv.{0}[sid] = ...)'.format(name), RuntimeWarning)
+        setattr(module, name, view)
+        if name == 'sbits':
+            continue
+        try:
+            for sid, item in enumerate(list(value)[:state.nst]):
+                view[sid] = item
+        except (TypeError, ValueError) as e:
+            print 'station_state: values of the replaced gv.{} not copied:'.format(name), e
+    return replaced
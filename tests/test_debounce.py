@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+gpio_pins.DebouncedInput on the simulated platform, fed with gpio_pins.sim_edges.
+
+Run from the SIP directory:
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import i18n
+
+import threading
+import time
+import unittest
+
+import gpio_pins
+
+PIN = 99  # Not a header pin, only known to the simulation.
+WINDOW = 0.05  # seconds
+
+
+@unittest.skipUnless(hasattr(gpio_pins, 'sim_edges'), 'needs the simulated GPIO platform')
+class DebouncedInputTest(unittest.TestCase):
+
+    def setUp(self):
+        gpio_pins.sim_levels[PIN] = 1
+        gpio_pins.sim_callbacks[PIN] = []
+        self.changes = []
+        self.changed = threading.Event()
+        self.input = gpio_pins.DebouncedInput(PIN, WINDOW, self.on_change)
+
+    def tearDown(self):
+        del gpio_pins.sim_levels[PIN]
+        del gpio_pins.sim_callbacks[PIN]
+
+    def on_change(self, level):
+        self.changes.append(level)
+        self.changed.set()
+
+    def settle(self):
+        time.sleep(WINDOW * 3)
+
+    def test_edge_detection(self):
+        self.assertTrue(self.input.edge_detect)
+        self.assertEqual(self.input.level, 1)
+
+    def test_bounce_reports_one_change(self):
+        gpio_pins.sim_edges(PIN, [(0, 0), (0.005, 1), (0.005, 0), (0.005, 1), (0.005, 0)])
+        self.assertTrue(self.changed.wait(1))
+        self.settle()
+        self.assertEqual(self.changes, [0])
+        self.assertEqual(self.input.level, 0)
+
+    def test_change_waits_for_the_window(self):
+        gpio_pins.sim_edges(PIN, [(0, 0)])
+        time.sleep(WINDOW / 5)
+        self.assertEqual(self.changes, [])
+        self.assertTrue(self.changed.wait(1))
+        self.assertEqual(self.changes, [0])
+
+    def test_short_pulse_is_ignored(self):
+        gpio_pins.sim_edges(PIN, [(0, 0), (WINDOW / 5, 1)])
+        self.settle()
+        self.assertEqual(self.changes, [])
+        self.assertEqual(self.input.level, 1)
+
+    def test_stable_changes_are_all_reported(self):
+        gpio_pins.sim_edges(PIN, [(0, 0)])
+        self.settle()
+        gpio_pins.sim_edges(PIN, [(0, 1), (0.005, 0), (0.005, 1)])
+        self.settle()
+        self.assertEqual(self.changes, [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
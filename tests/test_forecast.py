@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+The forecast lists the runs the timing loop makes, checked against simulate.py.
+
+Run from the SIP directory:
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import i18n
+
+import calendar
+import shutil
+import tempfile
+import time
+import unittest
+
+import forecast
+import gv
+import helpers
+import persist
+import program_index
+import simulate
+
+START = calendar.timegm(time.strptime('2024-06-03', '%Y-%m-%d'))
+DAYS = 3
+
+
+class ForecastMatchesSimulationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.saved = (persist.DATA_DIR, gv.sd.copy(), gv.pd)
+        persist.DATA_DIR = self.data_dir
+        gv.sd.update({'en': 1, 'mm': 0, 'nbrd': 1, 'nst': 8, 'mo': [0], 'ir': [0], 'iw': [0],
+                      'seq': 1, 'sdt': 0, 'mas': 0, 'mton': 0, 'mtoff': 0, 'wl': 100, 'idd': 0, 'rd': 0})
+        gv.stations.resize(8)
+
+    def tearDown(self):
+        persist.DATA_DIR, sd, gv.pd = self.saved
+        gv.sd.clear()
+        gv.sd.update(sd)
+        program_index.invalidate()
+        forecast.invalidate()
+        shutil.rmtree(self.data_dir)
+
+    def compare(self, programs):
+        gv.pd = programs
+        program_index.invalidate()
+        records, zones = simulate.simulate(START, DAYS)
+        simulated = sorted((r['station'], r['date'] + ' ' + r['start'], r['duration']) for r in records)
+        gv.sd['en'] = 1
+        forecast.invalidate()
+        runs = forecast.forecast(DAYS, START - 1)['runs']
+        forecasted = sorted((r['station'], time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(r['start'])),
+                             helpers.timestr(r['duration'])) for r in runs if r['stop'] < START + DAYS * 86400)
+        self.assertTrue(simulated)
+        self.assertEqual(forecasted, simulated)
+
+    def two_programs(self):
+        # P1 runs stations 1-3 for 400 s each from 06:00 until 06:20, P2 is due at 06:20.
+        return [[1, 127, 0, 360, 361, 1, 400, 7], [1, 127, 0, 380, 381, 1, 300, 7]]
+
+    def test_sequence_end(self):
+        self.compare(self.two_programs())
+
+    def test_master_off_delay(self):
+        gv.sd.update({'mas': 4, 'mo': [7]})
+        for mtoff in [60, 30, -30]:  # Past P2's minute, within it, before it.
+            gv.sd['mtoff'] = mtoff
+            self.compare(self.two_programs())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+The recording GPIO backend (gpio_recorder.py) and the output sequences
+gpio_pins.set_output() produces on it.
+
+gv.platform is fixed when gv is imported, so the set_output() checks run in
+a child process started with SIP_GPIO=recording.
+
+Run from the SIP directory:
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import json
+import subprocess
+import unittest
+
+import gpio_recorder
+
+DAT, CLK, LAT = 13, 7, 15
+
+OUTPUTS = r'''
+import i18n
+import json
+import gv
+import gpio_pins
+import gpio_recorder
+
+gv.sd.update({'nbrd': 2, 'nst': 16, 'alr': 0})
+gv.stations.resize(16)
+gpio_pins.set_output()  # Sets up the pins.
+
+def frames(calls):
+    return gpio_recorder.decode_frames(calls, gpio_pins.pin_sr_dat, gpio_pins.pin_sr_clk, gpio_pins.pin_sr_lat)
+
+result = {}
+recorder = gpio_pins.recorder
+recorder.reset()
+gv.srvals[0] = 1
+gv.srvals[9] = 1
+gpio_pins.set_output()
+result['write'] = frames(recorder.calls)
+recorder.reset()
+gpio_pins.set_output()
+result['unchanged'] = recorder.count()
+gpio_pins.hold_output()
+gv.srvals[0] = 0
+gpio_pins.set_output()
+gv.srvals[15] = 1
+gpio_pins.set_output()
+result['held'] = recorder.count()
+gpio_pins.release_output()
+result['released'] = frames(recorder.calls)
+print json.dumps(result)
+'''
+
+
+def shift_out(recorder, frame):
+    """Write frame to the shift registers the way gpio_pins.setShiftRegister does."""
+    recorder.write(CLK, 0)
+    recorder.write(LAT, 0)
+    for value in reversed(frame):
+        recorder.write(CLK, 0)
+        recorder.write(DAT, value)
+        recorder.write(CLK, 1)
+    recorder.write(LAT, 1)
+
+
+class RecorderTest(unittest.TestCase):
+
+    def test_calls_and_latency(self):
+        recorder = gpio_recorder.Recorder(0.0001)
+        recorder.config_output(DAT)
+        recorder.inputs[8] = 0
+        self.assertEqual(recorder.read(8), 0)
+        self.assertEqual(recorder.read(10), 1)  # Pulled up.
+        recorder.write(DAT, 5)
+        self.assertEqual([(c.op, c.pin, c.value) for c in recorder.calls],
+                         [('config_output', DAT, None), ('read', 8, 0), ('read', 10, 1), ('write', DAT, 1)])
+        self.assertEqual(recorder.count('read'), 2)
+        self.assertAlmostEqual(recorder.elapsed, 0.0004)
+        recorder.reset()
+        self.assertEqual((recorder.count(), recorder.elapsed), (0, 0.0))
+
+    def test_decode_frames(self):
+        recorder = gpio_recorder.Recorder()
+        frames = [[1, 0, 0, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 1], [0] * 16]
+        for frame in frames:
+            shift_out(recorder, frame)
+        self.assertEqual(gpio_recorder.decode_frames(recorder.calls, DAT, CLK, LAT), frames)
+
+    def test_set_output_sequences(self):
+        env = dict(os.environ, SIP_GPIO='recording')
+        output = subprocess.check_output([sys.executable, '-c', OUTPUTS], cwd=ROOT, env=env)
+        result = json.loads(output.strip().splitlines()[-1])
+        on = [0] * 16
+        on[0] = on[9] = 1
+        self.assertEqual(result['write'], [on])
+        self.assertEqual(result['unchanged'], 0)  # Same frame, nothing written.
+        self.assertEqual(result['held'], 0)  # Postponed to release_output().
+        on[0], on[15] = 0, 1
+        self.assertEqual(result['released'], [on])  # Both changes in one frame.
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Program changes made through the web pages reach the timing loop's plan.
+
+Run from the SIP directory:
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import i18n
+
+import calendar
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+import gv
+import persist
+import program_index
+import scheduler
+import sip
+
+DAY = calendar.timegm(time.strptime('2024-06-03', '%Y-%m-%d'))
+
+
+class AddProgramThenWakeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.saved = (persist.DATA_DIR, gv.sd.copy(), gv.pd, scheduler.waker.wake, gv.now)
+        persist.DATA_DIR = self.data_dir
+        gv.sd.update({'ipas': 1, 'svd': 0, 'en': 1, 'mm': 0, 'seq': 1, 'bsy': 0, 'rd': 0, 'urs': 0})
+        gv.pd = []
+        gv.now = DAY + 6 * 3600
+        gv.stations.clear()
+        program_index.invalidate()
+        scheduler.checked_minute = gv.now / 60
+        scheduler.plan()  # No programs: nothing planned, next_fire() cached as None.
+        # The timing loop wakes and re-plans as soon as wake() is called.
+        scheduler.waker.wake = scheduler.plan
+
+    def tearDown(self):
+        persist.DATA_DIR, sd, gv.pd, scheduler.waker.wake, gv.now = self.saved
+        gv.sd.clear()
+        gv.sd.update(sd)
+        program_index.invalidate()
+        scheduler.deadlines.clear()
+        shutil.rmtree(self.data_dir)
+
+    def program_checks(self):
+        return [d[0] for d in scheduler.deadlines.pop_due(DAY + 86400) if d[1] == scheduler.PROGRAM_CHECK]
+
+    def test_new_program_is_planned(self):
+        self.assertEqual(self.program_checks(), [])
+        scheduler.plan()
+        program = [1, 127, 0, 7 * 60, 7 * 60 + 1, 1, 600, 1]  # Every day at 07:00, station 1.
+        result = sip.app.request('/cp?pid=-1&v=' + json.dumps(program))
+        self.assertEqual(result.status, '303 See Other')
+        self.assertEqual(self.program_checks(), [DAY + 7 * 3600])
+
+    def test_disabled_program_is_not_planned(self):
+        gv.pd = [[1, 127, 0, 7 * 60, 7 * 60 + 1, 1, 600, 1]]
+        program_index.invalidate()
+        scheduler.plan()
+        sip.app.request('/ep?pid=0&enable=0')
+        self.assertEqual(self.program_checks(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
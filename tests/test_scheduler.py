@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Deadline queue, due(), plan() and sleep() of scheduler.py, driven by a VirtualClock.
+
+Run from the SIP directory:
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import i18n
+
+import calendar
+import time
+import unittest
+
+import gv
+import program_index
+import scheduler
+
+DAY = calendar.timegm(time.strptime('2024-06-03', '%Y-%m-%d'))
+NOW = DAY + 6 * 3600  # 06:00
+
+
+class DeadlineQueueTest(unittest.TestCase):
+
+    def test_earliest_first(self):
+        queue = scheduler.DeadlineQueue()
+        queue.push(30, scheduler.STATION_OFF, 2)
+        queue.push(10, scheduler.STATION_ON, 1)
+        queue.push(20, scheduler.PROGRAM_CHECK)
+        self.assertEqual(queue.next_deadline(), 10)
+        self.assertEqual(queue.pop_due(20), [(10, scheduler.STATION_ON, 1), (20, scheduler.PROGRAM_CHECK, None)])
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.pop_due(29), [])
+        queue.clear()
+        self.assertEqual(queue.next_deadline(), None)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (gv.sd.copy(), gv.pd, gv.now, scheduler.clock)
+        gv.sd.update({'en': 1, 'mm': 0, 'seq': 1, 'bsy': 0, 'mas': 0, 'mton': 0, 'mtoff': 0,
+                      'rd': 0, 'rdst': 0, 'urs': 0})
+        gv.pd = []
+        gv.now = NOW
+        gv.stations.clear()
+        program_index.invalidate()
+        scheduler.checked_minute = NOW / 60
+        scheduler.reset()
+
+    def tearDown(self):
+        sd, gv.pd, gv.now, scheduler.clock = self.saved
+        gv.sd.clear()
+        gv.sd.update(sd)
+        gv.stations.clear()
+        program_index.invalidate()
+        scheduler.reset()
+
+    def run_station(self, sid, start, stop):
+        gv.rs[sid] = [start, stop, stop - start, 1]
+        if start <= gv.now:
+            gv.srvals[sid] = 1
+        gv.sd['bsy'] = 1
+
+    def test_first_pass_is_due(self):
+        self.assertTrue(scheduler.due(NOW))
+        self.assertFalse(scheduler.due(NOW))
+
+    def test_plan_orders_deadlines(self):
+        gv.pd = [[1, 127, 0, 7 * 60, 7 * 60 + 1, 1, 600, 1]]  # Every day at 07:00.
+        program_index.invalidate()
+        self.run_station(0, NOW - 10, NOW + 50)  # On until 06:00:50.
+        self.run_station(1, NOW + 50, NOW + 110)  # Next in the sequence.
+        gv.sd.update({'rd': 1, 'rdst': NOW + 3600})
+        scheduler.plan()
+        self.assertEqual(scheduler.deadlines.pop_due(DAY + 86400), [
+            (NOW + 50, scheduler.STATION_OFF, 0),
+            (NOW + 50, scheduler.STATION_ON, 1),
+            (NOW + 3600, scheduler.PROGRAM_CHECK, None),
+            (NOW + 3600, scheduler.RAIN_DELAY_END, None),
+        ])
+
+    def test_master_deadlines(self):
+        gv.sd.update({'mas': 3})
+        self.run_station(0, NOW - 10, NOW + 50)
+        gv.rs[2] = [NOW + 20, NOW + 80, 60, 1]  # Master turns on late and off after the station.
+        scheduler.plan()
+        self.assertEqual(scheduler.deadlines.pop_due(NOW + 100), [
+            (NOW + 20, scheduler.MASTER_ON, 2),
+            (NOW + 50, scheduler.STATION_OFF, 0),
+        ])
+
+    def test_due_only_at_deadlines(self):
+        scheduler.due(NOW)  # First pass.
+        self.run_station(0, NOW - 10, NOW + 50)
+        scheduler.plan()
+        self.assertFalse(scheduler.due(NOW + 1))
+        self.assertFalse(scheduler.due(NOW + 49))
+        self.assertTrue(scheduler.due(NOW + 50))
+        self.assertFalse(scheduler.due(NOW + 51))  # Consumed.
+
+    def test_bsy_set_without_wake_is_due(self):
+        scheduler.due(NOW)
+        scheduler.plan()
+        gv.sd['bsy'] = 1  # Stations scheduled by a plugin that did not call wake().
+        self.assertTrue(scheduler.due(NOW + 1))
+
+    def test_wake_forces_a_pass(self):
+        scheduler.due(NOW)
+        scheduler.plan()
+        scheduler.clock = scheduler.VirtualClock(NOW, NOW + 600)
+        scheduler.wake()
+        scheduler.sleep()
+        self.assertEqual(scheduler.clock.now, NOW)  # Woken, not moved on.
+        self.assertTrue(scheduler.due(NOW))
+
+    def test_virtual_clock_jumps_to_deadline(self):
+        scheduler.due(NOW)
+        self.run_station(0, NOW - 10, NOW + 50)
+        scheduler.plan()
+        scheduler.clock = scheduler.VirtualClock(NOW, NOW + 600)
+        scheduler.sleep()
+        self.assertEqual(scheduler.clock.now, NOW + 50)
+        self.assertEqual(scheduler.wake_target, NOW + 50)
+        self.assertTrue(scheduler.due(scheduler.clock.now))
+
+    def test_virtual_clock_ends(self):
+        scheduler.due(NOW)
+        scheduler.plan()  # Nothing planned: waits for wake(), which never comes.
+        scheduler.clock = scheduler.VirtualClock(NOW, NOW + 600)
+        self.assertRaises(scheduler.SimulationEnd, scheduler.sleep)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Timing measurements for the timing loop in sip.py.
+
+For every pass of the loop the scheduled wake up time is compared with the
+time the loop actually woke (lateness), and the time spent in each phase of
+the pass is measured:
+
+    programs    matching programs and scheduling their stations
+    stations    the on/off pass over the active stations
+    (both of these include the set_output and log_run calls they make)
+    set_output  writing the station values to the hardware
+    check_rain  reading the rain sensor
+    log_run     writing log records
+    jsave       saving settings
+    total       the whole pass
+
+The most recent RING_SIZE passes are kept in a ring buffer for summaries
+(/api/tickstats). Histograms counting every pass since start up are also kept
+and exported in Prometheus text format (/metrics).
+
+Lateness is measured against scheduler.clock, phase durations against the
+wall clock.
+"""
+
+from collections import deque
+import threading
+import time
+
+RING_SIZE = 3600  # One hour of once a second passes.
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]  # seconds
+PHASES = ['programs', 'stations', 'set_output', 'check_rain', 'log_run', 'jsave', 'total']
+
+
+class Histogram(object):
+    """
+    Cumulative histogram with fixed bucket upper bounds, as used by Prometheus.
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last entry counts values above every bound.
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Return a list of (upper bound, number of values <= bound), ending with ('+Inf', count).
+        """
+        result = []
+        total = 0
+        for bound, n in zip(self.bounds + ['+Inf'], self.counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+
+_lock = threading.Lock()
+_ring = deque(maxlen=RING_SIZE)
+_lateness = Histogram()
+_phases = dict((name, Histogram()) for name in PHASES)
+_current = None  # Record of the pass in progress.
+_full_passes = 0
+
+
+def begin(scheduled, actual):
+    """
+    Start measuring a pass of the timing loop.
+
+    @type scheduled: float or None
+    @param scheduled: time the loop planned to wake (None if it waited for a wake up)
+    @type actual: float
+    @param actual: time the loop woke, in the same frame as scheduled
+    """
+    global _current
+    if scheduled is None or actual < scheduled:  # Woken early by scheduler.wake().
+        lateness = 0.0
+    else:
+        lateness = actual - scheduled
+    _current = {
+        'time': actual,
+        'lateness': lateness,
+        'full': False,
+        'started': time.time(),
+        'phases': {},  # Only phases that ran are recorded.
+    }
+
+
+def full_pass():
+    """Mark the pass in progress as one that re-evaluated the schedule."""
+    if _current is not None:
+        _current['full'] = True
+
+
+def add(name, seconds):
+    """Add time spent in a phase to the pass in progress."""
+    if _current is not None:
+        phases = _current['phases']
+        phases[name] = phases.get(name, 0.0) + seconds
+
+
+class phase(object):
+    """
+    Context manager timing a phase of the pass in progress:
+
+        with tick_stats.phase('check_rain'):
+            check_rain()
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, *exc):
+        add(self.name, time.time() - self.started)
+        return False
+
+
+def timed(name, func):
+    """
+    Return func wrapped so that each call adds to phase name of the pass in progress.
+    """
+    def wrapper(*args, **kwargs):
+        with phase(name):
+            return func(*args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def end():
+    """Finish the pass in progress and store its record."""
+    global _current, _full_passes
+    record = _current
+    if record is None:
+        return
+    _current = None
+    record['phases']['total'] = time.time() - record.pop('started')
+    with _lock:
+        _ring.append(record)
+        _lateness.observe(record['lateness'])
+        if record['full']:
+            _full_passes += 1
+            for name, seconds in record['phases'].items():
+                _phases[name].observe(seconds)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _summary(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if values else None,
+        'p50': _percentile(values, 0.5),
+        'p90': _percentile(values, 0.9),
+        'p99': _percentile(values, 0.99),
+        'max': values[-1] if values else None,
+    }
+
+
+def _histogram_dict(h):
+    return {
+        'buckets': [[bound, n] for bound, n in h.cumulative()],
+        'sum': h.sum,
+        'count': h.count,
+    }
+
+
+def stats(recent=0):
+    """
+    Return summaries of the passes in the ring buffer and the cumulative histograms as a dictionary.
+    If recent is given, the records of up to that many of the latest passes are included.
+    """
+    with _lock:
+        records = list(_ring)
+        result = {
+            'ring_size': RING_SIZE,
+            'passes': len(records),
+            'full_passes': _full_passes,
+            'histograms': {
+                'lateness': _histogram_dict(_lateness),
+                'phases': dict((name, _histogram_dict(h)) for name, h in _phases.items()),
+            },
+        }
+    full = [r for r in records if r['full']]
+    result['lateness'] = _summary([r['lateness'] for r in records])
+    result['phases'] = dict((name, _summary([r['phases'][name] for r in full if name in r['phases']]))
+                            for name in PHASES)
+    if recent:
+        result['recent'] = records[-recent:]
+    return result
+
+
+def _prometheus_histogram(lines, name, h, label=None):
+    """Append the lines of one histogram. label is an optional 'name="value"' string."""
+    prefix = label + ',' if label else ''
+    suffix = '{' + label + '}' if label else ''
+    for bound, n in h.cumulative():
+        lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, prefix, bound, n))
+    lines.append('{}_sum{} {!r}'.format(name, suffix, h.sum))
+    lines.append('{}_count{} {}'.format(name, suffix, h.count))
+
+
+def prometheus():
+    """
+    Return the cumulative histograms in Prometheus text exposition format.
+    """
+    lines = []
+    with _lock:
+        lines.append('# HELP sip_tick_lateness_seconds Time the timing loop woke after its scheduled time.')
+        lines.append('# TYPE sip_tick_lateness_seconds histogram')
+        _prometheus_histogram(lines, 'sip_tick_lateness_seconds', _lateness)
+        lines.append('# HELP sip_tick_phase_seconds Time spent in each phase of full timing loop passes.')
+        lines.append('# TYPE sip_tick_phase_seconds histogram')
+        for name in PHASES:
+            _prometheus_histogram(lines, 'sip_tick_phase_seconds', _phases[name], 'phase="{}"'.format(name))
+        lines.append('# HELP sip_tick_full_passes_total Timing loop passes that re-evaluated the schedule.')
+        lines.append('# TYPE sip_tick_full_passes_total counter')
+        lines.append('sip_tick_full_passes_total {}'.format(_full_passes))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Discard all measurements."""
+    global _lateness, _phases, _current, _full_passes
+    with _lock:
+        _ring.clear()
+        _lateness = Histogram()
+        _phases = dict((name, Histogram()) for name in PHASES)
+        _current = None
+        _full_passes = 0
@@ -26,6 +26,12 @@ urls = [
     '/wl', 'webpages.water_log',
     '/api/status', 'webpages.api_status',
     '/api/log', 'webpages.api_log',
+    '/api/logpage', 'webpages.api_log_page',
+    '/api/usage', 'webpages.api_usage',
+    '/api/forecast', 'webpages.api_forecast',
+    '/api/tickstats', 'webpages.api_tickstats',
+    '/api/signals', 'webpages.api_signals',
+    '/metrics', 'webpages.metrics',
     '/login', 'webpages.login',
     '/logout', 'webpages.logout',
     '/restart', 'webpages.sw_restart',
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Water usage rollups: run count and run time per station and per program,
+by day, week, month and year.
+
+helpers.log_run adds every logged run with add(), so reports do not have to
+read the run log. The totals are kept in data/usage.json:
+
+    {"runs": 1234,                              <- runs added, see version()
+     "station": {"day": {"0": {"2024-05-01": [runs, seconds], ...}, ...},
+                 "week": {"0": {"2024-W18": [runs, seconds], ...}, ...},
+                 "month": {... "2024-05" ...},
+                 "year": {... "2024" ...}},
+     "program": {... keyed by the log's program field ...}}
+
+Stations are numbered from 0 as in the log records; weeks are ISO weeks.
+Day totals older than DAYS_KEPT days are dropped, the others are kept for
+good. Clearing the log or trimming it to gv.sd['lr'] records does not change
+the totals; the first time the module is used they are built from the
+records in the log.
+
+The file is rewritten after each run and reloaded when another process (the
+engine process, see engine.py) has changed it.
+"""
+
+import datetime
+import json
+import os
+import threading
+
+import run_log
+
+USAGE_FILE = './data/usage.json'
+PERIODS = ['day', 'week', 'month', 'year']
+KINDS = ['station', 'program']
+DAYS_KEPT = 400
+
+_lock = threading.RLock()
+_usage = None
+_mtime = None
+
+
+def period_ids(date):
+    """Return the ids of the day, week, month and year of a date ("yyyy-mm-dd")."""
+    day = datetime.date(*map(int, date.split('-')))
+    year, week, weekday = day.isocalendar()
+    return [day.isoformat(), '{}-W{:02d}'.format(year, week), day.strftime('%Y-%m'), str(day.year)]
+
+
+def _empty():
+    return dict([('runs', 0)] + [(kind, dict((period, {}) for period in PERIODS)) for kind in KINDS])
+
+
+def _add(usage, record):
+    try:
+        ids = period_ids(record['date'])
+    except (KeyError, ValueError, TypeError, AttributeError):
+        return
+    seconds = run_log.seconds(record.get('duration'))
+    usage['runs'] += 1
+    for kind in KINDS:
+        key = record.get(kind)
+        if key is None:
+            continue
+        key = unicode(key)
+        for period, pid in zip(PERIODS, ids):
+            totals = usage[kind][period].setdefault(key, {}).setdefault(pid, [0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+
+
+def _prune(usage, today=None):
+    first = ((today or datetime.date.today()) - datetime.timedelta(days=DAYS_KEPT)).isoformat()
+    for kind in KINDS:
+        for days in usage[kind]['day'].values():
+            for pid in [pid for pid in days if pid < first]:
+                del days[pid]
+
+
+def _save(usage):
+    global _mtime
+    with open(USAGE_FILE + '.tmp', 'w') as f:
+        json.dump(usage, f)
+    os.rename(USAGE_FILE + '.tmp', USAGE_FILE)
+    _mtime = os.path.getmtime(USAGE_FILE)
+
+
+def _load():
+    """Return the totals, reading the file if it changed and building it from the log if there is none."""
+    global _usage, _mtime
+    with _lock:
+        try:
+            mtime = os.path.getmtime(USAGE_FILE)
+        except OSError:
+            mtime = None
+        if _usage is not None and mtime == _mtime:
+            return _usage
+        usage = None
+        if mtime is not None:
+            try:
+                with open(USAGE_FILE) as f:
+                    usage = json.load(f)
+                _mtime = mtime
+            except (IOError, ValueError):
+                pass
+        if usage is None:
+            usage = _empty()
+            for record in run_log.records(0):
+                _add(usage, record)
+            _prune(usage)
+            _save(usage)
+        _usage = usage
+        return usage
+
+
+def add(record):
+    """Add a run (a log record) to the totals."""
+    with _lock:
+        usage = _load()
+        _add(usage, record)
+        if usage['runs'] % 100 == 0:
+            _prune(usage)
+        _save(usage)
+
+
+def version():
+    """Return the number of runs added, which changes whenever the totals do."""
+    return _load()['runs']
+
+
+def totals(kind='station', period='month', first=None, last=None, key=None):
+    """
+    Return the totals of one kind ('station' or 'program') by period as
+    {key: {period id: {'runs': n, 'seconds': s}}}, for the period ids from
+    first to last (both included, all if None) and one station or program
+    (key) or all of them.
+    """
+    if kind not in KINDS or period not in PERIODS:
+        raise ValueError('unknown usage kind or period: {}, {}'.format(kind, period))
+    with _lock:
+        usage = _load()[kind][period]
+        result = {}
+        for k, periods in usage.items():
+            if key is not None and k != unicode(key):
+                continue
+            periods = dict((pid, {'runs': t[0], 'seconds': t[1]}) for pid, t in periods.items()
+                           if (first is None or pid >= first) and (last is None or pid <= last))
+            if periods:
+                result[k] = periods
+    return result
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Revision number and date of the installed SIP, cached in data/version.json.
+
+gv.py needs the number of commits and the date of the last commit to show the
+version. Asking git for them takes two processes, seconds on a Pi with a long
+history on an SD card, so they are looked up once, at install or update time,
+and saved with the commit they belong to:
+
+    {"head": "<commit sha>", "revision": 1234, "date": "2024-05-01"}
+
+load() returns the cached values while .git still points at that commit
+(read from the files in .git, without running git), and runs git and
+rewrites the cache otherwise, so a manual git pull is picked up on the next
+start. update() refreshes the cache; plugins/system_update.py calls it after
+pulling an update, and install scripts can run:
+
+    python version.py
+"""
+
+import json
+import os
+import subprocess
+
+VERSION_FILE = './data/version.json'
+GIT_DIR = './.git'
+
+
+def head():
+    """Return the sha of the commit checked out, read from .git, or None if it cannot be read."""
+    try:
+        with open(os.path.join(GIT_DIR, 'HEAD')) as f:
+            ref = f.read().strip()
+        if not ref.startswith('ref: '):
+            return ref  # Detached.
+        ref = ref[5:]
+        try:
+            with open(os.path.join(GIT_DIR, ref)) as f:
+                return f.read().strip()
+        except IOError:
+            with open(os.path.join(GIT_DIR, 'packed-refs')) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] == ref:
+                        return parts[0]
+    except IOError:
+        pass
+    return None
+
+
+def resolve():
+    """
+    Ask git for the revision (number of commits) and date of the last commit.
+    Values git cannot give are None.
+    """
+    info = {'head': head(), 'revision': None, 'date': None}
+    try:
+        info['revision'] = int(subprocess.check_output(['git', 'rev-list', '--count', 'HEAD']))
+    except Exception:
+        pass
+    try:
+        info['date'] = subprocess.check_output(['git', 'log', '-1', '--format=%cd', '--date=short']).strip()
+    except Exception:
+        pass
+    return info
+
+
+def update():
+    """Resolve the version with git and save it. Returns the version dictionary."""
+    info = resolve()
+    if info['revision'] is not None:
+        try:
+            with open(VERSION_FILE + '.tmp', 'w') as f:
+                json.dump(info, f)
+            os.rename(VERSION_FILE + '.tmp', VERSION_FILE)
+        except (IOError, OSError):
+            pass
+    return info
+
+
+def load():
+    """
+    Return the version dictionary (head, revision and date), from the cache
+    if it is for the commit checked out, else from git.
+    """
+    try:
+        with open(VERSION_FILE) as f:
+            info = json.load(f)
+        current = head()
+        if current is None or info.get('head') == current:
+            return info
+    except (IOError, ValueError):
+        pass
+    return update()
+
+
+if __name__ == '__main__':
+    info = update()
+    print 'revision {revision}, {date} ({head})'.format(**info)
@@ -9,8 +9,18 @@ import io
 import ast
 
 import gv
+import scheduler
+import forecast
+import tick_stats
+import engine
+import control
+import program_index
+import snapshot
+import dispatch
+import run_log
+import usage
 from helpers import *
-from gpio_pins import set_output
+from station_state import MAX_BOARDS
 from sip import template_render
 from blinker import signal
 
@@ -51,6 +61,7 @@ def report_program_toggle():
 
 class WebPage(object):
     def __init__(self):
+        engine.refresh()  # Current state from the engine process, if it runs separately.
         gv.cputemp = get_cpu_temp()
 
 
@@ -106,27 +117,31 @@ class change_values(ProtectedPage):
         qdict = web.input()
         print 'qdict: ', qdict
         if 'rsn' in qdict and qdict['rsn'] == '1':
-            stop_stations()
+            control.stop_all().wait(control.TIMEOUT)
             raise web.seeother('/')
+        commands = []
         if 'en' in qdict and qdict['en'] == '':
             qdict['en'] = '1'  # default
         elif 'en' in qdict and qdict['en'] == '0':
-            gv.srvals = [0] * (gv.sd['nst'])  # turn off all stations
-            set_output()
-        if 'mm' in qdict and qdict['mm'] == '0':
-            clear_mm()
-        if 'rd' in qdict and qdict['rd'] != '0' and qdict['rd'] != '':
-            gv.sd['rd'] = int(float(qdict['rd']))
-            gv.sd['rdst'] = int(gv.now + gv.sd['rd'] * 3600) # + 1  # +1 adds a smidge just so after a round trip the display hasn't already counted down by a minute.
-            stop_onrain()
-        elif 'rd' in qdict and qdict['rd'] == '0':
-            gv.sd['rdst'] = 0
+            commands.append(control.all_off())  # turn off all stations
+        if 'mm' in qdict and qdict['mm'] == '0' and gv.sd['mm']:
+            commands.append(control.end_manual_mode())
+        rain = None
+        if 'rd' in qdict and qdict['rd'] != '':
+            rain = control.rain_delay(int(float(qdict['rd'])))  # 0 cancels the rain delay
         for key in qdict.keys():
+            if key == 'rd':
+                continue  # set by the rain delay command
             try:
                 gv.sd[key] = int(qdict[key])
             except Exception:
                 pass
         jsave(gv.sd, 'sd')
+        scheduler.wake()
+        if rain is not None:
+            commands.append(rain)
+        for command in commands:
+            command.wait(control.TIMEOUT)
         report_value_change()
         raise web.seeother('/')  # Send browser back to home page
 
@@ -174,6 +189,7 @@ class change_options(ProtectedPage):
                 gv.sd[f] = qdict['o'+f]
 
         if 'onbrd' in qdict:
+            qdict['onbrd'] = str(max(0, min(int(qdict['onbrd']), MAX_BOARDS - 1)))  # expansion boards
             if int(qdict['onbrd']) + 1 != gv.sd['nbrd']:
                 self.update_scount(qdict)
             gv.sd['nbrd'] = int(qdict['onbrd']) + 1
@@ -184,23 +200,26 @@ class change_options(ProtectedPage):
                 qdict['rbt'] = '1'  # force reboot with change in htp
             gv.sd['htp'] = int(qdict['ohtp'])
 
-        for f in ['sdt', 'mas', 'mton', 'mtoff', 'wl', 'lr', 'tz']:
+        for f in ['sdt', 'mas', 'mton', 'mtoff', 'wl', 'lr', 'tz', 'rsdb', 'svd']:
             if 'o'+f in qdict:
                 if f == 'mton'  and int(qdict['o'+f])<0: #handle values less than zero (temp fix)
                     raise web.seeother('/vo?errorCode=mton_minus')                 
                 gv.sd[f] = int(qdict['o'+f])
 
-        for f in ['ipas', 'tf', 'urs', 'seq', 'rst', 'lg', 'idd', 'pigpio', 'alr']:
+        for f in ['ipas', 'tf', 'urs', 'seq', 'rst', 'lg', 'idd', 'pigpio', 'alr', 'eng', 'spi', 'asig', 'ldb']:
             if 'o'+f in qdict and (qdict['o'+f] == 'on' or qdict['o'+f] == '1'):
-                gv.sd[f] = 1
+                value = 1
             else:
-                gv.sd[f] = 0
+                value = 0
+            if f in ['eng', 'spi'] and value != gv.sd[f]:
+                qdict['rstrt'] = '1'  # force restart with change
+            gv.sd[f] = value
 
         jsave(gv.sd, 'sd')
+        scheduler.wake()
         report_option_change()
         if 'rbt' in qdict and qdict['rbt'] == '1':
-            gv.srvals = [0] * (gv.sd['nst'])
-            set_output()
+            control.all_off().wait(control.TIMEOUT)
             report_rebooted()
 #            os.system('reboot')
             reboot()
@@ -222,12 +241,7 @@ class change_options(ProtectedPage):
             ln = len(gv.snames)
             for i in range(incr*8):
                 gv.snames.append("S"+"{:0>2d}".format(i+1+ln))
-            for i in range(incr * 8):
-                gv.srvals.append(0)
-                gv.ps.append([0, 0])
-                gv.rs.append([0, 0, 0, 0])
-            for i in range(incr):
-                gv.sbits.append(0)
+            gv.stations.resize(gv.sd['nst'] + incr * 8)  # Also lengthens gv.srvals, gv.sbits, gv.ps and gv.rs
         elif int(qdict['onbrd']) + 1 < gv.sd['nbrd']:  # Shorten lists
             onbrd = int(qdict['onbrd'])
             decr = gv.sd['nbrd'] - (onbrd + 1)
@@ -239,11 +253,8 @@ class change_options(ProtectedPage):
             # nlst = gv.snames
             # nlst = nlst[:8+(onbrd*8)]
             newlen = gv.sd['nst'] - decr * 8
-            gv.srvals = gv.srvals[:newlen]
-            gv.ps = gv.ps[:newlen]
-            gv.rs = gv.rs[:newlen]
+            gv.stations.resize(newlen)  # Also shortens gv.srvals, gv.sbits, gv.ps and gv.rs
             gv.snames = gv.snames[:newlen]
-            gv.sbits = gv.sbits[:onbrd + 1]
         jsave(gv.snames, 'snames')
 
 
@@ -321,20 +332,11 @@ class get_set_station(ProtectedPage):
             else:
                 return _('Station ') + str(sid+1) + _(' not found.')
         elif gv.sd['mm']:
-            if set_to:  # if status is
-                gv.rs[sid][0] = gv.now  # set start time to current time
-                if set_time > 0:  # if an optional duration time is given
-                    gv.rs[sid][2] = set_time
-                    gv.rs[sid][1] = gv.rs[sid][0] + set_time  # stop time = start time + duration
-                else:
-                    gv.rs[sid][1] = float('inf')  # stop time = infinity
-                gv.rs[sid][3] = 99  # set program index
-                gv.ps[sid][1] = set_time
-                gv.sd['bsy'] = 1
-                time.sleep(1)
+            if set_to:  # if status is on
+                done = control.start_station(sid, set_time)  # optional duration, otherwise until turned off
             else:  # If status is off
-                gv.rs[sid][1] = gv.now + 2
-                time.sleep(2)
+                done = control.stop_station(sid)
+            done.wait(control.TIMEOUT)
             raise web.seeother('/')
         else:
             return _('Manual mode not active.')
@@ -356,29 +358,7 @@ class change_runonce(ProtectedPage):
             return
         gv.rovals = json.loads(qdict['t'])
         gv.rovals.pop()
-        for sid in range(gv.sd['nst']):
-            if gv.srvals[sid]:  # if currently on, log result
-                gv.lrun[0] = sid
-                gv.lrun[1] = gv.rs[sid][3]
-                gv.lrun[2] = int(gv.now - gv.rs[sid][0])
-                gv.lrun[3] = gv.now     # think this is unused
-                log_run()
-                report_station_completed(sid + 1)
-        stations = [0] * gv.sd['nbrd']
-        gv.ps = []  # program schedule (for display)
-        gv.rs = []  # run schedule
-        for sid in range(gv.sd['nst']):
-            gv.ps.append([0, 0])
-            gv.rs.append([0, 0, 0, 0])
-        for sid, dur in enumerate(gv.rovals):
-            if dur:  # if this element has a value
-                gv.rs[sid][0] = gv.now
-                gv.rs[sid][2] = dur
-                gv.rs[sid][3] = 98
-                gv.ps[sid][0] = 98
-                gv.ps[sid][1] = dur
-                stations[sid / 8] += 2 ** (sid % 8)
-        schedule_stations(stations)
+        control.run_once(list(gv.rovals)).wait(control.TIMEOUT)
         raise web.seeother('/')
 
 
@@ -414,15 +394,9 @@ class change_program(ProtectedPage):
         qdict = web.input()
         pnum = int(qdict['pid']) + 1  # program number
         cp = json.loads(qdict['v'])
+        stopped = None
         if cp[0] == 0 and pnum == gv.pon:  # if disabled and program is running
-            for i in range(len(gv.ps)):
-                if gv.ps[i][0] == pnum:
-                    gv.ps[i] = [0, 0]
-                if gv.srvals[i]:
-                    gv.srvals[i] = 0
-            for i in range(len(gv.rs)):
-                if gv.rs[i][3] == pnum:
-                    gv.rs[i] = [0, 0, 0, 0]
+            stopped = control.stop_program(pnum)
         if cp[1] >= 128 and cp[2] > 1:
             dse = int(gv.now / 86400)
             ref = dse + cp[1] - 128
@@ -433,6 +407,10 @@ class change_program(ProtectedPage):
             gv.pd[int(qdict['pid'])] = cp  # replace program
         jsave(gv.pd, 'programs')
         gv.sd['nprogs'] = len(gv.pd)
+        program_index.invalidate()  # Before waking, so the timing loop does not re-plan from the old index.
+        scheduler.wake()
+        if stopped is not None:
+            stopped.wait(control.TIMEOUT)
         report_program_change()
         raise web.seeother('/vp')
 
@@ -449,6 +427,8 @@ class delete_program(ProtectedPage):
             del gv.pd[int(qdict['pid'])]
         jsave(gv.pd, 'programs')
         gv.sd['nprogs'] = len(gv.pd)
+        program_index.invalidate()  # Before waking, so the timing loop does not re-plan from the old index.
+        scheduler.wake()
         report_program_deleted()
         raise web.seeother('/vp')
 
@@ -460,24 +440,27 @@ class enable_program(ProtectedPage):
         qdict = web.input()
         gv.pd[int(qdict['pid'])][0] = int(qdict['enable'])
         jsave(gv.pd, 'programs')
+        program_index.invalidate()
+        scheduler.wake()
         report_program_toggle()
         raise web.seeother('/vp')
 
 
 class view_log(ProtectedPage):
-    """View Log"""
+    """View Log. Only the first page is rendered, the page fetches the rest from /api/logpage."""
+
+    PAGE_SIZE = 100
 
     def GET(self):
-        records = read_log()
-        return template_render.log(records)
+        records, cursor = run_log.page(size=self.PAGE_SIZE)
+        return template_render.log(records, run_log.count(), cursor)
 
 
 class clear_log(ProtectedPage):
     """Delete all log records"""
 
     def GET(self):
-        with io.open('./data/log.json', 'w') as f:
-            f.write(u'')
+        run_log.clear()
         raise web.seeother('/vl')
 
 
@@ -487,29 +470,9 @@ class run_now(ProtectedPage):
     def GET(self):
         qdict = web.input()
         pid = int(qdict['pid'])
-        p = gv.pd[int(qdict['pid'])]  # program data
-#        if not p[0]:  # if program is disabled
+#        if not gv.pd[pid][0]:  # if program is disabled
 #           Sraise web.seeother('/vp')
-        stop_stations()
-        extra_adjustment = plugin_adjustment()
-        sid = -1
-        for b in range(gv.sd['nbrd']):  # check each station
-            for s in range(8):
-                sid += 1  # station index
-                if sid + 1 == gv.sd['mas']:  # skip if this is master valve
-                    continue
-                if p[7 + b] & 1 << s:  # if this station is scheduled in this program
-                    if gv.sd['idd']:
-                        duration = p[-1][sid]
-                    else:
-                        duration = p[6]
-                    if not gv.sd['iw'][b] & 1 << s:
-                        duration = duration * gv.sd['wl'] / 100 * extra_adjustment
-                    gv.rs[sid][2] = duration
-                    gv.rs[sid][3] = pid + 1  # store program number in schedule
-                    gv.ps[sid][0] = pid + 1  # store program number for display
-                    gv.ps[sid][1] = duration  # duration
-        schedule_stations(p[7:7 + gv.sd['nbrd']])
+        control.run_program(pid).wait(control.TIMEOUT)
         raise web.seeother('/')
 
 
@@ -530,34 +493,40 @@ class api_status(ProtectedPage):
     """Simple Status API"""
 
     def GET(self):
+        snap = snapshot.current()  # One consistent view of the state
+        snapshot.not_modified(snap)  # 304 if the poller already has this version
+        sd = snap.sd
+        ps = snap.ps
         statuslist = []
-        for bid in range(0, gv.sd['nbrd']):
+        for bid in range(0, sd['nbrd']):
             for s in range(0, 8):
-                if (gv.sd['show'][bid] >> s) & 1 == 1:
+                if (sd['show'][bid] >> s) & 1 == 1:
                     sid = bid * 8 + s
                     sn = sid + 1
-                    sname = gv.snames[sid]
-                    sbit = (gv.sbits[bid] >> s) & 1
-                    irbit = (gv.sd['ir'][bid] >> s) & 1
+                    sname = snap.snames[sid]
+                    sbit = (snap.sbits[bid] >> s) & 1
+                    irbit = (sd['ir'][bid] >> s) & 1
                     status = {'station': sid, 'status': 'disabled', 'reason': '', 'master': 0, 'programName': '',
                               'remaining': 0, 'name': sname}
-                    if gv.sd['en'] == 1:
+                    if sd['en'] == 1:
                         if sbit:
                             status['status'] = 'on'
                         if not irbit:
-                            if gv.sd['rd'] != 0:
+                            if sd['rd'] != 0:
                                 status['reason'] = 'rain_delay'
-                            if gv.sd['urs'] != 0 and gv.sd['rs'] != 0:
+                            if sd['urs'] != 0 and sd['rs'] != 0:
                                 status['reason'] = 'rain_sensed'
-                        if sn == gv.sd['mas']:
+                        if sn == sd['mas']:
                             status['master'] = 1
                             status['reason'] = 'master'
+                        elif not sbit and ps[sid][0] == 0:
+                            status['status'] = 'off'
                         else:
-                            rem = gv.ps[sid][1]
+                            rem = ps[sid][1]
                             if rem > 65536:
                                 rem = 0
 
-                            id_nr = gv.ps[sid][0]
+                            id_nr = ps[sid][0]
                             pname = 'P' + str(id_nr)
                             if id_nr == 255 or id_nr == 99:
                                 pname = 'Manual Mode'
@@ -570,13 +539,10 @@ class api_status(ProtectedPage):
                                 status['programName'] = pname
                                 status['remaining'] = rem
                             else:
-                                if gv.ps[sid][0] == 0:
-                                    status['status'] = 'off'
-                                else:
-                                    status['status'] = 'waiting'
-                                    status['reason'] = 'program'
-                                    status['programName'] = pname
-                                    status['remaining'] = rem
+                                status['status'] = 'waiting'
+                                status['reason'] = 'program'
+                                status['programName'] = pname
+                                status['remaining'] = rem
                     else:
                         status['reason'] = 'system_off'
                     statuslist.append(status)
@@ -595,14 +561,12 @@ class api_log(ProtectedPage):
         prevday = theday - datetime.timedelta(days=1)
         prevdate = prevday.strftime('%Y-%m-%d')
 
-        records = read_log()
+        records = run_log.records_between(prevdate, thedate)
         data = []
 
         for event in records:
-            #event = ast.literal_eval(json.loads(r))
-
             # return any records starting on this date
-            if 'date' not in qdict or event['date'] == thedate:
+            if event['date'] == thedate:
                 data.append(event)
                 # also return any records starting the day before and completing after midnight
             if event['date'] == prevdate:
@@ -614,19 +578,124 @@ class api_log(ProtectedPage):
         return json.dumps(data)
 
 
-class water_log(ProtectedPage):
-    """Simple Log API"""
+class api_usage(ProtectedPage):
+    """
+    Run count and run time (seconds) per station or program, from the usage totals (usage.py).
+    by is "station" (default, numbered from 0) or "program"; period is "day", "week",
+    "month" (default) or "year"; first and last limit the period ids ("2024-05-01",
+    "2024-W18", "2024-05", "2024"); station or program selects one of them.
+    The ETag changes only when a run is added.
+    """
 
     def GET(self):
-        records = read_log()
-        data = _("Date, Start Time, Zone, Duration, Program") + "\n"
-        for r in records:
-            event = ast.literal_eval(json.dumps(r))
-            data += event["date"] + ", " + event["start"] + ", " + str(event["station"]+1) + ", " + event[
-                "duration"] + ", " + event["program"] + "\n"
+        qdict = web.input()
+        by = qdict.get('by', 'station')
+        period = qdict.get('period', 'month')
+        etag = '"{}"'.format(usage.version())
+        web.header('ETag', etag)
+        if web.ctx.env.get('HTTP_IF_NONE_MATCH') == etag:
+            raise web.notmodified()
+        try:
+            data = usage.totals(by, period, qdict.get('first'), qdict.get('last'), qdict.get(by))
+        except ValueError:
+            raise web.badrequest()
+        web.header('Content-Type', 'application/json')
+        return json.dumps({'by': by, 'period': period, 'usage': data})
 
+
+class api_log_page(ProtectedPage):
+    """
+    A page of log records, most recent first. Pass the cursor returned with a
+    page to get the next one; size is the number of records (default 100, max 1000).
+    """
+
+    def GET(self):
+        qdict = web.input()
+        try:
+            size = max(1, min(int(qdict.get('size', 100)), 1000))
+            records, cursor = run_log.page(qdict.get('cursor') or None, size)
+        except ValueError:
+            raise web.badrequest()
+        web.header('Content-Type', 'application/json')
+        return json.dumps({'records': records, 'next': cursor, 'total': run_log.count()})
+
+
+class api_forecast(ProtectedPage):
+    """Station runs expected from the current programs over the next days (default 7, max 365)."""
+
+    def GET(self):
+        qdict = web.input()
+        try:
+            days = int(qdict.get('days', 7))
+        except ValueError:
+            days = 7
+        web.header('Content-Type', 'application/json')
+        return json.dumps(forecast.forecast(days))
+
+
+class api_tickstats(ProtectedPage):
+    """Timing loop lateness and phase times. Add recent=N to include the latest N passes."""
+
+    def GET(self):
+        qdict = web.input()
+        try:
+            recent = int(qdict.get('recent', 0))
+        except ValueError:
+            recent = 0
+        web.header('Content-Type', 'application/json')
+        return json.dumps(tick_stats.stats(recent))
+
+
+class api_signals(ProtectedPage):
+    """Calls, time and exceptions of each receiver of each signal."""
+
+    def GET(self):
+        web.header('Content-Type', 'application/json')
+        return json.dumps(dispatch.receiver_stats())
+
+
+class metrics(ProtectedPage):
+    """Timing loop histograms and signal counters in Prometheus text format."""
+
+    def GET(self):
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return tick_stats.prometheus() + dispatch.prometheus()
+
+
+class water_log(ProtectedPage):
+    """
+    Log as csv, most recent first. Optional filters: start and end dates ("yyyy-mm-dd"),
+    station (1 based) and program (as in the log: program number, "Manual" or "Run-once").
+    Rows are streamed as they are read from the log.
+    """
+
+    ROWS_PER_CHUNK = 200
+
+    def GET(self):
+        qdict = web.input()
+        try:
+            station = int(qdict['station']) - 1 if qdict.get('station') else None
+        except ValueError:
+            raise web.badrequest()
         web.header('Content-Type', 'text/csv')
-        return data
+        return self.rows(qdict.get('start') or '', qdict.get('end') or '9999-12-31',
+                         station, qdict.get('program') or None)
+
+    def rows(self, start, end, station, program):
+        yield _("Date, Start Time, Zone, Duration, Program") + "\n"
+        chunk = []
+        for event in run_log.records_between(start, end):
+            if station is not None and event["station"] != station:
+                continue
+            if program is not None and event["program"] != program:
+                continue
+            chunk.append(", ".join([event["date"], event["start"], str(event["station"] + 1),
+                                    event["duration"], event["program"]]) + "\n")
+            if len(chunk) >= self.ROWS_PER_CHUNK:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
     
 class rain_sensor_state(ProtectedPage):
     """Return rain sensor state."""